@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Form, UploadFile, File, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from fastapi.responses import FileResponse, HTMLResponse
 from pydantic import BaseModel
 # --- ИЗМЕНЕНИЕ: Используем АСИНХРОННЫЙ клиент OpenAI ---
@@ -6,32 +6,38 @@ from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import os
 import uvicorn
-from typing import Dict, List, Any, AsyncGenerator, Optional
+from typing import Dict, List, Any, AsyncGenerator, Optional, Tuple
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import StreamingResponse
 import aiosqlite
+import sqlite3
 import json
+import hashlib
+import hmac
 import datetime
 import asyncio
-from asyncddgs import aDDGS
 import aiohttp
-from bs4 import BeautifulSoup
 import re
-
-import io
-import pandas as pd
-import docx
-from pypdf import PdfReader
-from starlette.datastructures import UploadFile as StarletteUploadFile
+import time
+
+from db_engine import GroupCommitWriter, ReadConnectionPool, open_writer_connection
+from caches import ContentCache, DiskCacheStore, LRUCache, TwoLevelCache
+from http_client import HttpPoolStats, create_http_session, pool_stats
+from html_extract import extract_text_from_response
+from search_providers import DDGSProvider, FakeSearchProvider, HedgedSearch, SearchProvider
+from file_parsers import ParserPool, ParserPoolBusy, ParseTimeout, parse_csv, parse_docx, parse_html, parse_pdf, parse_xlsx, read_text_prefix
+from uploads import SpooledUpload, UploadSizeLimitMiddleware, receive_upload_form
+import file_index
+import message_search
+import pagination
+from context_builder import build_context, count_tokens
+from plan_classifier import PlanClassifier, PlanLogWriter, label_to_plan
 
 # --- Новые импорты для безопасности ---
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from datetime import datetime, timedelta, timezone
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
-
-ph = PasswordHasher()
+from password_hashing import PasswordHashPool, PasswordPoolBusy, make_password_hasher
 
 # --- Regex для deteksi URL ---
 URL_REGEX = re.compile(r'https://[\w\.-]+[/\w\.-]*')
@@ -63,39 +69,324 @@ app = FastAPI(
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # --- Настройка базы данных ---
-DB_NAME = "database.db"
+# Каталог постоянных данных: база, кэши поиска и файлов, журнал и модель планировщика.
+# В Docker — смонтированный том /app/data (см. Dockerfile); каждый путь можно
+# переопределить своей переменной
+DATA_DIR = os.environ.get("DATA_DIR", ".")
+# Рядом с файлом БД SQLite создаёт -wal/-shm, поэтому в Docker монтируется каталог
+DB_NAME = os.environ.get("DB_PATH", os.path.join(DATA_DIR, "database.db"))
+
+# Версия схемы хранится в PRAGMA user_version.
+# 1 — сообщения вынесены из JSON-колонки chats.messages в отдельную таблицу messages.
+# 2 — денормализованные preview / message_count в chats для быстрого /get_chats.
+# 3 — индекс фрагментов прикреплённых файлов file_chunks + FTS5 (см. file_index.py).
+# 4 — скользящее резюме чата chats.summary / summary_seq.
+# 5 — полнотекстовый индекс реплик messages_fts (см. message_search.py).
+# 6 — индекс списка чатов с chat_id для keyset-пагинации (см. pagination.py).
+SCHEMA_VERSION = 6
+
+# Превью в списке чатов хранится обрезанным: фронтенд всё равно показывает ~30 символов
+PREVIEW_MAX_LENGTH = 200
+
+# --- Параметры движка SQLite (см. db_engine.py) ---
+DB_READ_POOL_SIZE = int(os.environ.get("DB_READ_POOL_SIZE", "4"))
+DB_GROUP_COMMIT_MAX_BATCH = int(os.environ.get("DB_GROUP_COMMIT_MAX_BATCH", "64"))
+DB_GROUP_COMMIT_DELAY_MS = float(os.environ.get("DB_GROUP_COMMIT_DELAY_MS", "0"))
 
 @app.on_event("startup")
 async def startup_event():
-    app.state.db = await aiosqlite.connect(DB_NAME)
-    app.state.db.row_factory = aiosqlite.Row
-    
+    # Соединение писателя: на нём же создаётся схема и идут миграции
+    db = await open_writer_connection(DB_NAME)
+    app.state.db = db
+
+    await _migrate_schema(db)
+
+    # Все дальнейшие записи идут через group-commit писателя, чтения — через пул
+    app.state.db_writer = GroupCommitWriter(
+        db,
+        max_batch=DB_GROUP_COMMIT_MAX_BATCH,
+        max_delay=DB_GROUP_COMMIT_DELAY_MS / 1000,
+    )
+    app.state.db_writer.start()
+    app.state.db_readers = ReadConnectionPool(DB_NAME, size=DB_READ_POOL_SIZE)
+    await app.state.db_readers.open()
+    print(f"✅ База данных инициализирована (WAL, пул чтения: {DB_READ_POOL_SIZE}, pid: {os.getpid()}).")
+
+    _load_plan_classifier()
+    if PLAN_LOG_ENABLED:
+        plan_log.start()
+
+    app.state.http = create_http_session(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        dns_ttl=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        stats=http_pool_stats,
+    )
+
+    await search_cache_store.open()
+    await search_provider.open()
+    await parsed_file_cache.open()
+    parser_pool.start()
+    password_pool.start()
+    purged = await search_results_cache.purge_expired() + await page_content_cache.purge_expired()
+    print(f"✅ Кэш поиска открыт ({SEARCH_CACHE_DB_PATH}, удалено устаревших записей: {purged}).")
+
+
+async def _create_tables(db: aiosqlite.Connection):
     # --- Таблица чатов ---
-    await app.state.db.execute('''
+    await db.execute('''
         CREATE TABLE IF NOT EXISTS chats (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
             chat_id TEXT UNIQUE NOT NULL,
             chat_name TEXT NOT NULL,
-            messages TEXT,
-            updated_at TEXT
+            updated_at TEXT,
+            preview TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            summary TEXT,
+            summary_seq INTEGER NOT NULL DEFAULT 0
         )
     ''')
-    
+
+    # --- Таблица сообщений (append-only, одна строка на сообщение) ---
+    # kind: 'message' — видимые реплики user/assistant,
+    #       'file' / 'link' — системный контекст из файла или URL.
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'message',
+            created_at TEXT NOT NULL
+        )
+    ''')
+    await db.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_chat_seq ON messages (chat_id, seq)"
+    )
+
+    # Список чатов пользователя читается одним проходом по этому индексу;
+    # chat_id в конце — однозначный порядок и курсор страницы при равных updated_at
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chats_user_updated_chat "
+        "ON chats (user_id, updated_at DESC, chat_id DESC)"
+    )
+
+    # --- Фрагменты прикреплённых файлов и их полнотекстовый индекс ---
+    # file_chunks_fts хранит только индекс (content= внешний), тексты — в file_chunks;
+    # триггеры держат индекс в соответствии с таблицей
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS file_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            chunk_no INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_file_chunks_chat ON file_chunks (chat_id, user_id, file_name)"
+    )
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS file_chunks_fts USING fts5(
+            content,
+            content = 'file_chunks',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS file_chunks_ai AFTER INSERT ON file_chunks BEGIN
+            INSERT INTO file_chunks_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS file_chunks_ad AFTER DELETE ON file_chunks BEGIN
+            INSERT INTO file_chunks_fts (file_chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+
     # *** ИЗМЕНЕНИЕ: Новая таблица пользователей ***
-    await app.state.db.execute('''
+    await db.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             hashed_password TEXT NOT NULL
         )
     ''')
-    await app.state.db.commit()
-    print("✅ База данных инициализирована (с таблицей users).")
+
+    # --- Полнотекстовый индекс видимых реплик (см. message_search.py) ---
+    # Внешний контент — представление: текст берётся из messages, а колонка owner
+    # ("u<users.id>", один токен) делит индекс по пользователям, чтобы поиск
+    # читал только реплики этого пользователя. unicode61 не сводит "ё" к "е",
+    # поэтому текст индексируется уже с заменой (как и поисковые запросы)
+    await db.execute('''
+        CREATE VIEW IF NOT EXISTS messages_search_source AS
+        SELECT m.id AS id, replace(replace(m.content, 'ё', 'е'), 'Ё', 'Е') AS content, 'u' || u.id AS owner
+        FROM messages m
+        JOIN chats c ON c.chat_id = m.chat_id
+        JOIN users u ON u.username = c.user_id
+        WHERE m.kind = 'message'
+    ''')
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            owner,
+            content = 'messages_search_source',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    # Чат создаётся раньше своих сообщений и удаляется после них (delete_chat),
+    # поэтому владелец в триггерах всегда находится
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages
+        WHEN new.kind = 'message' BEGIN
+            INSERT INTO messages_fts (rowid, content, owner) VALUES (
+                new.id, replace(replace(new.content, 'ё', 'е'), 'Ё', 'Е'),
+                (SELECT 'u' || u.id FROM chats c JOIN users u ON u.username = c.user_id
+                 WHERE c.chat_id = new.chat_id)
+            );
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages
+        WHEN old.kind = 'message' BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, owner) VALUES (
+                'delete', old.id, replace(replace(old.content, 'ё', 'е'), 'Ё', 'Е'),
+                (SELECT 'u' || u.id FROM chats c JOIN users u ON u.username = c.user_id
+                 WHERE c.chat_id = old.chat_id)
+            );
+        END
+    ''')
+
+
+def _legacy_message_kind(message: Dict[str, str]) -> str:
+    """Определяет kind для сообщения из старого JSON-формата."""
+    if message.get("role") in ("user", "assistant"):
+        return "message"
+    content = message.get("content") or ""
+    if content.startswith("Контекст, извлеченный из прикрепленного файла"):
+        return "file"
+    if content.startswith("Контекст, извлеченный из URL"):
+        return "link"
+    return "context"
+
+
+async def _migrate_schema(db: aiosqlite.Connection):
+    """
+    Создание таблиц и одноразовые миграции по PRAGMA user_version.
+    Выполняются одной транзакцией BEGIN IMMEDIATE: при старте нескольких
+    воркеров схему создаёт первый, остальные ждут блокировку (busy_timeout)
+    и видят уже актуальную версию.
+    """
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        await _create_tables(db)
+        await _apply_migrations(db)
+    except Exception:
+        await db.execute("ROLLBACK")
+        raise
+    await db.execute("COMMIT")
+
+
+async def _apply_migrations(db: aiosqlite.Connection):
+    """
+    Версия 1: перенос JSON-истории из chats.messages в таблицу messages.
+    Версия 2: заполнение preview / message_count.
+    Версия 3: только новые таблицы (file_chunks) — старые файлы остаются в истории как есть.
+    Версия 4: колонки резюме; резюме старых чатов строится в фоне при следующем ответе.
+    Версия 5: индексация уже сохранённых реплик в messages_fts.
+    Версия 6: индекс списка чатов заменён на (user_id, updated_at, chat_id).
+    """
+    async with db.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+    if version >= SCHEMA_VERSION:
+        return
+
+    async with db.execute("PRAGMA table_info(chats)") as cursor:
+        chat_columns = {row["name"] async for row in cursor}
+
+    if version < 1 and "messages" in chat_columns:
+        migrated = 0
+        async with db.execute(
+            "SELECT chat_id, messages, updated_at FROM chats WHERE messages IS NOT NULL"
+        ) as cursor:
+            legacy_rows = await cursor.fetchall()
+
+        for row in legacy_rows:
+            legacy_messages = json.loads(row["messages"]) if row["messages"] else []
+            created_at = row["updated_at"] or datetime.now().isoformat()
+            await db.executemany("""
+                INSERT OR IGNORE INTO messages (chat_id, seq, role, content, kind, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [
+                (row["chat_id"], seq, msg.get("role"), msg.get("content") or "",
+                 _legacy_message_kind(msg), created_at)
+                for seq, msg in enumerate(legacy_messages)
+            ])
+            migrated += 1
+
+        # Старая колонка остаётся пустой: история теперь живёт только в messages
+        await db.execute("UPDATE chats SET messages = NULL WHERE messages IS NOT NULL")
+        print(f"🔁 Миграция: история {migrated} чатов перенесена в таблицу messages.")
+
+    if version < 2:
+        # message_count — число строк в messages (включая системный контекст),
+        # preview — последнее видимое сообщение (user/assistant)
+        if "preview" not in chat_columns:
+            await db.execute("ALTER TABLE chats ADD COLUMN preview TEXT")
+        if "message_count" not in chat_columns:
+            await db.execute("ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+        await db.execute(f"""
+            UPDATE chats SET
+                message_count = (SELECT COUNT(*) FROM messages m WHERE m.chat_id = chats.chat_id),
+                preview = (SELECT substr(m.content, 1, {PREVIEW_MAX_LENGTH}) FROM messages m
+                           WHERE m.chat_id = chats.chat_id AND m.kind = 'message'
+                           ORDER BY m.seq DESC LIMIT 1)
+        """)
+        print("🔁 Миграция: заполнены preview / message_count в таблице chats.")
+
+    if version < 4:
+        # summary — сжатое содержание сообщений с seq < summary_seq
+        if "summary" not in chat_columns:
+            await db.execute("ALTER TABLE chats ADD COLUMN summary TEXT")
+        if "summary_seq" not in chat_columns:
+            await db.execute("ALTER TABLE chats ADD COLUMN summary_seq INTEGER NOT NULL DEFAULT 0")
+
+    if version < 5:
+        # Триггеры индексируют только новые записи — существующие добавляем разом
+        indexed = await message_search.rebuild_messages_index(db)
+        print(f"🔁 Миграция: в поисковый индекс добавлено {indexed} сообщений.")
+
+    if version < 6:
+        # Новый индекс создан в _create_tables, прежний — его префикс, он лишний.
+        # NULL в сравнении курсора выпал бы из выдачи: пустая строка сортируется так же (последней)
+        await db.execute("DROP INDEX IF EXISTS idx_chats_user_updated")
+        await db.execute("UPDATE chats SET updated_at = '' WHERE updated_at IS NULL")
+
+    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    # Фоновые резюме не дожидаемся: недостроенное обновится после следующего ответа
+    for task in list(_summary_tasks):
+        task.cancel()
+    # Сначала дописываем очередь писателя, затем закрываем соединения
+    await app.state.db_writer.close()
+    await app.state.db_readers.close()
     await app.state.db.close()
+    await search_cache_store.close()
+    await search_provider.close()
+    await parsed_file_cache.close()
+    await plan_log.close()
+    parser_pool.close()
+    password_pool.close()
+    await app.state.http.close()
     print("🧹 Соединение с базой закрыто.")
 
 # --- ********************************* ---
@@ -110,6 +401,33 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 24 часа
 
+# --- Кэши проверки токена (get_current_user вызывается на каждый защищённый запрос) ---
+# Проверенные токены: ключ — sha256 токена, запись живёт до его exp
+AUTH_TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# Существование пользователя (и отсутствие — тоже): кэш у каждого воркера свой,
+# регистрация сбрасывает запись только в своём, поэтому TTL короткий
+AUTH_USER_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_USER_CACHE_MAX_ENTRIES", "10000"))
+AUTH_USER_CACHE_TTL_SECONDS = float(os.environ.get("AUTH_USER_CACHE_TTL_SECONDS", "30"))
+# Токену, выданному не раньше стольких секунд назад, верим без проверки пользователя в БД
+# (0 — проверять всегда). Пользователи не удаляются, риск — только у сброшенной базы
+AUTH_TRUST_FRESH_TOKEN_SECONDS = int(os.environ.get("AUTH_TRUST_FRESH_TOKEN_SECONDS", "0"))
+
+token_cache = LRUCache(
+    ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    max_entries=AUTH_TOKEN_CACHE_MAX_ENTRIES,
+)
+user_exists_cache = LRUCache(
+    ttl=AUTH_USER_CACHE_TTL_SECONDS,
+    max_entries=AUTH_USER_CACHE_MAX_ENTRIES,
+)
+auth_stats = {
+    "token_decodes": 0,
+    "token_cache_hits": 0,
+    "trusted_fresh": 0,
+    "user_lookups": 0,
+    "rejected": 0,
+}
+
 # Контекст для хеширования паролей
 
 
@@ -125,6 +443,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    issued_at: Optional[float] = None
 
 class User(BaseModel):
     username: str
@@ -138,24 +457,27 @@ class UserCreate(BaseModel):
 
 # --- Утилиты аутентификации ---
 
-# --- ИЗМЕНЕНИЕ: Это БЛОКИРУЮЩИЕ функции (CPU-bound) ---
-# Мы не делаем их 'async def', но будем вызывать их через to_thread
-def verify_password(plain_password, hashed_password):
-    try:
-        ph.verify(hashed_password, plain_password)
-        return True
-    except VerifyMismatchError:
-        return False
-
-def get_password_hash(password):
-    return ph.hash(password)
-# --- Конец блокирующих функций ---
+# --- Хеширование паролей: Argon2 в собственном ограниченном пуле потоков (password_hashing.py) ---
+# Параметры стоимости по умолчанию — как у argon2-cffi; подобрать под железо:
+# python bench_password_hash.py. Хеши со старыми параметрами проверяются как прежде
+# и пересчитываются при следующем успешном входе.
+ARGON2_TIME_COST = int(os.environ.get("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST_KIB = int(os.environ.get("ARGON2_MEMORY_COST_KIB", "65536"))
+ARGON2_PARALLELISM = int(os.environ.get("ARGON2_PARALLELISM", "4"))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", "16"))
+
+password_pool = PasswordHashPool(
+    make_password_hasher(ARGON2_TIME_COST, ARGON2_MEMORY_COST_KIB, ARGON2_PARALLELISM),
+    max_workers=PASSWORD_HASH_WORKERS,
+    max_queue=PASSWORD_HASH_QUEUE_SIZE,
+)
 
 
 async def get_user_from_db(username: str) -> Optional[UserInDB]:
-    db = get_db()
-    async with db.execute("SELECT username, hashed_password FROM users WHERE username = ?", (username,)) as cursor:
-        user_row = await cursor.fetchone()
+    async with read_db() as db:
+        async with db.execute("SELECT username, hashed_password FROM users WHERE username = ?", (username,)) as cursor:
+            user_row = await cursor.fetchone()
     if user_row:
         return UserInDB(**user_row)
     return None
@@ -166,7 +488,8 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    # iat — по нему get_current_user узнаёт «свежие» токены (AUTH_TRUST_FRESH_TOKEN_SECONDS)
+    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc)})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -182,27 +505,53 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        # --- ИЗМЕНЕНИЕ: Выполняем быструю (sync) CPU-операцию в to_thread
-        # Хотя JWT быстр, это "полностью" асинхронный подход
-        payload = await asyncio.to_thread(
-            jwt.decode, token, SECRET_KEY, [ALGORITHM]
-        )
-        
+    # Проверенный ранее токен не декодируется повторно: подпись и exp уже проверены,
+    # а запись в кэше истекает вместе с токеном
+    token_key = hashlib.sha256(token.encode("utf-8")).digest()
+    token_data = token_cache.get(token_key)
+    if token_data is not None:
+        auth_stats["token_cache_hits"] += 1
+    else:
+        try:
+            # HS256 — микросекунды, выполняется прямо в цикле событий (без to_thread)
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            auth_stats["rejected"] += 1
+            raise credentials_exception
+        auth_stats["token_decodes"] += 1
+
         username: str = payload.get("sub")
-        if username is None:
+        if username is None or not isinstance(payload.get("exp"), (int, float)):
+            auth_stats["rejected"] += 1
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    
-    user = await get_user_from_db(token_data.username)
-    if user is None:
+        token_data = TokenData(username=username, issued_at=payload.get("iat"))
+        ttl = payload["exp"] - time.time()
+        if ttl > 0:
+            token_cache.set(token_key, token_data, ttl=ttl)
+
+    if not await _user_exists(token_data):
+        auth_stats["rejected"] += 1
         raise credentials_exception
     
     # *** ИЗМЕНЕНИЕ: Возвращаем словарь с именем пользователя ***
     # Это позволит нам использовать 'user['username']' в защищенных маршрутах
-    return {"username": user.username}
+    return {"username": token_data.username}
+
+async def _user_exists(token_data: TokenData) -> bool:
+    """Есть ли владелец токена в users: сначала доверие свежему токену, затем кэш, затем БД."""
+    if (AUTH_TRUST_FRESH_TOKEN_SECONDS > 0 and token_data.issued_at is not None
+            and time.time() - token_data.issued_at < AUTH_TRUST_FRESH_TOKEN_SECONDS):
+        auth_stats["trusted_fresh"] += 1
+        return True
+
+    exists = user_exists_cache.get(token_data.username)
+    if exists is None:
+        auth_stats["user_lookups"] += 1
+        async with read_db() as db:
+            async with db.execute("SELECT 1 FROM users WHERE username = ?", (token_data.username,)) as cursor:
+                exists = await cursor.fetchone() is not None
+        user_exists_cache.set(token_data.username, exists)
+    return exists
 
 # --- *********************************** ---
 # --- *** КОНЕЦ БЛОКА АУТЕНТИФИКАЦИИ *** ---
@@ -341,7 +690,7 @@ ANALYSIS_PLAN_PROMPT_TEMPLATE = """
     -   Если "needs_search" - false, верни 0.
     -   Ключ: "num_results" (integer: 0, 1, 3, 5).
 
-История чата (последние 5 сообщений):
+История чата (краткое содержание, если есть, и последние 5 сообщений):
 {history}
 
 Запрос пользователя: "{query}"
@@ -353,58 +702,372 @@ ANALYSIS_PLAN_PROMPT_TEMPLATE = """
 class ChatHistoryRequest(BaseModel):
     # *** ИЗМЕНЕНИЕ: user_id больше не нужен, мы берем его из токена ***
     chat_id: str
+    # Постраничная история (/get_chat_history): без limit — вся история целиком
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
 
 # *** ИЗМЕНЕНИЕ: UserIdRequest больше не нужен, мы используем токен ***
 # class UserIdRequest(BaseModel):
 #     user_id: str
 
-# --- Утилита для доступа к БД ---
-def get_db():
-    return app.state.db
+# --- Утилиты для доступа к БД ---
+def read_db():
+    """Контекстный менеджер: соединение из пула чтения."""
+    return app.state.db_readers.acquire()
+
+async def db_write(op):
+    """Выполняет op(conn) в очередной group-commit транзакции писателя."""
+    return await app.state.db_writer.submit(op)
+
+# --- Кэш "горячих" чатов ---
+# Декодированное состояние чата (имя + сообщения) по ключу (user_id, chat_id):
+# следующий ход того же пользователя обычно приходит через несколько секунд.
+CHAT_CACHE_MAX_BYTES = int(os.environ.get("CHAT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CHAT_CACHE_TTL_SECONDS = float(os.environ.get("CHAT_CACHE_TTL_SECONDS", "600"))
+
+def _chat_state_size(state: Dict[str, Any]) -> int:
+    # Приблизительно: строки Python с кириллицей занимают ~2 байта на символ
+    return 256 + 2 * len(state["summary"] or "") + sum(64 + 2 * len(m["content"]) for m in state["messages"])
+
+chat_cache = LRUCache(
+    max_bytes=CHAT_CACHE_MAX_BYTES,
+    ttl=CHAT_CACHE_TTL_SECONDS,
+    sizeof=_chat_state_size,
+)
+
+async def _revalidate_cached_chat(cache_key, cached: Dict[str, Any]) -> Dict[str, Any] | None:
+    """
+    Кэш у каждого воркера свой, а писать в чат может любой воркер.
+    Поэтому запись сверяется с chats.message_count (точечное чтение по индексу):
+    совпало — отдаём как есть, выросло — догружаем только хвост по seq.
+    Резюме обновляется в фоне и сверяется по summary_seq.
+    """
+    user_id, chat_id = cache_key
+    cached_count = len(cached["messages"])
+    async with read_db() as db:
+        async with db.execute(
+            "SELECT chat_name, message_count, summary, summary_seq FROM chats WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None or row["message_count"] < cached_count:
+            chat_cache.invalidate(cache_key)
+            return None
+        if (row["message_count"] == cached_count and row["chat_name"] == cached["chat_name"]
+                and row["summary_seq"] == cached["summary_seq"]):
+            return cached
+
+        async with db.execute(
+            "SELECT role, content, kind FROM messages WHERE chat_id = ? AND seq >= ? ORDER BY seq",
+            (chat_id, cached_count)
+        ) as cursor:
+            tail = [
+                {"role": m["role"], "content": m["content"], "kind": m["kind"]}
+                async for m in cursor
+            ]
+
+    refreshed = {
+        "chat_name": row["chat_name"],
+        "messages": cached["messages"] + tail,
+        "summary": row["summary"],
+        "summary_seq": row["summary_seq"],
+    }
+    chat_cache.set(cache_key, refreshed)
+    return refreshed
 
 # --- Функции работы с БД ---
 async def _get_chat_from_db(chat_id: str, user_id: str) -> Dict[str, Any] | None:
-    db = get_db()
-    # *** ИЗМЕНЕНИЕ: Добавлена проверка user_id при поиске чата ***
-    async with db.execute(
-        "SELECT user_id, chat_name, messages FROM chats WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
-    ) as cursor:
-        row = await cursor.fetchone()
-
-    if row:
-        messages = json.loads(row["messages"]) if row["messages"] else []
+    cache_key = (user_id, chat_id)
+    cached = chat_cache.get(cache_key)
+    if cached is not None:
+        cached = await _revalidate_cached_chat(cache_key, cached)
+    if cached is not None:
+        # Копия списка: вызывающий код дописывает в него сообщения текущего хода
         return {
             "chat_id": chat_id,
-            "user_id": row["user_id"],
-            "chat_name": row["chat_name"],
-            "messages": messages,
+            "user_id": user_id,
+            "chat_name": cached["chat_name"],
+            "messages": list(cached["messages"]),
+            "summary": cached["summary"],
+            "summary_seq": cached["summary_seq"],
         }
-    return None
 
+    async with read_db() as db:
+        # *** ИЗМЕНЕНИЕ: Добавлена проверка user_id при поиске чата ***
+        async with db.execute(
+            "SELECT user_id, chat_name, summary, summary_seq FROM chats WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if not row:
+            return None
+
+        async with db.execute(
+            "SELECT role, content, kind FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+        ) as cursor:
+            messages = [
+                {"role": m["role"], "content": m["content"], "kind": m["kind"]}
+                async for m in cursor
+            ]
+
+    chat_cache.set((user_id, chat_id), {
+        "chat_name": row["chat_name"],
+        "messages": messages,
+        "summary": row["summary"],
+        "summary_seq": row["summary_seq"],
+    })
+    return {
+        "chat_id": chat_id,
+        "user_id": row["user_id"],
+        "chat_name": row["chat_name"],
+        "messages": list(messages),
+        "summary": row["summary"],
+        "summary_seq": row["summary_seq"],
+    }
+
+
+def _message_kind(message: Dict[str, str]) -> str:
+    return message.get("kind") or ("message" if message.get("role") in ("user", "assistant") else "context")
 
-async def _update_chat_in_db(chat_id: str, user_id: str, chat_name: str,
-                             messages: List[Dict[str, str]], is_new_chat: bool = False):
-    db = get_db()
-    messages_json = json.dumps(messages)
+
+async def _append_messages_to_db(chat_id: str, user_id: str, chat_name: str,
+                                 new_messages: List[Dict[str, str]], is_new_chat: bool = False) -> int:
+    """
+    Дописывает только новые сообщения хода (append-only), не трогая историю.
+    seq вычисляется внутри INSERT, поэтому параллельные ответы в один чат не конфликтуют.
+    Возвращает итоговое число сообщений чата.
+    """
     updated_at = datetime.now().isoformat()
 
-    if is_new_chat:
-        await db.execute("""
-            INSERT INTO chats (user_id, chat_id, chat_name, messages, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, chat_id, chat_name, messages_json, updated_at))
-    else:
-        # *** ИЗМЕНЕНИЕ: Добавлена проверка user_id при обновлении ***
-        await db.execute("""
-            UPDATE chats SET chat_name = ?, messages = ?, updated_at = ?
-            WHERE chat_id = ? AND user_id = ?
-        """, (chat_name, messages_json, updated_at, chat_id, user_id))
+    preview = None
+    for msg in reversed(new_messages):
+        if _message_kind(msg) == "message":
+            preview = msg["content"][:PREVIEW_MAX_LENGTH]
+            break
+
+    async def op(db: aiosqlite.Connection):
+        if is_new_chat:
+            await db.execute("""
+                INSERT INTO chats (user_id, chat_id, chat_name, updated_at, preview, message_count)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, chat_id, chat_name, updated_at, preview, len(new_messages)))
+        else:
+            # *** ИЗМЕНЕНИЕ: Добавлена проверка user_id при обновлении ***
+            await db.execute("""
+                UPDATE chats SET chat_name = ?, updated_at = ?,
+                                 preview = COALESCE(?, preview),
+                                 message_count = message_count + ?
+                WHERE chat_id = ? AND user_id = ?
+            """, (chat_name, updated_at, preview, len(new_messages), chat_id, user_id))
+
+        await db.executemany("""
+            INSERT INTO messages (chat_id, seq, role, content, kind, created_at)
+            VALUES (?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE chat_id = ?), ?, ?, ?, ?)
+        """, [
+            (chat_id, chat_id, msg["role"], msg["content"], _message_kind(msg), updated_at)
+            for msg in new_messages
+        ])
+
+        async with db.execute("SELECT message_count FROM chats WHERE chat_id = ?", (chat_id,)) as cursor:
+            row = await cursor.fetchone()
+        return row["message_count"] if row else 0
+
+    return await db_write(op)
+
+# --- Скользящее резюме чата ---
+# Каждые SUMMARY_EVERY_TURNS ходов фоновая задача дописывает в chats.summary
+# содержание сообщений, вышедших из окна последних CONTEXT_KEEP_RECENT_MESSAGES.
+# Планировщик и генерация видят резюме вместо старых реплик, поэтому размер
+# промпта не растёт с длиной чата. Резюме обновляется моделью классификатора.
+SUMMARY_EVERY_TURNS = int(os.environ.get("SUMMARY_EVERY_TURNS", "4"))
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "600"))
+# Сколько символов каждого сообщения передаётся суммаризатору
+SUMMARY_MESSAGE_CHARS = 2000
+
+SUMMARY_PROMPT_TEMPLATE = """
+Ты ведёшь краткое содержание диалога пользователя с бизнес-ассистентом.
+Дополни текущее резюме новыми сообщениями. Сохрани: цели и задачи пользователя,
+факты о его бизнесе (ниша, регион, цифры), принятые решения и договорённости,
+названия прикреплённых файлов и ссылок, открытые вопросы.
+Пиши по-русски, сжато, не более 250 слов, без вступлений и оценок.
+
+Текущее резюме:
+{summary}
+
+Новые сообщения:
+{messages}
+
+Обновлённое резюме:
+"""
+
+summary_stats = {"scheduled": 0, "updates": 0, "failures": 0, "conflicts": 0, "messages_summarized": 0}
+# Чаты, для которых резюме уже строится в этом процессе, и ссылки на задачи
+_summary_inflight: set = set()
+_summary_tasks: set = set()
+
+
+def _maybe_schedule_summary(chat_id: str, user_id: str, message_count: int, summary_seq: int):
+    """Запускает фоновое обновление резюме, если вне окна последних сообщений накопилось достаточно."""
+    target_seq = message_count - CONTEXT_KEEP_RECENT_MESSAGES
+    if SUMMARY_EVERY_TURNS <= 0 or target_seq - summary_seq < 2 * SUMMARY_EVERY_TURNS:
+        return
+    if (user_id, chat_id) in _summary_inflight:
+        return
+    _summary_inflight.add((user_id, chat_id))
+    summary_stats["scheduled"] += 1
+    task = asyncio.create_task(_update_chat_summary(chat_id, user_id, target_seq))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
 
-    await db.commit()
+
+def _summary_line(message: Dict[str, str]) -> str:
+    content = " ".join(message["content"].split())[:SUMMARY_MESSAGE_CHARS]
+    if message["kind"] == "message":
+        return f"{'Пользователь' if message['role'] == 'user' else 'Ассистент'}: {content}"
+    return f"[Контекст: {content[:300]}]"
+
+
+async def _update_chat_summary(chat_id: str, user_id: str, target_seq: int):
+    try:
+        async with read_db() as db:
+            async with db.execute(
+                "SELECT summary, summary_seq FROM chats WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None or row["summary_seq"] >= target_seq:
+                return
+            async with db.execute(
+                "SELECT role, content, kind FROM messages WHERE chat_id = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (chat_id, row["summary_seq"], target_seq)
+            ) as cursor:
+                new_messages = [dict(m) async for m in cursor]
+
+        prompt = SUMMARY_PROMPT_TEMPLATE.format(
+            summary=row["summary"] or "(пока пусто)",
+            messages="\n".join(_summary_line(m) for m in new_messages),
+        )
+        response = await client.chat.completions.create(
+            model=CLASSIFY_MODEL_ID,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+        summary = (response.choices[0].message.content or "").strip()
+        if not summary:
+            raise ValueError("пустой ответ модели")
+
+        # Условие на прежний summary_seq: если другой воркер успел обновить резюме, не затираем
+        async def op(db: aiosqlite.Connection):
+            cursor = await db.execute(
+                "UPDATE chats SET summary = ?, summary_seq = ? WHERE chat_id = ? AND user_id = ? AND summary_seq = ?",
+                (summary, target_seq, chat_id, user_id, row["summary_seq"])
+            )
+            return cursor.rowcount
+
+        if await db_write(op):
+            summary_stats["updates"] += 1
+            summary_stats["messages_summarized"] += len(new_messages)
+            print(f"Резюме чата {chat_id} обновлено: сообщения до {target_seq}, {len(summary)} симв.")
+        else:
+            summary_stats["conflicts"] += 1
+    except Exception as e:
+        summary_stats["failures"] += 1
+        print(f"Ошибка обновления резюме чата {chat_id}: {e}")
+    finally:
+        _summary_inflight.discard((user_id, chat_id))
+
+# --- Кэш планов _analyze_and_plan ---
+# Одинаковый запрос при одинаковой (обрезанной) истории даёт тот же план,
+# поэтому повторы не тратят вызов классификатора.
+PLAN_CACHE_MAX_ENTRIES = int(os.environ.get("PLAN_CACHE_MAX_ENTRIES", "5000"))
+PLAN_CACHE_TTL_SECONDS = float(os.environ.get("PLAN_CACHE_TTL_SECONDS", str(6 * 60 * 60)))
+
+# Поисковый запрос, привязанный к дате ("курс доллара 05.03.2025", "налоги 2025",
+# "новости сегодня"), устаревает, как только меняется {date} в промпте
+DATE_IN_QUERY_RE = re.compile(
+    r"\d{1,2}[./-]\d{1,2}([./-]\d{2,4})?|\b(19|20)\d{2}\b|сегодня|завтра|вчера|"
+    r"январ|феврал|\bмарт|апрел|\bма[йя]\b|июн|июл|август|сентябр|октябр|ноябр|декабр",
+    re.IGNORECASE
+)
+
+plan_cache = LRUCache(
+    ttl=PLAN_CACHE_TTL_SECONDS,
+    max_entries=PLAN_CACHE_MAX_ENTRIES,
+)
+
+def _normalize_query(query: str) -> str:
+    query = " ".join(query.lower().replace("ё", "е").split())
+    return query.strip(" ?!.,;:")
+
+def _plan_cache_key(user_query: str, history_str: str) -> tuple:
+    history_digest = hashlib.sha256(history_str.encode("utf-8")).hexdigest()
+    return (_normalize_query(user_query), history_digest)
+
+def _get_cached_plan(cache_key: tuple, today: str) -> Dict[str, Any] | None:
+    entry = plan_cache.get(cache_key)
+    if entry is None:
+        return None
+    if entry["date_bound"] and entry["date"] != today:
+        plan_cache.invalidate(cache_key)
+        return None
+    return dict(entry["plan"])
+
+def _store_plan(cache_key: tuple, plan: Dict[str, Any], today: str):
+    search_query = plan.get("search_query") or ""
+    plan_cache.set(cache_key, {
+        "plan": dict(plan),
+        "date": today,
+        "date_bound": bool(DATE_IN_QUERY_RE.search(search_query)),
+    })
+
+# --- Локальный fast-path классификатор (см. plan_classifier.py) ---
+# Решения LLM-планировщика можно писать в журнал; обученная на нём модель
+# отвечает сама, когда уверена, и только неоднозначные запросы уходят в LLM.
+# В журнале — тексты запросов пользователей, поэтому он выключен по умолчанию.
+PLAN_LOG_ENABLED = os.environ.get("PLAN_LOG_ENABLED", "false").lower() in ("1", "true", "yes")
+PLAN_LOG_PATH = os.environ.get("PLAN_LOG_PATH", os.path.join(DATA_DIR, "plan_log.jsonl"))
+PLAN_LOG_MAX_BYTES = int(os.environ.get("PLAN_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+PLAN_CLASSIFIER_PATH = os.environ.get("PLAN_CLASSIFIER_PATH", os.path.join(DATA_DIR, "plan_classifier.json"))
+PLAN_CLASSIFIER_THRESHOLD = float(os.environ.get("PLAN_CLASSIFIER_THRESHOLD", "0.9"))
+
+local_classifier: Optional[PlanClassifier] = None
+plan_log = PlanLogWriter(PLAN_LOG_PATH, PLAN_LOG_MAX_BYTES)
+planner_stats = {"cache": 0, "local": 0, "llm": 0}
+
+def _load_plan_classifier():
+    global local_classifier
+    if not os.path.exists(PLAN_CLASSIFIER_PATH):
+        print(f"Локальный классификатор не найден ({PLAN_CLASSIFIER_PATH}), все планы — через LLM.")
+        return
+    try:
+        local_classifier = PlanClassifier.load(PLAN_CLASSIFIER_PATH)
+        print(f"✅ Локальный классификатор загружен: {len(local_classifier.labels)} классов, "
+              f"порог {PLAN_CLASSIFIER_THRESHOLD}.")
+    except Exception as e:
+        print(f"Ошибка загрузки локального классификатора: {e}")
+
+def _local_plan(user_query: str) -> Dict[str, Any] | None:
+    """План от локальной модели или None, если она не уверена / нужен поисковый запрос."""
+    if local_classifier is None:
+        return None
+    label, confidence = local_classifier.predict(user_query)
+    if confidence < PLAN_CLASSIFIER_THRESHOLD:
+        return None
+    plan = label_to_plan(label)
+    if plan is not None:
+        print(f"План от локального классификатора ({label}, {confidence:.2f}): {plan}")
+    return plan
+
+def _log_plan_decision(user_query: str, plan: Dict[str, Any]):
+    # Только ставит запись в очередь: файл пишет фоновая задача plan_log
+    plan_log.log(user_query, plan, datetime.now().isoformat())
 
 # --- Логика фильтрации и стриминга ---
 # ... (Функции _analyze_and_plan, _fetch_google_doc_content, _fetch_and_parse, _search_duckduckgo, _stream_canned_response - без изменений) ...
-async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]]) -> Dict[str, Any]:
+async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]],
+                            summary: str | None = None) -> Dict[str, Any]:
     """
     Использует Cerebras Llama для ОДНОВРЕМЕННОЙ
     1. Фильтрации (is_business)
@@ -412,10 +1075,30 @@ async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]]) -> D
     3. Решения о поиске (needs_search)
     4. Генерации поискового запроса (search_query)
     5. Выбора кол-ва результатов (num_results)
+    summary — скользящее резюме более ранней части чата (если есть).
     """
     history_str = "\n".join([f"{m['role']}: {m['content'][:100]}..." for m in history])
+    if summary:
+        history_str = f"Краткое содержание более ранней части разговора: {summary}\n\n{history_str}"
+    today = datetime.now().strftime("%d.%m.%Y")
+
+    cache_key = _plan_cache_key(user_query, history_str)
+    cached_plan = _get_cached_plan(cache_key, today)
+    if cached_plan is not None:
+        planner_stats["cache"] += 1
+        print(f"План взят из кэша: {cached_plan}")
+        return cached_plan
+
+    local_plan = _local_plan(user_query)
+    if local_plan is not None:
+        planner_stats["local"] += 1
+        _store_plan(cache_key, local_plan, today)
+        return local_plan
+
+    planner_stats["llm"] += 1
+
     prompt = ANALYSIS_PLAN_PROMPT_TEMPLATE.format(
-        date=datetime.now().strftime("%d.%m.%Y"),
+        date=today,
         history=history_str,
         query=user_query
     )
@@ -452,13 +1135,16 @@ async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]]) -> D
         num_results = int(data.get("num_results", 0))
 
         if not is_business:
-            return {
+            plan = {
                 "is_business": False,
                 "personality": "default",
                 "needs_search": False,
                 "search_query": None,
                 "num_results": 0
             }
+            _store_plan(cache_key, plan, today)
+            _log_plan_decision(user_query, plan)
+            return plan
         
         if needs_search and not search_query:
             needs_search = False
@@ -468,13 +1154,16 @@ async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]]) -> D
             search_query = None
             num_results = 0
 
-        return {
+        plan = {
             "is_business": is_business,
             "personality": personality if personality in PERSONALITY_PROMPTS else "default",
             "needs_search": needs_search,
             "search_query": search_query,
             "num_results": num_results
         }
+        _store_plan(cache_key, plan, today)
+        _log_plan_decision(user_query, plan)
+        return plan
 
     except Exception as e:
         print(f"Ошибка классификации/планирования (Cerebras): {e}")
@@ -486,6 +1175,19 @@ async def _analyze_and_plan(user_query: str, history: List[Dict[str, str]]) -> D
             "num_results": 0
         }
 
+# --- HTTP-клиент для загрузки страниц и Google Docs ---
+# Одна сессия на процесс (app.state.http), создаётся в startup_event
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get("HTTP_POOL_LIMIT_PER_HOST", "8"))
+HTTP_DNS_CACHE_TTL = int(os.environ.get("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", "30"))
+
+http_pool_stats = HttpPoolStats()
+
+# Сколько байт HTML страницы читать максимум (остальное не скачивается)
+MAX_HTML_BYTES = int(os.environ.get("MAX_HTML_BYTES", str(512 * 1024)))
+html_fetch_stats = {"pages": 0, "bytes_read": 0, "byte_capped": 0}
+
 async def _fetch_google_doc_content(session: aiohttp.ClientSession, url: str) -> str | None:
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36'}
     
@@ -531,7 +1233,11 @@ async def _fetch_google_doc_content(session: aiohttp.ClientSession, url: str) ->
         print(f"Ошибка при загрузке Google Doc {url}: {e}")
         return f"[Ошибка при загрузке URL {url}: {str(e)}]"
 
-async def _fetch_and_parse(session: aiohttp.ClientSession, url: str) -> str:
+async def _fetch_and_parse(session: aiohttp.ClientSession, url: str) -> Dict[str, Any]:
+    """
+    {"ok": True, "text": ...} — текст страницы;
+    {"ok": False, "error": ...} — страницу получить не удалось.
+    """
     MAX_TEXT_LENGTH = 10000 
     
     try:
@@ -539,36 +1245,112 @@ async def _fetch_and_parse(session: aiohttp.ClientSession, url: str) -> str:
         
         async with session.get(url, timeout=5, headers=headers) as response:
             if response.status != 200:
-                return f"Не удалось загрузить (статус: {response.status})"
+                return {"ok": False, "error": f"Не удалось загрузить (статус: {response.status})"}
             
             if 'text/html' not in response.headers.get('Content-Type', ''):
-                 return "Контент не является HTML-страницей."
+                 return {"ok": False, "error": "Контент не является HTML-страницей."}
                  
-            html = await response.text()
-            
-            # --- ИЗМЕНЕНИЕ: BeautifulSoup - блокирующая операция. Выполняем в to_thread ---
-            def parse_html(html_content):
-                soup = BeautifulSoup(html_content, 'html.parser')
-                for script_or_style in soup(["script", "style"]):
-                    script_or_style.decompose()
-                text = soup.get_text()
-                lines = (line.strip() for line in text.splitlines())
-                chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-                return '\n'.join(chunk for chunk in chunks if chunk)
-
-            text = await asyncio.to_thread(parse_html, html)
-            # --- Конец изменения ---
+            # Тело читается кусками и разбирается на лету: чтение прекращается,
+            # как только набран MAX_TEXT_LENGTH символов текста или MAX_HTML_BYTES байт
+            text, received = await extract_text_from_response(response, MAX_TEXT_LENGTH, MAX_HTML_BYTES)
+            html_fetch_stats["pages"] += 1
+            html_fetch_stats["bytes_read"] += received
+            if received >= MAX_HTML_BYTES:
+                html_fetch_stats["byte_capped"] += 1
             
             if not text:
-                return "Не удалось извлечь текст из HTML."
+                return {"ok": False, "error": "Не удалось извлечь текст из HTML."}
             
-            return text[:MAX_TEXT_LENGTH] + "..." if len(text) > MAX_TEXT_LENGTH else text
+            return {"ok": True, "text": text}
 
     except asyncio.TimeoutError:
-        return "Не удалось загрузить (тайм-аут)."
+        return {"ok": False, "error": "Не удалось загрузить (тайм-аут)."}
     except Exception as e:
         print(f"Ошибка при загрузке {url}: {e}")
-        return f"Ошибка при загрузке контента: {str(e)}"
+        return {"ok": False, "error": f"Ошибка при загрузке контента: {str(e)}"}
+
+# --- Кэш поиска и текста страниц ---
+# Память воркера + общий для всех воркеров файл SQLite. Свежие записи отдаются
+# как есть; устаревшие (в пределах *_STALE_TTL) — сразу, с фоновым обновлением.
+SEARCH_CACHE_DB_PATH = os.environ.get("SEARCH_CACHE_DB_PATH", os.path.join(DATA_DIR, "search_cache.db"))
+SEARCH_RESULTS_TTL = float(os.environ.get("SEARCH_RESULTS_TTL", str(30 * 60)))
+SEARCH_RESULTS_STALE_TTL = float(os.environ.get("SEARCH_RESULTS_STALE_TTL", str(6 * 60 * 60)))
+PAGE_CONTENT_TTL = float(os.environ.get("PAGE_CONTENT_TTL", str(6 * 60 * 60)))
+PAGE_CONTENT_STALE_TTL = float(os.environ.get("PAGE_CONTENT_STALE_TTL", str(24 * 60 * 60)))
+SEARCH_CACHE_MEMORY_BYTES = int(os.environ.get("SEARCH_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+
+def _search_results_size(results: List[Dict[str, str]]) -> int:
+    return sum(len(r.get("href", "")) + len(r.get("body", "")) + len(r.get("title", "")) for r in results)
+
+search_cache_store = DiskCacheStore(SEARCH_CACHE_DB_PATH)
+search_results_cache = TwoLevelCache(
+    "search", search_cache_store,
+    fresh_ttl=SEARCH_RESULTS_TTL,
+    stale_ttl=SEARCH_RESULTS_STALE_TTL,
+    memory_max_bytes=SEARCH_CACHE_MEMORY_BYTES // 4,
+    sizeof=_search_results_size,
+)
+page_content_cache = TwoLevelCache(
+    "page", search_cache_store,
+    fresh_ttl=PAGE_CONTENT_TTL,
+    stale_ttl=PAGE_CONTENT_STALE_TTL,
+    memory_max_bytes=SEARCH_CACHE_MEMORY_BYTES - SEARCH_CACHE_MEMORY_BYTES // 4,
+    sizeof=len,
+)
+
+# --- Поисковые провайдеры ---
+# SEARCH_PROVIDERS — список через запятую: ddgs-html, ddgs-lite, ddgs-auto, fake.
+# Первый — основной; следующий запускается хеджем, если основной не ответил
+# за p95 обычной задержки (до накопления статистики — SEARCH_HEDGE_DELAY_MS).
+SEARCH_PROVIDERS = os.environ.get("SEARCH_PROVIDERS", "ddgs-html,ddgs-lite")
+SEARCH_HEDGE_DELAY_MS = float(os.environ.get("SEARCH_HEDGE_DELAY_MS", "1500"))
+SEARCH_HEDGE_QUANTILE = float(os.environ.get("SEARCH_HEDGE_QUANTILE", "0.95"))
+
+def _build_search_provider() -> HedgedSearch:
+    providers: List[SearchProvider] = []
+    for name in SEARCH_PROVIDERS.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        if name == "fake":
+            providers.append(FakeSearchProvider())
+        elif name.startswith("ddgs-"):
+            providers.append(DDGSProvider(backend=name[len("ddgs-"):]))
+        else:
+            print(f"⚠️ Неизвестный поисковый провайдер '{name}', пропущен.")
+    if not providers:
+        providers.append(DDGSProvider())
+    return HedgedSearch(
+        providers,
+        default_hedge_delay=SEARCH_HEDGE_DELAY_MS / 1000,
+        quantile=SEARCH_HEDGE_QUANTILE,
+    )
+
+search_provider = _build_search_provider()
+
+# Бюджет времени на загрузку страниц поиска (секунды) по числу результатов:
+# "2.5,3,3.5,4,4.5" — для 1, 2, ... 5 результатов; пустое значение — бюджеты по умолчанию
+DEFAULT_SEARCH_FETCH_BUDGETS = [2.5, 3.0, 3.5, 4.0, 4.5]
+SEARCH_FETCH_BUDGETS = [
+    float(v) for v in os.environ.get("SEARCH_FETCH_BUDGETS", "").split(",") if v.strip()
+] or DEFAULT_SEARCH_FETCH_BUDGETS
+search_fetch_stats = {"searches": 0, "sources": 0, "late_sources": 0, "deadline_hits": 0}
+
+def _search_fetch_budget(num_results: int) -> float:
+    # Запрошенное число результатов, зажатое в границы списка бюджетов
+    index = min(max(num_results, 1), len(SEARCH_FETCH_BUDGETS)) - 1
+    return SEARCH_FETCH_BUDGETS[index]
+
+async def _cached_fetch_and_parse(url: str) -> Dict[str, Any]:
+    async def fetch() -> Dict[str, Any]:
+        return await _fetch_and_parse(app.state.http, url)
+
+    # Ошибки загрузки не кэшируем — следующий запрос попробует снова
+    page = await page_content_cache.get_or_fetch(url, fetch, should_cache=lambda page: page["ok"])
+    # Старые записи дискового кэша — просто текст (ошибки туда не попадали)
+    if isinstance(page, str):
+        return {"ok": True, "text": page}
+    return page
 
 async def _search_duckduckgo(query: str, max_results: int) -> str:
     if not 1 <= max_results <= 5:
@@ -577,15 +1359,19 @@ async def _search_duckduckgo(query: str, max_results: int) -> str:
         
     print(f"Выполнение поиска ({max_results} стр.): {query}")
     results_data = []
+
+    async def fetch_results() -> List[Dict[str, str]]:
+        return await search_provider.search(query, max_results)
     
     try:
-        async with aDDGS() as ddgs:
-            results = await ddgs.text(query, max_results=max_results)
-            
-            if not results:
-                return "Результаты Поиска: Не найдено."
-            
-            results_data = results 
+        results_data = await search_results_cache.get_or_fetch(
+            f"{max_results}:{_normalize_query(query)}",
+            fetch_results,
+            should_cache=bool,
+        )
+        
+        if not results_data:
+            return "Результаты Поиска: Не найдено."
             
     except Exception as e:
         print(f"Ошибка поиска DuckDuckGo: {e}")
@@ -593,21 +1379,40 @@ async def _search_duckduckgo(query: str, max_results: int) -> str:
 
     formatted_results = ["Результаты Поиска (используй их для ответа, в конце ответа приведи источники):"]
     
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for r in results_data:
-            tasks.append(_fetch_and_parse(session, r['href']))
+    # Страницы забираются по мере готовности; к дедлайну недогруженные источники
+    # заменяются сниппетом DDG. Ожидание отменяется, но сама загрузка (под shield
+    # в кэше страниц) доходит до конца и пригодится следующему запросу.
+    async def fetch_indexed(i: int, url: str):
+        return i, await _cached_fetch_and_parse(url)
+
+    budget = _search_fetch_budget(max_results)
+    tasks = [asyncio.create_task(fetch_indexed(i, r['href'])) for i, r in enumerate(results_data)]
+    fetched_contents: Dict[int, Dict[str, Any]] = {}
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=budget):
+            i, page = await next_done
+            fetched_contents[i] = page
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    late = len(results_data) - len(fetched_contents)
+    search_fetch_stats["searches"] += 1
+    search_fetch_stats["sources"] += len(results_data)
+    search_fetch_stats["late_sources"] += late
+    if late:
+        search_fetch_stats["deadline_hits"] += 1
+        print(f"Поиск: {late} из {len(results_data)} источников не успели за {budget} с, использованы сниппеты.")
+
+    for i, r in enumerate(results_data):
+        page = fetched_contents.get(i)
+        final_content = page["text"] if page is not None and page["ok"] else r['body']
         
-        fetched_contents = await asyncio.gather(*tasks)
-
-        for i, (r, fetched_text) in enumerate(zip(results_data, fetched_contents)):
-            final_content = fetched_text
-            if "Не удалось" in fetched_text or "Ошибка" in fetched_text or "не является HTML" in fetched_text or "Не удалось извлечь" in fetched_text:
-                 final_content = r['body'] 
-            
-            formatted_results.append(
-                f"Источник {i+1}: [URL: {r['href']}] [ТЕКСТ: {final_content}]"
-            )
+        formatted_results.append(
+            f"Источник {i+1}: [URL: {r['href']}] [ТЕКСТ: {final_content}]"
+        )
     
     return "\n".join(formatted_results)
 
@@ -616,6 +1421,66 @@ async def _stream_canned_response(message: str) -> AsyncGenerator[str, None]:
     await asyncio.sleep(0)
 
 
+# --- Бюджет контекста генерации (см. context_builder.py) ---
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "24000"))
+CONTEXT_KEEP_RECENT_MESSAGES = int(os.environ.get("CONTEXT_KEEP_RECENT_MESSAGES", "6"))
+CONTEXT_COMPACT_CHARS = int(os.environ.get("CONTEXT_COMPACT_CHARS", "300"))
+
+context_stats = {
+    "builds": 0,
+    "trimmed": 0,          # из истории что-то сжато или отброшено
+    "extra_truncated": 0,  # контекст поиска/файлов обрезан по бюджету
+    "dropped_messages": 0,
+    "compacted_messages": 0,
+    "prompt_tokens_total": 0,
+    "max_prompt_tokens": 0,
+}
+
+
+def _build_final_messages(
+    system_prompt: Dict[str, str],
+    current_messages: List[Dict[str, str]],
+    search_context: str | None,
+    chat_summary: Tuple[str, int] | None = None
+) -> List[Dict[str, str]]:
+    # В API уходят только role/content — служебное поле kind остаётся у нас
+    summary, summary_upto = chat_summary or (None, 0)
+    final_messages, report = build_context(
+        system_prompt,
+        current_messages,
+        search_context,
+        max_tokens=CONTEXT_MAX_TOKENS,
+        keep_recent=CONTEXT_KEEP_RECENT_MESSAGES,
+        compact_chars=CONTEXT_COMPACT_CHARS,
+        summary=summary,
+        summary_upto=summary_upto,
+    )
+    context_stats["builds"] += 1
+    if report.dropped or report.compacted:
+        context_stats["trimmed"] += 1
+    if report.extra_truncated:
+        context_stats["extra_truncated"] += 1
+    context_stats["dropped_messages"] += report.dropped
+    context_stats["compacted_messages"] += report.compacted
+    context_stats["prompt_tokens_total"] += report.total_tokens
+    context_stats["max_prompt_tokens"] = max(context_stats["max_prompt_tokens"], report.total_tokens)
+    print(report.summary())
+    return final_messages
+
+
+async def _open_generation_stream(
+    system_prompt: Dict[str, str],
+    current_messages: List[Dict[str, str]],
+    search_context: str | None,
+    chat_summary: Tuple[str, int] | None = None
+):
+    return await client.chat.completions.create(
+        model=GENERATE_MODEL_ID,
+        messages=_build_final_messages(system_prompt, current_messages, search_context, chat_summary), # type: ignore
+        stream=True
+    )
+
+
 async def _stream_cerebras_response(
     system_prompt: Dict[str, str],
     current_messages: List[Dict[str, str]],
@@ -623,23 +1488,25 @@ async def _stream_cerebras_response(
     chat_id: str,
     user_id: str, # *** ИЗМЕНЕНИЕ: user_id (username) передается из токена ***
     chat_name: str,
-    is_new_chat: bool
+    is_new_chat: bool,
+    persisted_count: int = 0,
+    stream_task: Optional[asyncio.Task] = None,
+    chat_summary: Tuple[str, int] | None = None
 ) -> AsyncGenerator[str, None]:
     full_reply_content = []
-    final_messages = [system_prompt]
-    
-    if search_context:
-        final_messages.append({"role": "system", "content": search_context})
-    
-    final_messages.extend(current_messages)
     
     try:
-        # --- ИЗМЕНЕНИЕ: Используем 'await' для асинхронного клиента ---
-        stream = await client.chat.completions.create(
-            model=GENERATE_MODEL_ID,
-            messages=final_messages, # type: ignore
-            stream=True
-        )
+        # Стрим мог быть открыт заранее спекулятивно (см. _start_speculation)
+        stream = None
+        if stream_task is not None:
+            try:
+                stream = await stream_task
+            except Exception as e:
+                print(f"Спекулятивная генерация не удалась, повторяем запрос: {e}")
+
+        if stream is None:
+            # --- ИЗМЕНЕНИЕ: Используем 'await' для асинхронного клиента ---
+            stream = await _open_generation_stream(system_prompt, current_messages, search_context, chat_summary)
         
         # --- ИЗМЕНЕНИЕ: Используем 'async for' для асинхронного стрима ---
         async for chunk in stream:
@@ -656,113 +1523,313 @@ async def _stream_cerebras_response(
         full_message = "".join(full_reply_content)
         
         if full_message:
-            current_messages.append({"role": "assistant", "content": full_message})
+            current_messages.append({"role": "assistant", "content": full_message, "kind": "message"})
             
-            await _update_chat_in_db(
-                chat_id=chat_id,
-                user_id=user_id, # *** ИЗМЕНЕНИЕ: Используем user_id из токена ***
-                chat_name=chat_name,
-                messages=current_messages,
-                is_new_chat=is_new_chat
-            )
-
-
-# --- ИЗМЕНЕНИЕ: Выносим блокирующие (CPU/IO) функции парсинга ---
-# Они будут вызваны в _read_uploaded_file через asyncio.to_thread
-
-def _parse_xlsx(content_bytes: bytes) -> str:
-    """Блокирующая функция парсинга XLSX."""
-    bytes_io = io.BytesIO(content_bytes)
-    xls = pd.ExcelFile(bytes_io, engine='openpyxl')
-    all_sheets = []
-    for sheet_name in xls.sheet_names:
-        df = pd.read_excel(xls, sheet_name=sheet_name)
-        all_sheets.append(f"--- Лист: {sheet_name} ---\n{df.to_csv(index=False)}")
-    return "\n\n".join(all_sheets)
+            # Сохраняем только сообщения этого хода: всё до persisted_count уже в БД
+            cache_key = (user_id, chat_id)
+            try:
+                message_count = await _append_messages_to_db(
+                    chat_id=chat_id,
+                    user_id=user_id, # *** ИЗМЕНЕНИЕ: Используем user_id из токена ***
+                    chat_name=chat_name,
+                    new_messages=current_messages[persisted_count:],
+                    is_new_chat=is_new_chat
+                )
+            except Exception:
+                chat_cache.invalidate(cache_key)
+                raise
+
+            # Если параллельный запрос успел дописать свои сообщения, наше
+            # представление чата неполное — тогда просто сбрасываем кэш
+            summary, summary_seq = chat_summary or (None, 0)
+            if message_count == len(current_messages):
+                chat_cache.set(cache_key, {
+                    "chat_name": chat_name,
+                    "messages": list(current_messages),
+                    "summary": summary,
+                    "summary_seq": summary_seq,
+                })
+            else:
+                chat_cache.invalidate(cache_key)
+
+            _maybe_schedule_summary(chat_id, user_id, message_count, summary_seq)
+
+
+# --- Пул процессов для разбора файлов (см. file_parsers.py) ---
+PARSER_WORKERS = int(os.environ.get("PARSER_WORKERS", "2"))
+PARSER_QUEUE_SIZE = int(os.environ.get("PARSER_QUEUE_SIZE", "8"))
+PARSER_TIMEOUT_SECONDS = float(os.environ.get("PARSER_TIMEOUT_SECONDS", "30"))
+
+parser_pool = ParserPool(
+    max_workers=PARSER_WORKERS,
+    max_queue=PARSER_QUEUE_SIZE,
+    timeout=PARSER_TIMEOUT_SECONDS,
+)
 
-def _parse_docx(content_bytes: bytes) -> str:
-    """Блокирующая функция парсинга DOCX."""
-    bytes_io = io.BytesIO(content_bytes)
-    doc = docx.Document(bytes_io)
-    all_paragraphs = [p.text for p in doc.paragraphs]
-    return "\n".join(all_paragraphs)
 
-def _parse_pdf(content_bytes: bytes) -> str:
-    """Блокирующая функция парсинга PDF."""
-    bytes_io = io.BytesIO(content_bytes)
-    reader = PdfReader(bytes_io)
-    all_pages = [page.extract_text() for page in reader.pages if page.extract_text()]
-    return "\n\n--- Новая страница ---\n\n".join(all_pages)
+# --- Кэш разобранных файлов ---
+# Ключ — SHA-256 содержимого + расширение + версия парсеров, поэтому один и тот же
+# прайс-лист или договор, загруженный в разные чаты (и разными пользователями),
+# разбирается один раз. PARSER_VERSION нужно увеличивать при изменении парсеров.
+PARSER_VERSION = 3
+FILE_CACHE_DB_PATH = os.environ.get("FILE_CACHE_DB_PATH", os.path.join(DATA_DIR, "file_cache.db"))
+FILE_CACHE_MAX_BYTES = int(os.environ.get("FILE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Время последнего обращения к записи обновляется не чаще раза в столько секунд
+FILE_CACHE_TOUCH_INTERVAL_SECONDS = float(os.environ.get("FILE_CACHE_TOUCH_INTERVAL_SECONDS", "300"))
+parsed_file_cache = ContentCache(FILE_CACHE_DB_PATH, FILE_CACHE_MAX_BYTES, FILE_CACHE_TOUCH_INTERVAL_SECONDS)
+
+def _file_cache_key(digest: str, extension: str) -> str:
+    # Бюджеты разбора тоже в ключе: от них зависит, где парсер остановился
+    return f"v{PARSER_VERSION}:{extension}:{FILE_INDEX_MAX_CHARS}:{PDF_MAX_PAGES}:{digest}"
+
+
+# --- Индекс фрагментов файлов (см. file_index.py) ---
+# Файл разбирается целиком (в пределах FILE_INDEX_MAX_CHARS) и индексируется
+# по чату; в промпт на каждый вопрос попадают только релевантные фрагменты.
+FILE_INDEX_MAX_CHARS = int(os.environ.get("FILE_INDEX_MAX_CHARS", "400000"))
+FILE_CHUNK_CHARS = int(os.environ.get("FILE_CHUNK_CHARS", "1200"))
+FILE_CHUNK_OVERLAP_CHARS = int(os.environ.get("FILE_CHUNK_OVERLAP_CHARS", "200"))
+FILE_CONTEXT_BUDGET_TOKENS = int(os.environ.get("FILE_CONTEXT_BUDGET_TOKENS", "2000"))
+FILE_RETRIEVAL_TOP_K = int(os.environ.get("FILE_RETRIEVAL_TOP_K", "8"))
+
+file_index_stats = {
+    "files_indexed": 0,
+    "chunks_indexed": 0,
+    "retrievals": 0,
+    "whole_index": 0,      # все фрагменты чата поместились в бюджет
+    "ranked": 0,           # выбраны по BM25
+    "leading": 0,          # совпадений нет — начало последнего файла
+    "chunks_injected": 0,
+    "tokens_injected": 0,
+}
 
-# --- Конец блокирующих функций парсинга ---
+# Лимит размера загружаемого файла; проверяется по Content-Length и при копировании
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(25 * 1024 * 1024)))
+# Каталог для временных копий загрузок (по умолчанию системный tmp)
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
 
+# Слишком большой запрос отклоняется с 413 ещё до разбора multipart-формы
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=MAX_UPLOAD_BYTES, paths=["/send_message_stream"])
+# Больше страниц PDF не извлекается, даже если бюджет символов не исчерпан
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "100"))
 
-MAX_FILE_CONTEXT_LENGTH = 15000
-async def _read_uploaded_file(file: UploadFile) -> str:
-    filename = file.filename or ""
+async def _read_uploaded_file(upload: SpooledUpload) -> Tuple[str, bool] | None:
+    """
+    Текст загруженного файла (не длиннее FILE_INDEX_MAX_CHARS) и признак обрезки.
+    Временный файл загрузки удаляется.
+    """
+    filename = upload.filename
     
     if '.' not in filename:
         extension = 'txt'
     else:
         extension = filename.rsplit('.', 1)[-1].lower()
 
-    print(f"Парсинг файла: {filename} (тип: {extension})")
-    
-    # file.read() уже асинхронный
-    content_bytes = await file.read()
+    # Загрузка уже лежит во временном файле (receive_upload_form), парсеры читают его с диска
+    try:
+        cache_key = _file_cache_key(upload.sha256, extension)
+        parsed = await parsed_file_cache.get(cache_key)
+        if parsed is not None:
+            print(f"Файл {filename} (тип: {extension}) взят из кэша разобранных файлов.")
+        else:
+            print(f"Парсинг файла: {filename} (тип: {extension}, {upload.size} байт)")
+            parsed = await _parse_file_content(upload.path, filename, extension)
+            if parsed is None:
+                return None
+            await parsed_file_cache.set(cache_key, parsed)
+    finally:
+        upload.remove()
+
+    text_content, truncated = parsed
+    if len(text_content) > FILE_INDEX_MAX_CHARS:
+        text_content, truncated = text_content[:FILE_INDEX_MAX_CHARS], True
+    return text_content, truncated
+
+async def _parse_file_content(path: str, filename: str, extension: str) -> Tuple[str, bool] | None:
+    """
+    Извлекает текст из файла по расширению: (текст, обрезан_ли).
+    None — если файл не удалось разобрать.
+    """
     text_content = None
+    truncated = False
 
     try:
-        # --- ИЗМЕНЕНИЕ: Выполняем блокирующий парсинг в thread pool ---
+        # Тяжёлые форматы разбираются в пуле процессов, чтобы не держать GIL
         if extension == 'xlsx':
-            text_content = await asyncio.to_thread(_parse_xlsx, content_bytes)
+            text_content, truncated = await parser_pool.run(parse_xlsx, path, FILE_INDEX_MAX_CHARS)
+
+        elif extension == 'csv':
+            text_content, truncated = await parser_pool.run(parse_csv, path, FILE_INDEX_MAX_CHARS)
         
         elif extension == 'docx':
-            text_content = await asyncio.to_thread(_parse_docx, content_bytes)
+            text_content = await parser_pool.run(parse_docx, path)
 
         elif extension == 'pdf':
-            text_content = await asyncio.to_thread(_parse_pdf, content_bytes)
+            text_content, truncated = await parser_pool.run(
+                parse_pdf, path, FILE_INDEX_MAX_CHARS, PDF_MAX_PAGES
+            )
+
+        elif extension == 'html':
+            text_content = await parser_pool.run(parse_html, path)
         
-        elif extension in ('txt', 'csv', 'html') or '.' not in filename:
-            # Декодирование - быстрая операция, можно оставить в основном потоке
-            try:
-                text_content = content_bytes.decode('utf-8')
-            except UnicodeDecodeError:
-                text_content = content_bytes.decode('windows-1251')
-            
-            if extension == 'html':
-                # BeautifulSoup может быть медленным, лучше в to_thread
-                def parse_html_text(html_text):
-                    soup = BeautifulSoup(html_text, 'html.parser')
-                    return soup.get_text(separator="\n", strip=True)
-                
-                text_content = await asyncio.to_thread(parse_html_text, text_content)
+        elif extension == 'txt' or '.' not in filename:
+            # Текст читается только в пределах бюджета — это быстро, хватает потока
+            text_content, truncated = await asyncio.to_thread(read_text_prefix, path, FILE_INDEX_MAX_CHARS)
             
         else:
             # Попытка декодировать неизвестные типы как текст
             try:
-                text_content = content_bytes.decode('utf-8')
+                text_content, truncated = await asyncio.to_thread(
+                    read_text_prefix, path, FILE_INDEX_MAX_CHARS, "strict"
+                )
             except UnicodeDecodeError:
-                try:
-                    text_content = content_bytes.decode('windows-1251')
-                except UnicodeDecodeError:
-                    print(f"Файл {filename} имеет неизвестное расширение и не является текстом.")
-                    return None 
+                print(f"Файл {filename} имеет неизвестное расширение и не является текстом.")
+                return None 
 
+    except ParserPoolBusy:
+        raise HTTPException(status_code=503, detail="Сервер занят разбором других файлов, попробуйте позже.")
+    except ParseTimeout:
+        print(f"Парсинг файла {filename} (ext: {extension}) прерван по тайм-ауту ({PARSER_TIMEOUT_SECONDS} с).")
+        return None
     except Exception as e:
         print(f"Ошибка парсинга файла {filename} (ext: {extension}): {e}")
         return None
 
-    if text_content is None:
+    return text_content, truncated
+# --- Конец _read_uploaded_file ---
+
+
+async def _index_uploaded_file(chat_id: str, user_id: str, file_name: str, chunks: List[str]):
+    """Индексирует фрагменты файла (file_index.chunk_text) в чате."""
+    created_at = datetime.now().isoformat()
+
+    async def op(db: aiosqlite.Connection):
+        await file_index.replace_file_chunks(db, chat_id, user_id, file_name, chunks, created_at)
+
+    await db_write(op)
+    file_index_stats["files_indexed"] += 1
+    file_index_stats["chunks_indexed"] += len(chunks)
+
+
+async def _retrieve_file_context(chat_id: str, user_id: str, query: str) -> str | None:
+    """
+    Фрагменты файлов чата для текущего вопроса в пределах FILE_CONTEXT_BUDGET_TOKENS:
+    небольшой индекс целиком, иначе top-k по BM25, а если совпадений нет
+    ("перескажи кратко") — начало последнего загруженного файла.
+    """
+    file_index_stats["retrievals"] += 1
+    async with read_db() as db:
+        size = await file_index.index_size(db, chat_id, user_id)
+        if not size["chunks"]:
+            return None
+
+        candidates = []
+        # Небольшой индекс (в токене обычно не больше 4 символов) проверяем целиком
+        if size["chars"] <= FILE_CONTEXT_BUDGET_TOKENS * 4:
+            candidates = await file_index.leading_chunks(db, chat_id, user_id, size["chunks"])
+            if sum(count_tokens(c["content"]) for c in candidates) <= FILE_CONTEXT_BUDGET_TOKENS:
+                file_index_stats["whole_index"] += 1
+            else:
+                candidates = []
+        if not candidates:
+            match_query = file_index.build_match_query(query)
+            if match_query:
+                candidates = await file_index.search_chunks(
+                    db, chat_id, user_id, match_query, FILE_RETRIEVAL_TOP_K
+                )
+            if candidates:
+                file_index_stats["ranked"] += 1
+            else:
+                file_index_stats["leading"] += 1
+                candidates = await file_index.leading_chunks(db, chat_id, user_id, FILE_RETRIEVAL_TOP_K)
+
+    selected = file_index.select_within_budget(candidates, FILE_CONTEXT_BUDGET_TOKENS, count_tokens)
+    if not selected:
         return None
-        
-    if len(text_content) > MAX_FILE_CONTEXT_LENGTH:
-        text_content = text_content[:MAX_FILE_CONTEXT_LENGTH] + \
-                       f"\n... [СОДЕРЖИМОЕ ФАЙЛА '{filename}' ОБРЕЗАНО] ..."
+    file_index_stats["chunks_injected"] += len(selected)
+    tokens = sum(c["tokens"] for c in selected)
+    file_index_stats["tokens_injected"] += tokens
+    print(f"Контекст файлов: {len(selected)} фрагм. из {size['chunks']} ({tokens} токенов)")
+    return file_index.format_file_context(selected)
+
+
+# --- Спекулятивный конвейер ---
+# В спекулятивном режиме, пока планировщик думает, дешёвая эвристика оценивает,
+# понадобится ли поиск. Если нет — стрим генерации открывается заранее и
+# используется, когда план это подтвердит. Поиск заранее не запускается:
+# планировщик переписывает поисковый запрос, и поиск по сырому тексту
+# почти никогда не совпадал бы с плановым.
+SPECULATIVE_PIPELINE = os.environ.get("SPECULATIVE_PIPELINE", "false").lower() in ("1", "true", "yes")
+
+# Признаки запросов, для которых планировщик обычно требует поиск
+SEARCH_HINT_RE = re.compile(
+    r"курс|сегодня|сейчас|новост|ставк|налог|закон|кодекс|штраф|срок|последн|актуальн|"
+    r"изменени|стоимост|сколько стоит|цен[аыу]|погод|статистик|\b20\d{2}\b",
+    re.IGNORECASE
+)
+
+speculation_stats = {"generation_started": 0, "skipped_search": 0, "committed": 0, "cancelled": 0}
+
+def _build_system_prompt(personality_key: str, user_name: str) -> Dict[str, str]:
+    # --- ИЗМЕНЕНИЕ: Получаем базовый промпт ---
+    base_system_prompt = PERSONALITY_PROMPTS.get(personality_key, DEFAULT_PROMPT)
     
-    return text_content
-# --- Конец _read_uploaded_file ---
+    # --- ИЗМЕНЕНИЕ: Внедряем имя пользователя (логин) в промпт ---
+    # Создаем *копию* словаря, чтобы не изменить оригинал
+    system_prompt = base_system_prompt.copy()
+    # Добавляем инструкцию в начало
+    system_prompt['content'] = (
+        f"Ты общаешься с пользователем по имени '{user_name}'. "
+        f"Если это уместно, ты можешь обращаться к нему по имени (например, 'Здраствуйте {user_name}'). "
+        f"{system_prompt['content']}"
+    )
+    return system_prompt
 
+def _guess_plan(user_query: str) -> tuple | None:
+    """
+    Быстрое предположение (needs_search, personality) без LLM.
+    None — запрос, скорее всего, будет отклонён, спекулировать незачем.
+    """
+    if local_classifier is not None:
+        label, _ = local_classifier.predict(user_query)
+        if label == "reject":
+            return None
+        personality, mode = label.split("|", 1)
+        return mode == "search", personality
+    return bool(SEARCH_HINT_RE.search(user_query)), "default"
+
+def _start_speculation(user_query: str, current_messages: List[Dict[str, str]],
+                       user_name: str, chat_summary: Tuple[str, int] | None = None) -> Dict[str, Any] | None:
+    guess = _guess_plan(user_query)
+    if guess is None:
+        return None
+    needs_search, personality = guess
+    if needs_search:
+        # Запрос для поиска определит планировщик — заранее открывать нечего
+        speculation_stats["skipped_search"] += 1
+        return None
+
+    speculation_stats["generation_started"] += 1
+    messages = current_messages + [{"role": "user", "content": user_query, "kind": "message"}]
+    task = asyncio.create_task(
+        _open_generation_stream(_build_system_prompt(personality, user_name), messages, None, chat_summary)
+    )
+    return {"task": task, "personality": personality}
+
+async def _cancel_speculation(speculation: Dict[str, Any] | None):
+    if speculation is None:
+        return
+    speculation_stats["cancelled"] += 1
+    task = speculation["task"]
+    if not task.done():
+        task.cancel()
+        return
+    # Стрим уже открыт — закрываем соединение, чтобы генерация остановилась
+    if not task.cancelled() and task.exception() is None:
+        try:
+            await task.result().close()
+        except Exception as e:
+            print(f"Ошибка при закрытии спекулятивного стрима: {e}")
 
 # --- Маршруты ---
 
@@ -779,22 +1846,30 @@ async def register_user(user_create: UserCreate):
     """
     Регистрирует нового пользователя.
     """
-    db = get_db()
     existing_user = await get_user_from_db(user_create.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Пользователь с таким именем уже существует")
     
-    # --- ИЗМЕНЕНИЕ: Хеширование - CPU-bound, выполняем в to_thread ---
-    hashed_password = await asyncio.to_thread(
-        get_password_hash, user_create.password
-    )
-    # --- Конец изменения ---
+    # Хеширование — CPU-bound, в отдельном пуле; при переполненной очереди отказ сразу
+    try:
+        hashed_password = await password_pool.hash(user_create.password)
+    except PasswordPoolBusy:
+        raise HTTPException(status_code=503, detail="Сервер перегружен, попробуйте позже.",
+                            headers={"Retry-After": "1"})
     
-    await db.execute(
-        "INSERT INTO users (username, hashed_password) VALUES (?, ?)",
-        (user_create.username, hashed_password)
-    )
-    await db.commit()
+    async def op(db: aiosqlite.Connection):
+        await db.execute(
+            "INSERT INTO users (username, hashed_password) VALUES (?, ?)",
+            (user_create.username, hashed_password)
+        )
+
+    try:
+        await db_write(op)
+    except sqlite3.IntegrityError:
+        # Параллельная регистрация того же имени успела раньше
+        raise HTTPException(status_code=400, detail="Пользователь с таким именем уже существует")
+    # Отрицательная запись (токен несуществующего пользователя) больше не верна
+    user_exists_cache.invalidate(user_create.username)
     
     return {"message": "Пользователь успешно зарегистрирован"}
 
@@ -806,13 +1881,15 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     """
     user = await get_user_from_db(form_data.username)
     
-    # --- ИЗМЕНЕНИЕ: Проверка пароля - CPU-bound, выполняем в to_thread ---
+    # Проверка пароля — CPU-bound, в отдельном пуле. Очередь полна (всплеск входов,
+    # перебор паролей) — 429 сразу, не дожидаясь освобождения потоков
     is_verified = False
     if user:
-        is_verified = await asyncio.to_thread(
-            verify_password, form_data.password, user.hashed_password
-        )
-    # --- Конец изменения ---
+        try:
+            is_verified = await password_pool.verify(user.hashed_password, form_data.password)
+        except PasswordPoolBusy:
+            raise HTTPException(status_code=429, detail="Слишком много попыток входа, попробуйте позже.",
+                                headers={"Retry-After": "1"})
 
     if not user or not is_verified:
         raise HTTPException(
@@ -821,11 +1898,12 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # --- ИЗМЕНЕНИЕ: Создание JWT - быстрая CPU-операция, тоже в to_thread ---
-    access_token = await asyncio.to_thread(
-        create_access_token, data={"sub": user.username}
-    )
-    # --- Конец изменения ---
+    if password_pool.needs_rehash(user.hashed_password):
+        await _rehash_password(user.username, form_data.password)
+
+    # Подпись HS256 — микросекунды, поток для неё не нужен
+    access_token = create_access_token(data={"sub": user.username})
+    user_exists_cache.set(user.username, True)
     
     # *** ИЗМЕНЕНИЕ: Возвращаем имя пользователя вместе с токеном ***
     return {
@@ -834,31 +1912,56 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         "username": user.username
     }
 
+async def _rehash_password(username: str, password: str):
+    """Пересчёт хеша под текущие ARGON2_*; при перегрузке — в другой раз, вход не блокируется."""
+    try:
+        hashed_password = await password_pool.hash(password)
+    except PasswordPoolBusy:
+        return
+
+    async def op(db: aiosqlite.Connection):
+        await db.execute(
+            "UPDATE users SET hashed_password = ? WHERE username = ?", (hashed_password, username)
+        )
+
+    await db_write(op)
+
 # --- *** ЗАЩИЩЕННЫЕ МАРШРУТЫ *** ---
 
 @app.post("/send_message_stream")
 async def send_message_stream(
+    request: Request,
     # *** ИЗМЕНЕНИЕ: user_id УДАЛЕН из Form, добавлен current_user из токена ***
     current_user: dict = Depends(get_current_user),
-    message: str = Form(""),
-    chat_id: str = Form(...),
-    file: Optional[UploadFile] = File(None)
 ):
     """
     Обрабатывает сообщение, выполняет анализ, поиск (если нужно) и стримит ответ.
     Теперь защищено: user_id берется из JWT токена.
+    Форма (message, chat_id, file) читается из тела уже после проверки токена.
     """
     
     # *** ИЗМЕНЕНИЕ: user_id (username) берется из токена ***
     user_id = current_user['username']
+
+    # Поля формы и файл: файл сразу пишется во временный файл, без копии Starlette
+    form, upload = await receive_upload_form(request, MAX_UPLOAD_BYTES, UPLOAD_SPOOL_DIR)
+    message = form.get("message", "")
+    chat_id = form.get("chat_id")
+    if not chat_id:
+        if upload is not None:
+            upload.remove()
+        raise HTTPException(status_code=422, detail="Не указан chat_id.")
     
     # 1. Чтение файла
     file_content: str | None = None
+    file_truncated = False
     file_name: str | None = None
 
-    if file:
-        file_name = file.filename
-        file_content = await _read_uploaded_file(file) 
+    if upload is not None:
+        file_name = upload.filename
+        parsed_file = await _read_uploaded_file(upload)
+        if parsed_file is not None:
+            file_content, file_truncated = parsed_file
     
     if not message and not file_content:
         raise HTTPException(status_code=400, detail="Сообщение или файл должны присутствовать.")
@@ -868,18 +1971,32 @@ async def send_message_stream(
     chat_data = await _get_chat_from_db(chat_id, user_id)
     is_new_chat = chat_data is None
 
+    chat_summary = None
     if is_new_chat:
         current_messages = []
     else:
         chat_name = chat_data["chat_name"]
         current_messages = chat_data["messages"]
+        if chat_data["summary"]:
+            chat_summary = (chat_data["summary"], chat_data["summary_seq"])
+    persisted_count = len(current_messages)
         
     # 3. Обработка прикрепленного файла
+    # В историю пишется только отметка о файле; сам текст индексируется по чату
+    # (после проверки темы, см. шаг 9), а в промпт каждого хода попадают
+    # релевантные вопросу фрагменты
+    file_chunks: List[str] = []
     if file_content and file_name:
         print(f"Обнаружен прикрепленный файл: {file_name}")
+        file_chunks = file_index.chunk_text(file_content, FILE_CHUNK_CHARS, FILE_CHUNK_OVERLAP_CHARS)
+        truncated_note = f", проиндексированы первые {len(file_content)} символов" if file_truncated else ""
         file_context_message = {
             "role": "system",
-            "content": f"Контекст, извлеченный из прикрепленного файла '{file_name}' (используй эту информацию для ответа):\n{file_content}"
+            "content": (
+                f"Пользователь прикрепил файл '{file_name}' ({len(file_chunks)} фрагм.{truncated_note}). "
+                f"Фрагменты файла, относящиеся к вопросу, передаются отдельным контекстом."
+            ),
+            "kind": "file"
         }
         current_messages.append(file_context_message)
 
@@ -899,23 +2016,23 @@ async def send_message_stream(
 
     if urls and not file_content: 
         print(f"Найдено {len(urls)} URL (файл не прикреплен), загрузка...")
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for url in urls:
-                tasks.append(_fetch_google_doc_content(session, url))
-            
-            fetched_contents = await asyncio.gather(*tasks)
-            
-            for i, content in enumerate(fetched_contents):
-                if content: 
-                    has_google_links = True
-                    fetched_link_content.append(f"Контент из {urls[i]}:\n{content}")
+        tasks = []
+        for url in urls:
+            tasks.append(_fetch_google_doc_content(app.state.http, url))
+        
+        fetched_contents = await asyncio.gather(*tasks)
+        
+        for i, content in enumerate(fetched_contents):
+            if content: 
+                has_google_links = True
+                fetched_link_content.append(f"Контент из {urls[i]}:\n{content}")
         
         if has_google_links:
             combined_link_content = "\n\n---\n\n".join(fetched_link_content)
             link_context_message = {
                 "role": "system",
-                "content": f"Контекст, извлеченный из URL-адресов пользователя (используй эту информацию для ответа):\n{combined_link_content}"
+                "content": f"Контекст, извлеченный из URL-адресов пользователя (используй эту информацию для ответа):\n{combined_link_content}",
+                "kind": "link"
             }
             current_messages.append(link_context_message)
             
@@ -926,45 +2043,56 @@ async def send_message_stream(
     if is_new_chat:
         chat_name = visible_user_message_content[:30]
 
+    has_files = any(m.get("kind") == "file" for m in current_messages)
+
     # 7. Анализ, Фильтрация, Решение о поиске
-    analysis = await _analyze_and_plan(visible_user_message_content, current_messages[-5:])
+    # В спекулятивном режиме стрим генерации без поиска открывается параллельно
+    # с планировщиком (только без файла и ссылок — их контекста в стриме не было бы)
+    user_name = current_user['username'] # user_id это и есть username
+    speculation = None
+    if SPECULATIVE_PIPELINE and not file_content and not has_files and not urls:
+        speculation = _start_speculation(visible_user_message_content, current_messages, user_name, chat_summary)
+
+    analysis = await _analyze_and_plan(
+        visible_user_message_content, current_messages[-5:], chat_summary[0] if chat_summary else None
+    )
     
     is_relevant = analysis.get("is_business", False)
     
     # 8. Если фильтр не пройден
     if not is_relevant:
+        await _cancel_speculation(speculation)
         canned_response = "К сожалению, я могу отвечать только на вопросы, связанные с ведением бизнеса, маркетингом, финансами или юриспруденцией."
         return StreamingResponse(
             _stream_canned_response(canned_response),
             media_type="text/event-stream"
         )
 
+    # Файл индексируется только для принятого вопроса: после отказа на фрагменты
+    # не ссылалось бы ни одно сообщение чата
+    if file_chunks:
+        await _index_uploaded_file(chat_id, user_id, file_name, file_chunks)
+
+    # Фрагменты файлов чата под текущий вопрос (в историю не сохраняются)
+    file_context = None
+    if has_files:
+        file_context = await _retrieve_file_context(chat_id, user_id, message or visible_user_message_content)
+
     # 9. Определение "личности"
     final_personality_key = analysis.get("personality", "default")
-    # --- ИЗМЕНЕНИЕ: Получаем базовый промпт ---
-    base_system_prompt = PERSONALITY_PROMPTS.get(final_personality_key, DEFAULT_PROMPT)
-    
-    # --- ИЗМЕНЕНИЕ: Внедряем имя пользователя (логин) в промпт ---
-    # Создаем *копию* словаря, чтобы не изменить оригинал
-    system_prompt = base_system_prompt.copy()
-    user_name = current_user['username'] # user_id это и есть username
-    # Добавляем инструкцию в начало
-    system_prompt['content'] = (
-        f"Ты общаешься с пользователем по имени '{user_name}'. "
-        f"Если это уместно, ты можешь обращаться к нему по имени (например, 'Здраствуйте {user_name}'). "
-        f"{system_prompt['content']}"
-    )
-    # --- Конец изменения ---
-
+    system_prompt = _build_system_prompt(final_personality_key, user_name)
 
     # 10. Выполнение поиска
     search_context = None
-    if (
+    needs_search = (
         not file_content and not has_google_links and
         analysis.get("needs_search") and 
         analysis.get("search_query") and 
         analysis.get("num_results") > 0
-    ):
+    )
+    if needs_search:
+        await _cancel_speculation(speculation)
+        speculation = None
         search_context = await _search_duckduckgo(
             analysis.get("search_query"),
             analysis.get("num_results")
@@ -972,8 +2100,20 @@ async def send_message_stream(
     elif analysis.get("needs_search"):
         print("Поиск отменен, так как предоставлен файл или ссылка Google Doc.")
 
+    # Заранее открытый стрим годится, только если план совпал: без поиска и та же личность
+    stream_task = None
+    if speculation is not None:
+        if speculation["personality"] == final_personality_key:
+            speculation_stats["committed"] += 1
+            stream_task = speculation["task"]
+        else:
+            await _cancel_speculation(speculation)
+
+    if file_context:
+        search_context = f"{file_context}\n\n{search_context}" if search_context else file_context
+
     # 11. Добавляем текущее *видимое* сообщение
-    current_messages.append({"role": "user", "content": visible_user_message_content})
+    current_messages.append({"role": "user", "content": visible_user_message_content, "kind": "message"})
 
     # 12. Возвращаем StreamingResponse
     return StreamingResponse(
@@ -984,44 +2124,60 @@ async def send_message_stream(
             chat_id,
             user_id, # *** ИЗМЕНЕНИЕ: Передаем user_id из токена ***
             chat_name,
-            is_new_chat
+            is_new_chat,
+            persisted_count,
+            stream_task,
+            chat_summary
         ),
         media_type="text/event-stream"
     )
 
 
+# Верхняя граница размера страницы; без limit эндпоинты отдают всё, как раньше
+CHATS_PAGE_MAX_LIMIT = 200
+HISTORY_PAGE_MAX_LIMIT = 200
+
+def _decode_page_cursor(cursor: str, fields: Dict[str, type]) -> Dict[str, Any]:
+    try:
+        return pagination.decode_cursor(cursor, fields)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректный курсор страницы.")
+
+
 @app.get("/get_chats") # *** ИЗМЕНЕНИЕ: Меняем на GET, т.к. user_id в токене ***
-async def get_chats(current_user: dict = Depends(get_current_user)):
+async def get_chats(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Чаты пользователя от новых к старым; с limit — страницами, next_cursor ведёт к следующей."""
     # *** ИЗМЕНЕНИЕ: req (UserIdRequest) больше не нужен ***
     user_id = current_user['username']
     if not user_id:
         raise HTTPException(status_code=400, detail="user_id не может быть пустым.")
 
-    db = get_db()
-    chats_list = []
-    async with db.execute("""
-        SELECT chat_id, chat_name, messages, updated_at
-        FROM chats WHERE user_id = ?
-        ORDER BY updated_at DESC
-    """, (user_id,)) as cursor:
-        async for row in cursor:
-            messages = json.loads(row["messages"]) if row["messages"] else []
-            
-            last_msg_content = None
-            for msg in reversed(messages):
-                if msg.get("role") in ("user", "assistant"):
-                    last_msg_content = msg.get("content")
-                    break
-            
-            last_msg = last_msg_content if last_msg_content else None
-            
-            chats_list.append({
-                "id": row["chat_id"],
-                "name": row["chat_name"],
-                "preview": last_msg,
-                "updatedAt": row["updated_at"]
-            })
-    return {"chats": chats_list}
+    after = None
+    if cursor:
+        position = _decode_page_cursor(cursor, pagination.CHATS_CURSOR_FIELDS)
+        after = (position["u"], position["c"])
+    if limit is not None:
+        limit = max(1, min(limit, CHATS_PAGE_MAX_LIMIT))
+
+    # Один проход по индексу (user_id, updated_at DESC, chat_id DESC) от курсора,
+    # тела сообщений не читаются
+    async with read_db() as db:
+        rows, next_cursor = await pagination.chats_page(db, user_id, limit, after)
+
+    chats_list = [
+        {
+            "id": row["chat_id"],
+            "name": row["chat_name"],
+            "preview": row["preview"] if row["preview"] else None,
+            "updatedAt": row["updated_at"]
+        }
+        for row in rows
+    ]
+    return {"chats": chats_list, "next_cursor": next_cursor}
 
 
 @app.post("/get_chat_history")
@@ -1031,6 +2187,9 @@ async def get_chat_history(
 ):
     # *** ИЗМЕНЕНИЕ: user_id из токена ***
     user_id = current_user['username']
+
+    if req.limit is not None or req.cursor:
+        return await _get_chat_history_page(req, user_id)
     
     # *** ИЗМЕНЕНИЕ: _get_chat_from_db теперь проверяет user_id ***
     chat_data = await _get_chat_from_db(req.chat_id, user_id)
@@ -1040,14 +2199,44 @@ async def get_chat_history(
         raise HTTPException(status_code=404, detail="Чат не найден или не принадлежит пользователю.")
     
     visible_messages = [
-        msg for msg in chat_data["messages"]
-        if msg.get("role") in ("user", "assistant")
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in chat_data["messages"]
+        if msg.get("kind") == "message"
     ]
     
     return {
         "chat_id": chat_data["chat_id"],
         "name": chat_data["chat_name"],
-        "messages": visible_messages
+        "messages": visible_messages,
+        "next_cursor": None
+    }
+
+
+async def _get_chat_history_page(req: ChatHistoryRequest, user_id: str) -> Dict[str, Any]:
+    """
+    Страница истории: последние limit реплик до курсора, в хронологическом порядке.
+    Читается только страница по индексу (chat_id, seq) — полная история
+    не загружается и в кэш горячих чатов не попадает.
+    """
+    before_seq = None
+    if req.cursor:
+        before_seq = _decode_page_cursor(req.cursor, pagination.HISTORY_CURSOR_FIELDS)["s"]
+    page_size = max(1, min(req.limit or HISTORY_PAGE_MAX_LIMIT, HISTORY_PAGE_MAX_LIMIT))
+
+    async with read_db() as db:
+        async with db.execute(
+            "SELECT chat_name FROM chats WHERE chat_id = ? AND user_id = ?", (req.chat_id, user_id)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Чат не найден или не принадлежит пользователю.")
+        rows, next_cursor = await pagination.messages_page(db, req.chat_id, page_size, before_seq)
+
+    return {
+        "chat_id": req.chat_id,
+        "name": row["chat_name"],
+        "messages": [{"role": m["role"], "content": m["content"], "seq": m["seq"]} for m in rows],
+        "next_cursor": next_cursor
     }
 
 @app.post("/delete_chat")
@@ -1061,23 +2250,114 @@ async def delete_chat(
     if not req.chat_id:
         raise HTTPException(status_code=400, detail="chat_id обязателен.")
 
-    db = get_db()
-    
     # *** ИЗМЕНЕНИЕ: Проверяем, что чат принадлежит пользователю ПЕРЕД удалением ***
-    async with db.execute(
-        "SELECT user_id FROM chats WHERE chat_id = ?", (req.chat_id,)
-    ) as cursor:
-        row = await cursor.fetchone()
+    async with read_db() as db:
+        async with db.execute(
+            "SELECT user_id FROM chats WHERE chat_id = ?", (req.chat_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
 
     if not row or row["user_id"] != user_id:
         raise HTTPException(status_code=404, detail="Чат не найден или не принадлежит пользователю.")
     
     # Если проверка пройдена, удаляем
-    await db.execute("DELETE FROM chats WHERE chat_id = ?", (req.chat_id,))
-    await db.commit()
+    async def op(db: aiosqlite.Connection):
+        await db.execute("DELETE FROM messages WHERE chat_id = ?", (req.chat_id,))
+        await db.execute("DELETE FROM chats WHERE chat_id = ? AND user_id = ?", (req.chat_id, user_id))
+
+        await file_index.delete_chat_chunks(db, req.chat_id, user_id)
+
+    await db_write(op)
+    chat_cache.invalidate((user_id, req.chat_id))
     
     return {"status": "ok", "message": "Чат удален"}
 
+# Не больше стольких результатов поиска за запрос
+SEARCH_MESSAGES_MAX_LIMIT = 50
+
+@app.get("/search_messages")
+async def search_messages(
+    q: str,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """Поиск по репликам всех чатов пользователя: сниппеты, лучшие совпадения первыми."""
+    user_id = current_user['username']
+    # Все слова запроса должны встретиться (по префиксу) в одной реплике
+    match_query = file_index.build_match_query(q, operator="AND", stop_words=file_index.STOP_WORDS)
+    if not match_query:
+        raise HTTPException(status_code=400, detail="Поисковый запрос пуст.")
+    limit = max(1, min(limit, SEARCH_MESSAGES_MAX_LIMIT))
+
+    async with read_db() as db:
+        rows = await message_search.search_messages(db, user_id, match_query, limit)
+
+    return {
+        "results": [
+            {
+                "chat_id": row["chat_id"],
+                "chat_name": row["chat_name"],
+                "seq": row["seq"],
+                "role": row["role"],
+                "snippet": row["snippet"],
+                "createdAt": row["created_at"],
+            }
+            for row in rows
+        ]
+    }
+
+# --- Метрики ---
+
+# Метрики раскрывают нагрузку и счётчики аутентификации, поэтому отдаются только
+# по отдельному токену (Authorization: Bearer <METRICS_TOKEN>); без токена эндпоинт выключен
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+async def require_metrics_token(authorization: Optional[str] = Header(None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Could not validate credentials",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/metrics", dependencies=[Depends(require_metrics_token)])
+async def metrics():
+    """Внутренние метрики процесса (JSON): очередь записи, задержки коммита, пул чтения."""
+    return {
+        "db_writer": app.state.db_writer.stats(),
+        "db_read_pool": app.state.db_readers.stats(),
+        "chat_cache": chat_cache.stats(),
+        "plan_cache": plan_cache.stats(),
+        "planner": dict(planner_stats),
+        "plan_log": plan_log.stats(),
+        "speculation": dict(speculation_stats),
+        "search_cache": search_results_cache.stats(),
+        "page_cache": page_content_cache.stats(),
+        "http_pool": pool_stats(app.state.http, http_pool_stats),
+        "html_fetch": dict(html_fetch_stats),
+        "search_fetch": dict(search_fetch_stats),
+        "search_providers": search_provider.stats(),
+        "file_cache": await parsed_file_cache.stats(),
+        "file_index": dict(file_index_stats),
+        "context": dict(context_stats),
+        "summaries": dict(summary_stats),
+        "parser_pool": parser_pool.stats(),
+        "password_pool": password_pool.stats(),
+        "auth": {
+            **auth_stats,
+            "token_cache": token_cache.stats(),
+            "user_cache": user_exists_cache.stats(),
+        },
+    }
+
 # --- Точка входа ---
+# Для продакшена: gunicorn -c gunicorn.conf.py app:app (несколько воркеров, см. README).
+# Здесь WEB_CONCURRENCY > 1 запускает встроенный мультипроцессный режим uvicorn.
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "app:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        workers=workers,
+    )
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Бенчмарк извлечения текста страниц: прежний путь (BeautifulSoup по всей странице,
+затем обрезка) против потокового html_extract (кусками с остановкой по лимиту).
+
+Корпус — каталог с сохранёнными страницами (*.html / *.htm), например:
+    curl -L https://example.com/news -o corpus/news.html
+
+Пример:
+    python bench_html_extract.py corpus --repeat 5
+"""
+
+import argparse
+import codecs
+import difflib
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from html_extract import VisibleTextExtractor, _make_decoder, _truncate
+
+MAX_TEXT_LENGTH = 10000
+
+
+def bs4_extract(raw: bytes, max_chars: int) -> str:
+    """Прежний путь _fetch_and_parse: весь документ -> дерево -> текст -> обрезка."""
+    html = raw.decode("utf-8", errors="replace")
+    soup = BeautifulSoup(html, "html.parser")
+    for script_or_style in soup(["script", "style"]):
+        script_or_style.decompose()
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    return _truncate("\n".join(chunk for chunk in chunks if chunk), max_chars)
+
+
+def streaming_extract(raw: bytes, max_chars: int, max_bytes: int, chunk_size: int):
+    """Тот же цикл, что extract_text_from_response, но по байтам из файла."""
+    extractor = VisibleTextExtractor(max_chars)
+    decoder = _make_decoder(None, raw[:4096]) or codecs.getincrementaldecoder("utf-8")("replace")
+    received = 0
+    for offset in range(0, min(len(raw), max_bytes), chunk_size):
+        chunk = raw[offset:min(offset + chunk_size, max_bytes)]
+        received += len(chunk)
+        extractor.feed(decoder.decode(chunk))
+        if extractor.done:
+            break
+    extractor.feed(decoder.decode(b"", final=True))
+    extractor.close()
+    return _truncate(extractor.get_text(), max_chars), received
+
+
+def measure(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, statistics.median(timings), peak
+
+
+def text_similarity(reference: str, candidate: str) -> float:
+    """
+    Похожесть текстов без учёта пробелов и переводов строк: BeautifulSoup склеивает
+    слова соседних блоков ("ценаотчет"), поэтому сравнение по словам занижено.
+    """
+    a = "".join(reference.split())
+    b = "".join(candidate.split())
+    if not a:
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение BeautifulSoup и потокового извлечения текста")
+    parser.add_argument("corpus", help="Каталог с сохранёнными HTML-страницами")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-chars", type=int, default=MAX_TEXT_LENGTH)
+    parser.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--chunk-size", type=int, default=16384)
+    args = parser.parse_args()
+
+    pages = sorted(p for p in Path(args.corpus).iterdir() if p.suffix.lower() in (".html", ".htm"))
+    if not pages:
+        print(f"В каталоге {args.corpus} нет *.html файлов.")
+        sys.exit(1)
+
+    print(f"{'страница':<32} {'размер КБ':>9} {'bs4 мс':>8} {'поток мс':>9} "
+          f"{'bs4 пик КБ':>10} {'поток пик КБ':>12} {'прочитано КБ':>12} {'сходство':>10}")
+    totals = {"bs4": 0.0, "stream": 0.0, "size": 0, "read": 0}
+    for page in pages:
+        raw = page.read_bytes()
+        reference, bs4_time, bs4_peak = measure(lambda: bs4_extract(raw, args.max_chars), args.repeat)
+        (text, received), stream_time, stream_peak = measure(
+            lambda: streaming_extract(raw, args.max_chars, args.max_bytes, args.chunk_size), args.repeat
+        )
+        totals["bs4"] += bs4_time
+        totals["stream"] += stream_time
+        totals["size"] += len(raw)
+        totals["read"] += received
+        print(f"{page.name[:32]:<32} {len(raw) / 1024:>9.0f} {bs4_time * 1000:>8.1f} {stream_time * 1000:>9.1f} "
+              f"{bs4_peak / 1024:>10.0f} {stream_peak / 1024:>12.0f} {received / 1024:>12.0f} "
+              f"{text_similarity(reference, text):>10.1%}")
+
+    print(f"\nИтого: {len(pages)} стр., {totals['size'] / 1024:.0f} КБ; "
+          f"bs4 {totals['bs4'] * 1000:.1f} мс, поток {totals['stream'] * 1000:.1f} мс "
+          f"(x{totals['bs4'] / totals['stream']:.1f}); прочитано {totals['read'] / totals['size']:.0%} байт")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Бенчмарк Argon2 для подбора ARGON2_* и PASSWORD_HASH_WORKERS: для каждого набора
+параметров — задержка одной проверки пароля и пропускная способность входов
+при параллельной проверке в пуле потоков, в пересчёте на ядро.
+
+Набор параметров — time_cost:memory_cost_kib:parallelism, например:
+    python bench_password_hash.py --settings 3:65536:4,2:19456:1 --duration 5
+"""
+
+import argparse
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from password_hashing import make_password_hasher, verify_password
+
+DEFAULT_SETTINGS = "3:65536:4,2:19456:1,1:47104:1,3:12288:1"
+PASSWORD = "correct horse battery staple"
+
+
+def parse_settings(value: str):
+    settings = []
+    for item in value.split(","):
+        time_cost, memory_cost, parallelism = (int(part) for part in item.strip().split(":"))
+        settings.append((time_cost, memory_cost, parallelism))
+    return settings
+
+
+def measure_latency(hasher, hashed: str, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        assert verify_password(hasher, hashed, PASSWORD)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def measure_throughput(hasher, hashed: str, threads: int, duration: float) -> float:
+    """Проверок в секунду, когда threads потоков проверяют пароли без перерыва."""
+    deadline = time.perf_counter() + duration
+
+    def worker() -> int:
+        done = 0
+        while time.perf_counter() < deadline:
+            verify_password(hasher, hashed, PASSWORD)
+            done += 1
+        return done
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        total = sum(executor.map(lambda _: worker(), range(threads)))
+    return total / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк параметров Argon2")
+    parser.add_argument("--settings", default=DEFAULT_SETTINGS,
+                        help="Наборы time_cost:memory_cost_kib:parallelism через запятую")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1,
+                        help="Потоков проверки (как PASSWORD_HASH_WORKERS)")
+    parser.add_argument("--repeat", type=int, default=10, help="Проверок для замера задержки")
+    parser.add_argument("--duration", type=float, default=3.0, help="Секунд на замер пропускной способности")
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f"Ядер: {cores}, потоков проверки: {args.threads}")
+    print(f"{'time:mem_kib:par':<18} {'p50 мс':>8} {'max мс':>8} {'входов/с':>10} {'входов/с/ядро':>14}")
+    for time_cost, memory_cost, parallelism in parse_settings(args.settings):
+        hasher = make_password_hasher(time_cost, memory_cost, parallelism)
+        hashed = hasher.hash(PASSWORD)
+        timings = measure_latency(hasher, hashed, args.repeat)
+        per_second = measure_throughput(hasher, hashed, args.threads, args.duration)
+        label = f"{time_cost}:{memory_cost}:{parallelism}"
+        print(f"{label:<18} {statistics.median(timings) * 1000:>8.1f} {max(timings) * 1000:>8.1f} "
+              f"{per_second:>10.1f} {per_second / min(cores, args.threads):>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+# --- Кэши ---
+#
+# LRUCache — общий ограниченный кэш: вытеснение по LRU, по суммарному
+# размеру (в приблизительных байтах, max_bytes), по числу записей (max_entries)
+# и по TTL. Кэш живёт в рамках одного
+# процесса (воркера), поэтому данные в нём либо проверяются по БД,
+# либо допускают короткую рассинхронизацию между воркерами.
+#
+# TwoLevelCache — LRUCache поверх дискового SQLite-хранилища (DiskCacheStore).
+# ContentCache — дисковый LRU с ограничением по размеру (ключ — хэш содержимого).
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import aiosqlite
+
+
+class LRUCache:
+    def __init__(
+        self,
+        ttl: float,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = lambda value: 1,
+        max_entries: Optional[int] = None,
+    ):
+        """
+        Нужен хотя бы один предел: max_bytes (размер по sizeof) или max_entries.
+        Без max_bytes sizeof не вызывается и размер записей не учитывается.
+        """
+        if max_bytes is None and max_entries is None:
+            raise ValueError("LRUCache: нужен max_bytes или max_entries")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.max_entries = max_entries
+        # key -> (value, size, expires_at)
+        self._data: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, _, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if key in self._data:
+            self._remove(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Значение крупнее всего кэша — не кэшируем
+            return
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, size, expires_at)
+        self._bytes += size
+        self._evict()
+
+    def invalidate(self, key: Hashable):
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        while self._data and (
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+            or (self.max_entries is not None and len(self._data) > self.max_entries)
+        ):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# --- Двухуровневый кэш: память (LRU) + диск (SQLite) ---
+#
+# Используется для результатов поиска и извлечённого текста страниц.
+# Запись свежая в течение fresh_ttl; ещё stale_ttl после этого она отдаётся
+# сразу, а в фоне запускается обновление (stale-while-revalidate).
+# Дисковый уровень — отдельный файл SQLite, общий для всех воркеров.
+
+class DiskCacheStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[aiosqlite.Connection] = None
+
+    async def open(self):
+        self._conn = await aiosqlite.connect(self.path)
+        await self._conn.execute("PRAGMA journal_mode = WAL")
+        await self._conn.execute("PRAGMA synchronous = NORMAL")
+        await self._conn.execute("PRAGMA busy_timeout = 5000")
+        await self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        await self._conn.commit()
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def get(self, namespace: str, key: str) -> Optional[Tuple[Any, float]]:
+        if self._conn is None:
+            return None
+        async with self._conn.execute(
+            "SELECT value, fetched_at FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    async def set(self, namespace: str, key: str, value: Any, fetched_at: float):
+        if self._conn is None:
+            return
+        await self._conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, fetched_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), fetched_at)
+        )
+        await self._conn.commit()
+
+    async def purge(self, namespace: str, max_age: float) -> int:
+        """Удаляет записи старше max_age секунд."""
+        if self._conn is None:
+            return 0
+        cursor = await self._conn.execute(
+            "DELETE FROM cache_entries WHERE namespace = ? AND fetched_at < ?",
+            (namespace, time.time() - max_age)
+        )
+        await self._conn.commit()
+        return cursor.rowcount
+
+
+class TwoLevelCache:
+    def __init__(self, namespace: str, store: DiskCacheStore, fresh_ttl: float, stale_ttl: float,
+                 memory_max_bytes: int, sizeof: Callable[[Any], int] = lambda value: 1):
+        self.namespace = namespace
+        self.store = store
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.memory = LRUCache(
+            max_bytes=memory_max_bytes,
+            ttl=fresh_ttl + stale_ttl,
+            sizeof=lambda entry: sizeof(entry[0]),
+        )
+        # Одновременные промахи по одному ключу ждут один и тот же запрос
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.disk_hits = 0
+        self.stale_served = 0
+        self.refreshes = 0
+        self.fetches = 0
+
+    async def get_or_fetch(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                           should_cache: Callable[[Any], bool] = lambda value: True) -> Any:
+        entry = self.memory.get(key)
+        if entry is None:
+            stored = await self.store.get(self.namespace, key)
+            if stored is not None:
+                self.disk_hits += 1
+                entry = stored
+                self.memory.set(key, entry, ttl=max(0.0, entry[1] + self.fresh_ttl + self.stale_ttl - time.time()))
+
+        if entry is not None:
+            value, fetched_at = entry
+            age = time.time() - fetched_at
+            if age < self.fresh_ttl:
+                return value
+            if age < self.fresh_ttl + self.stale_ttl:
+                self.stale_served += 1
+                if key not in self._inflight:
+                    self.refreshes += 1
+                    self._spawn(key, fetch, should_cache, background=True)
+                return value
+
+        task = self._inflight.get(key) or self._spawn(key, fetch, should_cache)
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    def _spawn(self, key: str, fetch: Callable[[], Awaitable[Any]],
+               should_cache: Callable[[Any], bool], background: bool = False) -> asyncio.Task:
+        task = asyncio.create_task(self._fetch_and_store(key, fetch, should_cache))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._on_done(key, t, background))
+        return task
+
+    def _on_done(self, key: str, task: asyncio.Task, background: bool):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled():
+            return
+        error = task.exception()
+        # Ошибки фоновых обновлений никто не ждёт — просто логируем
+        if error is not None and background:
+            print(f"Ошибка фонового обновления кэша {self.namespace} [{key[:80]}]: {error}")
+
+    async def _fetch_and_store(self, key: str, fetch: Callable[[], Awaitable[Any]],
+                               should_cache: Callable[[Any], bool]) -> Any:
+        self.fetches += 1
+        value = await fetch()
+        if should_cache(value):
+            fetched_at = time.time()
+            self.memory.set(key, (value, fetched_at))
+            try:
+                await self.store.set(self.namespace, key, value, fetched_at)
+            except Exception as e:
+                print(f"Ошибка записи дискового кэша {self.namespace}: {e}")
+        return value
+
+    async def purge_expired(self) -> int:
+        return await self.store.purge(self.namespace, self.fresh_ttl + self.stale_ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory": self.memory.stats(),
+            "disk_hits": self.disk_hits,
+            "stale_served": self.stale_served,
+            "background_refreshes": self.refreshes,
+            "fetches": self.fetches,
+            "inflight": len(self._inflight),
+        }
+
+
+# --- Дисковый LRU-кэш по содержимому ---
+#
+# Используется для текста, извлечённого из загруженных файлов (значения — JSON):
+# ключ — хэш содержимого, поэтому кэш общий для всех пользователей и воркеров.
+# Суммарный размер значений ограничен max_bytes, при превышении удаляются
+# записи, которые дольше всех не запрашивались.
+#
+# Суммарный размер и число записей ведут триггеры в однострочной таблице
+# content_totals — без SUM(size) по всей таблице на каждую запись, и счётчик
+# верен для всех воркеров. Время последнего обращения обновляется не чаще
+# раза в touch_interval секунд: порядок вытеснения огрублён до этого окна,
+# зато попадание в кэш обычно обходится без записи в файл.
+
+class ContentCache:
+    def __init__(self, path: str, max_bytes: int, touch_interval: float = 300.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._conn: Optional[aiosqlite.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.touches = 0
+
+    async def open(self):
+        self._conn = await aiosqlite.connect(self.path)
+        await self._conn.execute("PRAGMA journal_mode = WAL")
+        await self._conn.execute("PRAGMA synchronous = NORMAL")
+        await self._conn.execute("PRAGMA busy_timeout = 5000")
+        # Одна транзакция: другой воркер не вставит запись между подсчётом итогов и триггерами
+        await self._conn.execute("BEGIN IMMEDIATE")
+        await self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS content_entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        await self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_content_last_used ON content_entries (last_used)"
+        )
+        await self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS content_totals (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                entries INTEGER NOT NULL,
+                bytes INTEGER NOT NULL
+            )
+        ''')
+        # Файл кэша от прежней версии: итоги считаются один раз
+        await self._conn.execute('''
+            INSERT OR IGNORE INTO content_totals (id, entries, bytes)
+            SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM content_entries
+        ''')
+        await self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_entries_ai AFTER INSERT ON content_entries BEGIN
+                UPDATE content_totals SET entries = entries + 1, bytes = bytes + new.size WHERE id = 1;
+            END
+        ''')
+        await self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_entries_ad AFTER DELETE ON content_entries BEGIN
+                UPDATE content_totals SET entries = entries - 1, bytes = bytes - old.size WHERE id = 1;
+            END
+        ''')
+        await self._conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS content_entries_au AFTER UPDATE OF size ON content_entries BEGIN
+                UPDATE content_totals SET bytes = bytes - old.size + new.size WHERE id = 1;
+            END
+        ''')
+        await self._conn.commit()
+
+    async def close(self):
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def get(self, key: str) -> Any:
+        if self._conn is None:
+            return None
+        async with self._conn.execute(
+            "SELECT value, last_used FROM content_entries WHERE key = ?", (key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        now = time.time()
+        if now - row[1] >= self.touch_interval:
+            await self._conn.execute(
+                "UPDATE content_entries SET last_used = ? WHERE key = ?", (now, key)
+            )
+            await self._conn.commit()
+            self.touches += 1
+        return json.loads(row[0])
+
+    async def set(self, key: str, value: Any):
+        if self._conn is None:
+            return
+        encoded = json.dumps(value, ensure_ascii=False)
+        size = len(encoded.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        # Не REPLACE: его неявное удаление не запускает триггер и итоги разошлись бы
+        await self._conn.execute('''
+            INSERT INTO content_entries (key, value, size, last_used) VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = excluded.value, size = excluded.size, last_used = excluded.last_used
+        ''', (key, encoded, size, time.time()))
+        await self._evict()
+        await self._conn.commit()
+
+    async def _evict(self):
+        _, total = await self._totals()
+        while total > self.max_bytes:
+            async with self._conn.execute(
+                "SELECT key, size FROM content_entries ORDER BY last_used LIMIT 16"
+            ) as cursor:
+                oldest = await cursor.fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if total <= self.max_bytes:
+                    break
+                await self._conn.execute("DELETE FROM content_entries WHERE key = ?", (key,))
+                total -= size
+                self.evictions += 1
+
+    async def _totals(self) -> Tuple[int, int]:
+        async with self._conn.execute("SELECT entries, bytes FROM content_totals WHERE id = 1") as cursor:
+            row = await cursor.fetchone()
+        return (row[0], row[1]) if row is not None else (0, 0)
+
+    async def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        entries = 0
+        total = 0
+        if self._conn is not None:
+            entries, total = await self._totals()
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "touches": self.touches,
+        }
@@ -0,0 +1,222 @@
+# --- Сборка контекста генерации в пределах бюджета токенов ---
+#
+# Раньше в модель уходила вся история чата вместе со всеми когда-либо
+# добавленными файлами и ссылками, и промпт рос без ограничений. Здесь
+# промпт собирается по приоритетам:
+#   1. системный промпт и текущий вопрос — всегда;
+#   2. последние keep_recent сообщений — дословно;
+#   3. скользящее резюме чата — вместо всех сообщений, которые оно покрывает;
+#   4. контекст текущего хода (поиск, фрагменты файлов) — обрезается по остатку;
+#   5. более старые реплики после резюме — от новых к старым, пока есть бюджет;
+#      старый системный контекст (файлы, ссылки) сжимается до короткой отметки
+#      и отбрасывается первым.
+#
+# Токены считаются tiktoken (есть в requirements.txt); без него или без скачанного
+# словаря — эвристикой, о чём пишется в лог при старте.
+
+import math
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # локальная установка без requirements.txt
+    print("tiktoken не установлен, используется оценка токенов")
+    tiktoken = None
+
+# Служебные токены разметки одного сообщения чата
+MESSAGE_OVERHEAD_TOKENS = 4
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+TRUNCATED_MARK = "\n... [КОНТЕКСТ ОБРЕЗАН] ..."
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части разговора:\n"
+
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # словарь не скачан и нет сети
+        print(f"tiktoken недоступен, используется оценка токенов: {e}")
+
+
+def tokenizer_name() -> str:
+    return "tiktoken:o200k_base" if _encoding is not None else "heuristic"
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Оценка с запасом: латиница ~4 символа на токен, кириллица ~3, знак — токен
+    tokens = 0
+    for match in TOKEN_RE.findall(text):
+        if match.isascii():
+            tokens += math.ceil(len(match) / 4)
+        else:
+            tokens += math.ceil(len(match) / 3)
+    return tokens
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст так, чтобы он (вместе с пометкой) занимал не больше max_tokens."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRUNCATED_MARK)
+    if budget <= 0:
+        return ""
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text, disallowed_special=())[:budget]) + TRUNCATED_MARK
+    # Без токенизатора — пропорционально по символам, затем доводка
+    cut = int(len(text) * budget / count_tokens(text))
+    while cut > 0 and count_tokens(text[:cut]) > budget:
+        cut = int(cut * 0.9)
+    return text[:cut] + TRUNCATED_MARK
+
+
+def _compact(message: Dict[str, str], max_chars: int) -> Dict[str, str]:
+    """Короткая отметка вместо старого системного контекста (короткий остаётся как есть)."""
+    content = " ".join(message["content"].split())
+    if len(content) <= max_chars:
+        return message
+    return {
+        "role": message["role"],
+        "content": f"[Ранее в чате был передан контекст, сокращён: {content[:max_chars]}…]",
+    }
+
+
+def _is_dialogue(message: Dict[str, str]) -> bool:
+    return message.get("kind", "message") == "message"
+
+
+@dataclass
+class ContextReport:
+    budget: int
+    system_tokens: int = 0
+    summary_tokens: int = 0
+    extra_tokens: int = 0
+    recent_tokens: int = 0
+    history_tokens: int = 0
+    kept: int = 0
+    compacted: int = 0
+    dropped: int = 0
+    extra_truncated: bool = False
+
+    @property
+    def total_tokens(self) -> int:
+        return (self.system_tokens + self.summary_tokens + self.extra_tokens
+                + self.recent_tokens + self.history_tokens)
+
+    def summary(self) -> str:
+        extra = f"{self.extra_tokens}{' (обрезан)' if self.extra_truncated else ''}"
+        return (
+            f"Контекст генерации: система {self.system_tokens}, резюме {self.summary_tokens}, поиск/файлы {extra}, "
+            f"последние сообщения {self.recent_tokens}, история {self.history_tokens} "
+            f"(сообщений {self.kept}, сжато {self.compacted}, отброшено {self.dropped}); "
+            f"всего {self.total_tokens} из {self.budget} токенов ({tokenizer_name()})"
+        )
+
+
+def build_context(system_prompt: Dict[str, str], messages: List[Dict[str, str]],
+                  extra_context: Optional[str], max_tokens: int, keep_recent: int,
+                  compact_chars: int, summary: Optional[str] = None,
+                  summary_upto: int = 0) -> Tuple[List[Dict[str, str]], ContextReport]:
+    """
+    Собирает список сообщений для API (только role/content) в пределах max_tokens.
+    messages — история чата с полем kind, последний элемент — текущий вопрос;
+    summary — резюме сообщений messages[:summary_upto].
+    """
+    report = ContextReport(budget=max_tokens)
+    report.system_tokens = message_tokens(system_prompt)
+    remaining = max_tokens - report.system_tokens
+    selected: Dict[int, Dict[str, str]] = {}
+
+    def take(index: int, message: Dict[str, str], force: bool = False) -> Optional[int]:
+        nonlocal remaining
+        tokens = message_tokens(message)
+        if tokens > remaining and not force:
+            return None
+        selected[index] = message
+        remaining -= tokens
+        return tokens
+
+    # Последние сообщения — дословно; текущий вопрос берётся в любом случае.
+    # Не поместившийся системный контекст сжимается, на первой не поместившейся
+    # реплике набор останавливается
+    recent_start = max(0, len(messages) - max(1, keep_recent))
+    history_end = recent_start
+    for i in range(len(messages) - 1, recent_start - 1, -1):
+        tokens = take(i, messages[i], force=(i == len(messages) - 1))
+        if tokens is None and not _is_dialogue(messages[i]):
+            compacted = _compact(messages[i], compact_chars)
+            if compacted is not messages[i]:
+                tokens = take(i, compacted)
+                if tokens is not None:
+                    report.compacted += 1
+        if tokens is None:
+            history_end = -1
+            break
+        report.recent_tokens += tokens
+
+    # Сообщения, покрытые резюме, в промпт не попадают (кроме последних)
+    summary_message = None
+    if summary:
+        summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary}
+        if message_tokens(summary_message) <= remaining:
+            report.summary_tokens = message_tokens(summary_message)
+            remaining -= report.summary_tokens
+        else:
+            summary_message = None
+    history_start = summary_upto if summary_message is not None else 0
+
+    extra_message = None
+    if extra_context:
+        available = remaining - MESSAGE_OVERHEAD_TOKENS
+        content = truncate_to_tokens(extra_context, available) if available > 0 else ""
+        report.extra_truncated = content != extra_context
+        if content:
+            extra_message = {"role": "system", "content": content}
+            report.extra_tokens = message_tokens(extra_message)
+            remaining -= report.extra_tokens
+
+    # Старая история: сначала реплики (от новых к старым), пока помещаются...
+    oldest_kept = history_end
+    for i in range(history_end - 1, history_start - 1, -1):
+        if not _is_dialogue(messages[i]):
+            continue
+        tokens = take(i, messages[i])
+        if tokens is None:
+            break
+        report.history_tokens += tokens
+        oldest_kept = i
+    else:
+        # Вся старая переписка поместилась — отрезок истории начинается с начала чата (или резюме)
+        oldest_kept = history_start
+    # ...затем сжатый системный контекст внутри сохранённого отрезка истории
+    for i in range(history_end - 1, oldest_kept - 1, -1):
+        if _is_dialogue(messages[i]):
+            continue
+        compacted = _compact(messages[i], compact_chars)
+        tokens = take(i, compacted)
+        if tokens is not None:
+            report.history_tokens += tokens
+            if compacted is not messages[i]:
+                report.compacted += 1
+
+    report.kept = len(selected)
+    report.dropped = len(messages) - len(selected)
+
+    final_messages = [{"role": system_prompt["role"], "content": system_prompt["content"]}]
+    if summary_message is not None:
+        final_messages.append(summary_message)
+    if extra_message is not None:
+        final_messages.append(extra_message)
+    final_messages.extend(
+        {"role": m["role"], "content": m["content"]} for _, m in sorted(selected.items())
+    )
+    return final_messages, report
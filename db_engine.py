@@ -0,0 +1,231 @@
+# --- Движок SQLite: WAL, пул читающих соединений и group-commit писатель ---
+#
+# Все записи приложения идут через один GroupCommitWriter: он забирает из очереди
+# все накопившиеся операции и выполняет их одной транзакцией (один fsync на пачку).
+# Каждая операция обёрнута в SAVEPOINT, поэтому ошибка одной не откатывает соседей.
+# Чтения (история, список чатов, пользователи) идут через ReadConnectionPool.
+
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+# Общие PRAGMA для всех соединений
+CONNECTION_PRAGMAS = {
+    "busy_timeout": 5000,        # мс ожидания блокировки вместо мгновенного SQLITE_BUSY
+    "temp_store": "MEMORY",
+    "cache_size": -20000,        # ~20 МБ страничного кэша на соединение
+    "mmap_size": 268435456,      # 256 МБ memory-mapped I/O для чтения
+}
+
+# Только для писателя: WAL + synchronous=NORMAL — fsync лишь на чекпоинтах WAL
+WRITER_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "wal_autocheckpoint": 1000,
+}
+
+WAL_SWITCH_RETRIES = 20
+
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+async def _apply_pragmas(conn: aiosqlite.Connection, pragmas: Dict[str, Any]):
+    for name, value in pragmas.items():
+        await conn.execute(f"PRAGMA {name} = {value}")
+
+
+async def open_writer_connection(path: str) -> aiosqlite.Connection:
+    """
+    Соединение писателя в autocommit-режиме (isolation_level=None):
+    транзакциями управляет GroupCommitWriter (BEGIN IMMEDIATE ... COMMIT).
+    """
+    conn = await aiosqlite.connect(path, isolation_level=None)
+    conn.row_factory = aiosqlite.Row
+    await _apply_pragmas(conn, CONNECTION_PRAGMAS)
+
+    # Несколько воркеров могут стартовать одновременно: переключение в WAL
+    # требует монопольного доступа, поэтому при блокировке повторяем попытку
+    for attempt in range(WAL_SWITCH_RETRIES):
+        try:
+            await _apply_pragmas(conn, WRITER_PRAGMAS)
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == WAL_SWITCH_RETRIES - 1:
+                raise
+            await asyncio.sleep(0.1 * (attempt + 1))
+    return conn
+
+
+class ReadConnectionPool:
+    """Фиксированный пул соединений только для чтения (PRAGMA query_only)."""
+
+    def __init__(self, path: str, size: int = 4):
+        self.path = path
+        self.size = max(1, size)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._connections: List[aiosqlite.Connection] = []
+        self._waiting = 0
+        self._acquired_total = 0
+        self._wait_time_total = 0.0
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(self.path)
+            conn.row_factory = aiosqlite.Row
+            await _apply_pragmas(conn, CONNECTION_PRAGMAS)
+            await conn.execute("PRAGMA query_only = ON")
+            self._connections.append(conn)
+            self._queue.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            conn = await self._queue.get()
+        finally:
+            self._waiting -= 1
+        self._acquired_total += 1
+        self._wait_time_total += time.perf_counter() - started
+        try:
+            yield conn
+        finally:
+            self._queue.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "in_use": self.size - self._queue.qsize(),
+            "waiting": self._waiting,
+            "acquired_total": self._acquired_total,
+            "avg_wait_ms": round(self._wait_time_total / self._acquired_total * 1000, 3)
+                           if self._acquired_total else 0.0,
+        }
+
+
+class GroupCommitWriter:
+    """
+    Единственный писатель: очередь операций + фоновая задача,
+    которая коммитит их пачками до max_batch штук.
+    """
+
+    def __init__(self, conn: aiosqlite.Connection, max_batch: int = 64, max_delay: float = 0.0):
+        self.conn = conn
+        self.max_batch = max(1, max_batch)
+        # Необязательная задержка перед коммитом, чтобы собрать пачку побольше
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+        self._commits = 0
+        self._ops = 0
+        self._failed_ops = 0
+        self._max_queue_depth = 0
+        self._last_commit_ms = 0.0
+        self._max_commit_ms = 0.0
+        self._total_commit_ms = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, op: WriteOp) -> Any:
+        """Ставит операцию в очередь и ждёт коммита её пачки. Возвращает результат op."""
+        if self._task is None or self._task.done():
+            raise RuntimeError("GroupCommitWriter не запущен")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            if self.max_delay:
+                await asyncio.sleep(self.max_delay)
+
+            batch: List[Tuple[WriteOp, asyncio.Future]] = [item]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                next_item = self._queue.get_nowait()
+                if next_item is None:
+                    stopping = True
+                    break
+                batch.append(next_item)
+
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: List[Tuple[WriteOp, asyncio.Future]]):
+        outcomes: List[Tuple[asyncio.Future, Any, Optional[BaseException]]] = []
+        try:
+            await self.conn.execute("BEGIN IMMEDIATE")
+            for op, future in batch:
+                await self.conn.execute("SAVEPOINT group_op")
+                try:
+                    result = await op(self.conn)
+                except Exception as e:
+                    await self.conn.execute("ROLLBACK TO group_op")
+                    await self.conn.execute("RELEASE group_op")
+                    outcomes.append((future, None, e))
+                    self._failed_ops += 1
+                else:
+                    await self.conn.execute("RELEASE group_op")
+                    outcomes.append((future, result, None))
+
+            started = time.perf_counter()
+            await self.conn.execute("COMMIT")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+        except Exception as e:
+            print(f"Ошибка group commit ({len(batch)} операций): {e}")
+            try:
+                await self.conn.execute("ROLLBACK")
+            except Exception:
+                pass
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self._commits += 1
+        self._ops += len(batch)
+        self._last_commit_ms = elapsed_ms
+        self._max_commit_ms = max(self._max_commit_ms, elapsed_ms)
+        self._total_commit_ms += elapsed_ms
+
+        for future, result, error in outcomes:
+            if future.done():  # ожидающий запрос уже отменён
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "max_queue_depth": self._max_queue_depth,
+            "commits": self._commits,
+            "ops": self._ops,
+            "failed_ops": self._failed_ops,
+            "avg_batch_size": round(self._ops / self._commits, 2) if self._commits else 0.0,
+            "last_commit_ms": round(self._last_commit_ms, 3),
+            "avg_commit_ms": round(self._total_commit_ms / self._commits, 3) if self._commits else 0.0,
+            "max_commit_ms": round(self._max_commit_ms, 3),
+        }
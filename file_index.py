@@ -0,0 +1,202 @@
+# --- Индекс фрагментов прикреплённых файлов (FTS5 / BM25) ---
+#
+# Вместо первых N символов файла, навсегда записанных в историю чата, текст
+# файла режется на перекрывающиеся фрагменты и кладётся в file_chunks
+# (внешний контент для FTS5-таблицы file_chunks_fts). На каждый вопрос из
+# индекса чата берутся лучшие по BM25 фрагменты в пределах бюджета токенов,
+# так что уточняющие вопросы по тому же документу видят нужные места,
+# а промпт остаётся небольшим.
+
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+import aiosqlite
+
+# Слова без смысловой нагрузки для полнотекстового поиска
+STOP_WORDS = frozenset({
+    "что", "как", "это", "этот", "эта", "эти", "для", "или", "так", "там", "тут",
+    "где", "когда", "какой", "какая", "какие", "какое", "каков", "есть", "был", "была",
+    "было", "были", "его", "она", "они", "оно", "ему", "мне", "меня", "нам", "вам",
+    "наш", "ваш", "при", "про", "над", "под", "без", "все", "всё", "еще", "ещё",
+    "уже", "только", "можно", "нужно", "надо", "ли", "же", "бы", "не", "ни",
+    "в", "во", "на", "с", "со", "к", "ко", "о", "об", "по", "за", "до", "из", "от", "у",
+    "и", "а", "но", "да", "то", "я", "ты", "он", "мы", "вы",
+    "the", "and", "what", "which", "this", "that", "with", "from", "for", "are", "is",
+    "a", "an", "of", "to", "in", "on", "at", "by", "or", "it", "be", "as",
+})
+
+# В вопросе к прикреплённому файлу эти слова тоже ничего не отбирают
+FILE_QUESTION_STOP_WORDS = STOP_WORDS | frozenset({
+    "файл", "файла", "файле", "документ", "документа", "документе",
+    "пожалуйста", "скажи", "расскажи", "напиши",
+})
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Не больше стольких термов в MATCH-запросе
+MAX_QUERY_TERMS = 16
+
+
+def chunk_text(text: str, chunk_chars: int, overlap_chars: int) -> List[str]:
+    """
+    Режет текст на фрагменты до chunk_chars символов по границам строк
+    (строки таблиц и абзацы не разрываются); соседние фрагменты перекрываются
+    последними строками предыдущего на overlap_chars символов.
+    """
+    lines: List[str] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        # Слишком длинная строка (абзац без переносов) режется по пробелам
+        while len(line) > chunk_chars:
+            cut = line.rfind(" ", 0, chunk_chars)
+            if cut <= chunk_chars // 2:
+                cut = chunk_chars
+            lines.append(line[:cut].strip())
+            line = line[cut:].strip()
+        if line:
+            lines.append(line)
+
+    chunks: List[str] = []
+    current: List[str] = []
+    length = 0
+    for line in lines:
+        if current and length + len(line) + 1 > chunk_chars:
+            chunks.append("\n".join(current))
+            # Хвост предыдущего фрагмента — в начало следующего
+            tail: List[str] = []
+            tail_length = 0
+            for previous in reversed(current):
+                if tail_length + len(previous) + 1 > overlap_chars:
+                    break
+                tail.insert(0, previous)
+                tail_length += len(previous) + 1
+            current, length = tail, tail_length
+        current.append(line)
+        length += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def fold_yo(text: str) -> str:
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+
+def _stem(word: str) -> str:
+    # Грубое отсечение окончаний: "договора" / "договором" -> префикс "догово*"
+    if word.isdigit() or len(word) <= 4:
+        return word
+    return word[:max(4, len(word) - 2)]
+
+
+def build_match_query(text: str, operator: str = "OR",
+                      stop_words: frozenset = FILE_QUESTION_STOP_WORDS) -> Optional[str]:
+    """
+    MATCH-запрос FTS5 из текста пользователя: значимые слова как префиксы,
+    объединённые через operator (OR — ранжирование делает BM25, AND — нужны все слова).
+    None — искать нечего.
+    """
+    terms: List[str] = []
+    for word in WORD_RE.findall(fold_yo(text.lower())):
+        if word in stop_words:
+            continue
+        stem = _stem(word)
+        # Кавычки экранируют термин от синтаксиса запросов FTS5. Числа и короткие
+        # слова ("ип", "1с") ищутся целиком: как префикс они совпали бы с чем угодно
+        exact = stem.isdigit() or len(stem) < 3
+        term = f'"{stem}"' if exact else f'"{stem}"*'
+        if term not in terms:
+            terms.append(term)
+        if len(terms) >= MAX_QUERY_TERMS:
+            break
+    return f" {operator} ".join(terms) if terms else None
+
+
+async def replace_file_chunks(db: aiosqlite.Connection, chat_id: str, user_id: str,
+                              file_name: str, chunks: List[str], created_at: str):
+    """Индексирует файл в чате; повторная загрузка файла с тем же именем заменяет прежний."""
+    await db.execute(
+        "DELETE FROM file_chunks WHERE chat_id = ? AND user_id = ? AND file_name = ?",
+        (chat_id, user_id, file_name)
+    )
+    # unicode61 не сводит "ё" к "е", а в запросах она заменяется — текст приводится так же.
+    # Фрагменты, проиндексированные раньше, приводит rebuild_search_index.py
+    await db.executemany("""
+        INSERT INTO file_chunks (chat_id, user_id, file_name, chunk_no, content, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (chat_id, user_id, file_name, chunk_no, fold_yo(content), created_at)
+        for chunk_no, content in enumerate(chunks)
+    ])
+
+
+async def delete_chat_chunks(db: aiosqlite.Connection, chat_id: str, user_id: str):
+    await db.execute("DELETE FROM file_chunks WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+
+async def index_size(db: aiosqlite.Connection, chat_id: str, user_id: str) -> Dict[str, int]:
+    async with db.execute(
+        "SELECT COUNT(*) AS chunks, COALESCE(SUM(length(content)), 0) AS chars "
+        "FROM file_chunks WHERE chat_id = ? AND user_id = ?",
+        (chat_id, user_id)
+    ) as cursor:
+        row = await cursor.fetchone()
+    return {"chunks": row["chunks"], "chars": row["chars"]}
+
+
+async def search_chunks(db: aiosqlite.Connection, chat_id: str, user_id: str,
+                        match_query: str, limit: int) -> List[Dict[str, Any]]:
+    """Лучшие по BM25 фрагменты файлов чата (меньший bm25 — более релевантный)."""
+    async with db.execute("""
+        SELECT c.file_name, c.chunk_no, c.content, bm25(file_chunks_fts) AS score
+        FROM file_chunks_fts
+        JOIN file_chunks c ON c.id = file_chunks_fts.rowid
+        WHERE file_chunks_fts MATCH ? AND c.chat_id = ? AND c.user_id = ?
+        ORDER BY score
+        LIMIT ?
+    """, (match_query, chat_id, user_id, limit)) as cursor:
+        return [dict(row) async for row in cursor]
+
+
+async def leading_chunks(db: aiosqlite.Connection, chat_id: str, user_id: str,
+                         limit: int) -> List[Dict[str, Any]]:
+    """Фрагменты по порядку, начиная с последнего загруженного файла (когда ранжировать не по чему)."""
+    async with db.execute("""
+        SELECT file_name, chunk_no, content FROM file_chunks
+        WHERE chat_id = ? AND user_id = ?
+        ORDER BY created_at DESC, file_name, chunk_no
+        LIMIT ?
+    """, (chat_id, user_id, limit)) as cursor:
+        return [dict(row) async for row in cursor]
+
+
+def select_within_budget(chunks: List[Dict[str, Any]], budget: int,
+                         measure: Callable[[str], int] = len) -> List[Dict[str, Any]]:
+    """
+    Берёт фрагменты по порядку ранжирования, пока они помещаются в бюджет
+    (в единицах measure — символах или токенах); размер пишется в chunk["tokens"].
+    """
+    selected = []
+    used = 0
+    for chunk in chunks:
+        chunk["tokens"] = measure(chunk["content"])
+        if used + chunk["tokens"] > budget:
+            continue
+        selected.append(chunk)
+        used += chunk["tokens"]
+    return selected
+
+
+def format_file_context(chunks: List[Dict[str, Any]]) -> str:
+    # В промпте фрагменты идут в порядке документа, а не релевантности
+    ordered = sorted(chunks, key=lambda c: (c["file_name"], c["chunk_no"]))
+    parts = [
+        f"[Файл '{c['file_name']}', фрагмент {c['chunk_no'] + 1}]\n{c['content']}"
+        for c in ordered
+    ]
+    return (
+        "Фрагменты прикреплённых пользователем файлов, относящиеся к вопросу "
+        "(используй эту информацию для ответа):\n\n" + "\n\n".join(parts)
+    )
@@ -0,0 +1,394 @@
+# --- Парсеры загружаемых файлов и пул процессов для них ---
+#
+# Парсеры получают путь к загруженному файлу на диске (см. uploads.py), а не bytes.
+# Разбор PDF/DOCX/XLSX/HTML — чистый CPU под GIL. В потоках он тормозил все
+# остальные запросы (включая стриминг токенов), поэтому парсеры выполняются
+# в отдельном ProcessPoolExecutor. Модуль намеренно не импортирует app.py:
+# рабочим процессам нужны только функции ниже.
+#
+# ParserPool ограничивает число одновременных разборов (= процессов) и длину
+# очереди ожидания, а зависший разбор убивает по тайм-ауту вместе с пулом.
+# Процессы создаются через forkserver (или spawn): fork из воркера uvicorn, где уже
+# работают потоки aiosqlite и пул Argon2, может унаследовать захваченную блокировку
+# и зависнуть.
+
+import asyncio
+import codecs
+import csv
+import io
+import mmap
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import docx
+import openpyxl
+from bs4 import BeautifulSoup
+from pypdf import PdfReader
+
+
+# --- Таблицы (XLSX/CSV): потоковое чтение строк ---
+# Строки читаются по одной (openpyxl read_only / csv.reader): в контекст попадают
+# заголовок и строки, пока не исчерпан бюджет символов, а по всем строкам листа
+# за тот же проход считается сводка по столбцам — модель видит картину целиком.
+
+# Дальше строки не читаются даже для сводки — разбор большого листа не должен
+# упираться в тайм-аут пула (openpyxl разбирает ~10–20 тыс. строк в секунду)
+TABLE_STATS_MAX_ROWS = 200_000
+
+
+class ColumnStats:
+    __slots__ = ("filled", "numeric", "min", "max", "total")
+
+    def __init__(self):
+        self.filled = 0
+        self.numeric = 0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self.total = 0.0
+
+    def add(self, value: Any):
+        if value is None or value == "":
+            return
+        self.filled += 1
+        number = _as_number(value)
+        if number is None:
+            return
+        self.numeric += 1
+        self.total += number
+        self.min = number if self.min is None else min(self.min, number)
+        self.max = number if self.max is None else max(self.max, number)
+
+    def describe(self, name: str) -> str:
+        line = f"- {name}: заполнено {self.filled}"
+        if self.numeric:
+            line += (f", числовых {self.numeric}; min {self.min:.6g}, max {self.max:.6g}, "
+                     f"среднее {self.total / self.numeric:.6g}")
+        return line
+
+
+def _as_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        # "1 234,5" — типичная запись чисел в русских выгрузках
+        cleaned = value.strip().replace("\xa0", "").replace(" ", "").replace(",", ".")
+        if not cleaned or cleaned[-1] not in "0123456789.":
+            return None
+        try:
+            return float(cleaned)
+        except ValueError:
+            return None
+    return None
+
+
+def _format_table(rows: Iterable[Sequence[Any]], max_chars: int, delimiter: str = ",") -> Tuple[str, bool, int]:
+    """
+    Один проход по строкам таблицы: CSV-текст заголовка и строк в пределах max_chars,
+    затем сводка по столбцам. Возвращает (текст, обрезан_ли, длина_строк).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator="\n")
+    header: Optional[List[str]] = None
+    stats: List[ColumnStats] = []
+    total_rows = shown_rows = 0
+    budget_hit = False
+    stats_partial = False
+
+    for row in rows:
+        values = ["" if v is None else v for v in row]
+        if header is None:
+            if not any(str(v).strip() for v in values):
+                continue
+            header = [str(v) for v in values]
+            writer.writerow(header)
+            continue
+        if not any(str(v).strip() for v in values):
+            continue
+        total_rows += 1
+        while len(stats) < len(values):
+            stats.append(ColumnStats())
+        for column, value in zip(stats, values):
+            column.add(value)
+        if not budget_hit:
+            position = buffer.tell()
+            writer.writerow(values)
+            if buffer.tell() > max_chars:
+                buffer.seek(position)
+                buffer.truncate()
+                budget_hit = True
+            else:
+                shown_rows += 1
+        if total_rows >= TABLE_STATS_MAX_ROWS:
+            stats_partial = True
+            break
+
+    if header is None:
+        return "", False, 0
+
+    table = buffer.getvalue()
+    parts = [table.rstrip("\n")]
+    truncated = shown_rows < total_rows or stats_partial
+    if truncated:
+        parts.append(f"... [показано строк: {shown_rows} из {total_rows}{'+' if stats_partial else ''}]")
+    summary = [f"Сводка по столбцам (строк данных: {total_rows}{'+' if stats_partial else ''}):"]
+    for index, column in enumerate(stats):
+        name = header[index] if index < len(header) and header[index] else f"столбец {index + 1}"
+        summary.append(column.describe(name))
+    parts.append("\n".join(summary))
+    return "\n".join(parts), truncated, len(table)
+
+
+def parse_xlsx(path: str, max_chars: int) -> Tuple[str, bool]:
+    """Блокирующая функция парсинга XLSX (read_only, построчно). Возвращает (текст, обрезан_ли)."""
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        all_sheets = []
+        truncated = False
+        remaining = max_chars
+        for sheet in workbook.worksheets:
+            # Сводка считается по каждому листу, строки — пока остаётся общий бюджет
+            text, sheet_truncated, used = _format_table(sheet.iter_rows(values_only=True), max(remaining, 0))
+            remaining -= used
+            truncated = truncated or sheet_truncated
+            all_sheets.append(f"--- Лист: {sheet.title} ---\n{text}")
+        return "\n\n".join(all_sheets), truncated
+    finally:
+        workbook.close()
+
+
+def _is_utf8(path: str, chunk_size: int = 1 << 20) -> bool:
+    """Проверка кодировки по отображённому в память файлу, кусками — без копии в RAM."""
+    if os.path.getsize(path) == 0:
+        return True
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        try:
+            for offset in range(0, len(view), chunk_size):
+                decoder.decode(view[offset:offset + chunk_size])
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def parse_csv(path: str, max_chars: int) -> Tuple[str, bool]:
+    """Блокирующая функция парсинга CSV (построчно). Возвращает (текст, обрезан_ли)."""
+    encoding = "utf-8-sig" if _is_utf8(path) else "windows-1251"
+    with open(path, encoding=encoding, errors="replace", newline="") as stream:
+        sample = stream.read(8192)
+        try:
+            delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+        except csv.Error:
+            delimiter = ","
+        stream.seek(0)
+        text, truncated, _ = _format_table(csv.reader(stream, delimiter=delimiter), max_chars, delimiter)
+    return text, truncated
+
+
+def read_text_prefix(path: str, max_chars: int, errors: str = "replace") -> Tuple[str, bool]:
+    """
+    Текстовый файл: читается только начало (max_chars символов), а не весь файл.
+    UTF-8, при ошибке декодирования — windows-1251. Возвращает (текст, обрезан_ли).
+    """
+    encoding = "utf-8" if _is_utf8(path) else "windows-1251"
+    with open(path, encoding=encoding, errors=errors) as f:
+        text = f.read(max_chars)
+        truncated = bool(f.read(1))
+    return text, truncated
+
+
+def parse_docx(path: str) -> str:
+    """Блокирующая функция парсинга DOCX."""
+    doc = docx.Document(path)
+    all_paragraphs = [p.text for p in doc.paragraphs]
+    return "\n".join(all_paragraphs)
+
+
+def parse_pdf(path: str, max_chars: int, max_pages: int) -> Tuple[str, bool]:
+    """
+    Блокирующая функция парсинга PDF: страницы извлекаются по одной, пока не набрано
+    max_chars символов или max_pages страниц. Возвращает (текст, обрезан_ли).
+    """
+    # Открытый файл, а не путь: по пути PdfReader сначала читает весь файл в BytesIO,
+    # а с файлом обращается к объектам через seek по мере надобности
+    with open(path, "rb") as f:
+        reader = PdfReader(f)
+        total_pages = len(reader.pages)
+        all_pages = []
+        length = 0
+        read_pages = 0
+        for page in reader.pages:
+            if length >= max_chars or read_pages >= max_pages:
+                break
+            read_pages += 1
+            text = page.extract_text()
+            if text:
+                all_pages.append(text)
+                length += len(text)
+    truncated = read_pages < total_pages or length > max_chars
+    return "\n\n--- Новая страница ---\n\n".join(all_pages), truncated
+
+
+def parse_html(path: str) -> str:
+    """Блокирующая функция извлечения текста из загруженного HTML."""
+    encoding = "utf-8" if _is_utf8(path) else "windows-1251"
+    with open(path, encoding=encoding, errors="replace") as f:
+        soup = BeautifulSoup(f, 'html.parser')
+    return soup.get_text(separator="\n", strip=True)
+
+
+class ParserPoolBusy(Exception):
+    """Очередь на разбор файлов переполнена."""
+
+
+class ParseTimeout(Exception):
+    """Разбор файла не уложился в тайм-аут и был прерван."""
+
+
+def _pool_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _register_worker(pids):
+    # Инициализатор рабочего процесса: сообщает свой PID, чтобы пул мог убить
+    # зависший разбор без доступа к внутренностям ProcessPoolExecutor
+    pids.put(os.getpid())
+
+
+class ParserPool:
+    def __init__(self, max_workers: int = 2, max_queue: int = 8, timeout: float = 30.0):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._context = _pool_context()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._worker_pids = None
+        # Поколение пула: меняется при перезапуске после тайм-аута
+        self._generation = 0
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._waiting = 0
+        self._active = 0
+
+        self.parses = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.restarts = 0
+        self._parse_time_total = 0.0
+        self._max_parse_time = 0.0
+        self._acquired = 0
+        self._wait_time_total = 0.0
+        self._max_wait_time = 0.0
+
+    def start(self):
+        self._worker_pids = self._context.SimpleQueue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=self._context,
+            initializer=_register_worker,
+            initargs=(self._worker_pids,),
+        )
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._worker_pids.close()
+
+    @staticmethod
+    def _kill_workers(pids):
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _restart(self):
+        """Убивает рабочие процессы (в т.ч. зависший) и поднимает новый пул."""
+        executor, pids = self._executor, self._worker_pids
+        self._generation += 1
+        self.restarts += 1
+        self.start()
+        if executor is None:
+            return
+        self._kill_workers(pids)
+        executor.shutdown(wait=False, cancel_futures=True)
+        pids.close()
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        if self._waiting >= self.max_queue and self._slots.locked():
+            self.rejected += 1
+            raise ParserPoolBusy()
+
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        waited = time.perf_counter() - started
+        self._acquired += 1
+        self._wait_time_total += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+
+        self._active += 1
+        try:
+            return await self._run_in_pool(func, args)
+        finally:
+            self._active -= 1
+            self._slots.release()
+
+    async def _run_in_pool(self, func: Callable[..., Any], args: Tuple[Any, ...]) -> Any:
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            generation = self._generation
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, func, *args), timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self._restart()
+                raise ParseTimeout()
+            except BrokenProcessPool:
+                # Пул убит из-за тайм-аута соседнего разбора — повторяем один раз на новом
+                if generation != self._generation and attempt == 0:
+                    continue
+                self.failures += 1
+                self._restart()
+                raise
+            except Exception:
+                self.failures += 1
+                raise
+
+            elapsed = time.perf_counter() - started
+            self.parses += 1
+            self._parse_time_total += elapsed
+            self._max_parse_time = max(self._max_parse_time, elapsed)
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.max_workers,
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_queue": self.max_queue,
+            "parses": self.parses,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "avg_parse_ms": round(self._parse_time_total / self.parses * 1000, 3) if self.parses else 0.0,
+            "max_parse_ms": round(self._max_parse_time * 1000, 3),
+            "avg_queue_wait_ms": round(self._wait_time_total / self._acquired * 1000, 3) if self._acquired else 0.0,
+            "max_queue_wait_ms": round(self._max_wait_time * 1000, 3),
+        }
@@ -0,0 +1,28 @@
+# --- Конфигурация Gunicorn для продакшена ---
+# Запуск: gunicorn -c gunicorn.conf.py app:app
+#
+# Каждый воркер — отдельный процесс uvicorn со своим писателем SQLite,
+# пулом чтения и внутрипроцессными кэшами. Записи разных воркеров
+# сериализует сама SQLite (WAL + busy_timeout), кэш чатов сверяется с БД.
+
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# По умолчанию — по воркеру на ядро
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# preload: приложение импортируется один раз в мастере до fork (быстрее старт,
+# общая память под модули). Соединения с БД всё равно открываются в каждом
+# воркере в startup-хуке, поэтому preload безопасен.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() in ("1", "true", "yes")
+
+# Стриминг ответа LLM может длиться долго — не убиваем воркер раньше времени
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
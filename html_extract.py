@@ -0,0 +1,158 @@
+# --- Потоковое извлечение видимого текста из HTML ---
+#
+# Замена схемы "response.text() -> BeautifulSoup -> get_text() -> обрезка":
+# тело ответа читается кусками, каждый кусок сразу скармливается
+# инкрементальному html.parser, содержимое script/style/nav и т.п. отбрасывается
+# на лету. Чтение прекращается, как только набрано max_chars символов текста
+# или прочитано max_bytes байт — дерево документа не строится вовсе.
+# Разбор — чистый CPU, поэтому идёт в потоке пачками по FEED_BATCH_BYTES,
+# а не на event loop.
+
+import asyncio
+import codecs
+import re
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+import aiohttp
+
+# Теги, содержимое которых не является видимым текстом страницы
+SKIPPED_TAGS = frozenset({
+    "script", "style", "noscript", "template", "svg", "iframe",
+    "nav", "aside", "footer", "form", "select", "button",
+})
+
+# Блочные теги: граница такого тега — граница строки
+BLOCK_TAGS = frozenset({
+    "p", "div", "br", "li", "ul", "ol", "tr", "td", "th", "table",
+    "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "main",
+    "header", "blockquote", "pre", "dd", "dt", "hr", "title",
+})
+
+# Сколько байт тела копить перед очередной передачей парсеру в поток
+FEED_BATCH_BYTES = 64 * 1024
+
+META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([\w:.-]+)""", re.IGNORECASE)
+
+
+class VisibleTextExtractor(HTMLParser):
+    """
+    Инкрементальный сборщик видимого текста. Нормализация та же, что была
+    у прежнего пути: строки обрезаются, фразы делятся по двойному пробелу,
+    пустые отбрасываются, результат склеивается через перевод строки.
+    """
+
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.chunks: List[str] = []
+        self.length = 0
+        self.done = False
+        self._line: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._flush_line()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._flush_line()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            if self._skip_depth:
+                self._skip_depth -= 1
+        elif tag in BLOCK_TAGS:
+            self._flush_line()
+
+    def handle_data(self, data):
+        if self._skip_depth or self.done:
+            return
+        lines = data.split("\n")
+        self._line.append(lines[0])
+        for line in lines[1:]:
+            self._flush_line()
+            self._line.append(line)
+
+    def _flush_line(self):
+        if not self._line:
+            return
+        line = "".join(self._line).strip()
+        self._line = []
+        for phrase in line.split("  "):
+            phrase = phrase.strip()
+            if phrase and not self.done:
+                self.chunks.append(phrase)
+                self.length += len(phrase) + 1
+                if self.length > self.max_chars:
+                    self.done = True
+
+    def get_text(self) -> str:
+        self._flush_line()
+        return "\n".join(self.chunks)
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    return text[:max_chars] + "..." if len(text) > max_chars else text
+
+
+def _make_decoder(charset: Optional[str], head: bytes):
+    candidates = [charset]
+    match = META_CHARSET_RE.search(head)
+    if match:
+        candidates.append(match.group(1).decode("ascii", "ignore"))
+    candidates.append("utf-8")
+    for name in candidates:
+        if not name:
+            continue
+        try:
+            return codecs.getincrementaldecoder(name)(errors="replace")
+        except LookupError:
+            continue
+
+
+def extract_text(html: str, max_chars: int) -> str:
+    """Видимый текст уже загруженного HTML (для бенчмарка и тестов)."""
+    extractor = VisibleTextExtractor(max_chars)
+    extractor.feed(html)
+    extractor.close()
+    return _truncate(extractor.get_text(), max_chars)
+
+
+async def extract_text_from_response(response: aiohttp.ClientResponse, max_chars: int,
+                                     max_bytes: int, chunk_size: int = 16384) -> Tuple[str, int]:
+    """
+    Читает тело ответа кусками и возвращает (текст, прочитано_байт).
+    Останавливается по лимиту текста или байт; недочитанное соединение закрывается.
+    """
+    extractor = VisibleTextExtractor(max_chars)
+    decoder = None
+    received = 0
+    batch: List[bytes] = []
+    batch_bytes = 0
+
+    def feed(data: bytes, final: bool = False):
+        extractor.feed(decoder.decode(data, final=final))
+
+    async for chunk in response.content.iter_chunked(chunk_size):
+        if decoder is None:
+            decoder = _make_decoder(response.charset, chunk[:4096])
+        if received + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - received]
+        received += len(chunk)
+        batch.append(chunk)
+        batch_bytes += len(chunk)
+        if batch_bytes >= FEED_BATCH_BYTES:
+            await asyncio.to_thread(feed, b"".join(batch))
+            batch, batch_bytes = [], 0
+            if extractor.done:
+                break
+        if received >= max_bytes:
+            break
+    if decoder is not None and not extractor.done:
+        await asyncio.to_thread(feed, b"".join(batch), True)
+    extractor.close()
+    return _truncate(extractor.get_text(), max_chars), received
@@ -0,0 +1,109 @@
+# --- Общий HTTP-клиент приложения ---
+#
+# Одна aiohttp.ClientSession на всё время жизни процесса (воркера): соединения
+# и TLS-сессии переиспользуются между запросами, DNS кэшируется в коннекторе.
+# Загрузка страниц поиска и Google Docs/Sheets идёт через неё.
+# Статистика пула собирается через TraceConfig и отдаётся в /metrics.
+
+import time
+from typing import Any, Dict
+
+import aiohttp
+
+
+class HttpPoolStats:
+    """Счётчики использования пула соединений (через сигналы aiohttp TraceConfig)."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.request_errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queue_wait_total = 0.0
+        self.max_queue_wait = 0.0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self._on_request_start)
+        trace.on_request_end.append(self._on_request_end)
+        trace.on_request_exception.append(self._on_request_exception)
+        trace.on_connection_create_end.append(self._on_connection_create_end)
+        trace.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace.on_connection_queued_start.append(self._on_queued_start)
+        trace.on_connection_queued_end.append(self._on_queued_end)
+        trace.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        return trace
+
+    async def _on_request_start(self, session, ctx, params):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    async def _on_request_end(self, session, ctx, params):
+        self.in_flight -= 1
+
+    async def _on_request_exception(self, session, ctx, params):
+        self.in_flight -= 1
+        self.request_errors += 1
+
+    async def _on_connection_create_end(self, session, ctx, params):
+        self.connections_created += 1
+
+    async def _on_connection_reuseconn(self, session, ctx, params):
+        self.connections_reused += 1
+
+    async def _on_queued_start(self, session, ctx, params):
+        # Все соединения пула (общий или per-host лимит) заняты — ждём освобождения
+        self.queued += 1
+        ctx.queued_at = time.perf_counter()
+
+    async def _on_queued_end(self, session, ctx, params):
+        waited = time.perf_counter() - getattr(ctx, "queued_at", time.perf_counter())
+        self.queue_wait_total += waited
+        self.max_queue_wait = max(self.max_queue_wait, waited)
+
+    async def _on_dns_cache_hit(self, session, ctx, params):
+        self.dns_cache_hits += 1
+
+    async def _on_dns_cache_miss(self, session, ctx, params):
+        self.dns_cache_misses += 1
+
+
+def create_http_session(limit: int, limit_per_host: int, dns_ttl: int,
+                        keepalive_timeout: float, stats: HttpPoolStats) -> aiohttp.ClientSession:
+    """Сессия с ограниченным пулом соединений, DNS-кэшем и keep-alive."""
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_ttl,
+        use_dns_cache=True,
+        keepalive_timeout=keepalive_timeout,
+    )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[stats.trace_config()])
+
+
+def pool_stats(session: aiohttp.ClientSession, stats: HttpPoolStats) -> Dict[str, Any]:
+    connector = session.connector
+    connections = stats.connections_created + stats.connections_reused
+    return {
+        "limit": connector.limit if connector else 0,
+        "limit_per_host": connector.limit_per_host if connector else 0,
+        "in_flight": stats.in_flight,
+        "max_in_flight": stats.max_in_flight,
+        "requests": stats.requests,
+        "request_errors": stats.request_errors,
+        "connections_created": stats.connections_created,
+        "connections_reused": stats.connections_reused,
+        "reuse_rate": round(stats.connections_reused / connections, 4) if connections else 0.0,
+        "queued": stats.queued,
+        "avg_queue_wait_ms": round(stats.queue_wait_total / stats.queued * 1000, 3) if stats.queued else 0.0,
+        "max_queue_wait_ms": round(stats.max_queue_wait * 1000, 3),
+        "dns_cache_hits": stats.dns_cache_hits,
+        "dns_cache_misses": stats.dns_cache_misses,
+    }
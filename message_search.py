@@ -0,0 +1,52 @@
+# --- Полнотекстовый поиск по истории чатов пользователя (FTS5) ---
+#
+# messages_fts — индекс с внешним контентом (представление messages_search_source):
+# тексты не дублируются, в индекс попадают только видимые реплики (kind = 'message'),
+# системный контекст файлов и ссылок не индексируется. Колонка owner — токен
+# владельца чата, запрос всегда ограничен ею, поэтому время поиска зависит от
+# объёма истории пользователя, а не всей базы. Ранжирование BM25 по тексту, сниппеты.
+
+from typing import Any, Dict, List
+
+import aiosqlite
+
+# Полная переиндексация: представление уже отбирает только видимые реплики
+REBUILD_STATEMENTS = [
+    "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+]
+
+# Границы совпадения в сниппете — markdown, фронтенд рендерит его через marked
+SNIPPET_START = "**"
+SNIPPET_END = "**"
+SNIPPET_TOKENS = 16
+
+
+async def rebuild_messages_index(db: aiosqlite.Connection) -> int:
+    for statement in REBUILD_STATEMENTS:
+        await db.execute(statement)
+    async with db.execute("SELECT COUNT(*) FROM messages WHERE kind = 'message'") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def search_messages(db: aiosqlite.Connection, user_id: str, match_query: str,
+                          limit: int) -> List[Dict[str, Any]]:
+    """Реплики пользователя, подходящие под MATCH-запрос, лучшие по BM25 первыми."""
+    async with db.execute("SELECT id FROM users WHERE username = ?", (user_id,)) as cursor:
+        user = await cursor.fetchone()
+    if user is None:
+        return []
+
+    # Токен владельца отбирает реплики пользователя в самом индексе; условие
+    # на chats.user_id оставлено как точная проверка принадлежности
+    owner_query = f'owner : "u{user["id"]}" AND content : ({match_query})'
+    async with db.execute("""
+        SELECT m.chat_id, c.chat_name, m.seq, m.role, m.created_at,
+               snippet(messages_fts, 0, ?, ?, '…', ?) AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN chats c ON c.chat_id = m.chat_id
+        WHERE messages_fts MATCH ? AND c.user_id = ?
+        ORDER BY bm25(messages_fts, 1.0, 0.0)
+        LIMIT ?
+    """, (SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, owner_query, user_id, limit)) as cursor:
+        return [dict(row) async for row in cursor]
@@ -0,0 +1,105 @@
+# --- Постраничная выдача списка чатов и истории (keyset-пагинация) ---
+#
+# Вместо OFFSET страница продолжается с позиции последней отданной записи:
+# список чатов — по (updated_at, chat_id), история — по seq. Каждый запрос —
+# один проход по индексу от курсора, стоимость не растёт с номером страницы,
+# а новые сообщения и чаты не сдвигают уже выданные страницы.
+#
+# Курсор непрозрачен для клиента: base64url от JSON с позицией.
+
+import base64
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiosqlite
+
+
+def encode_cursor(position: Dict[str, Any]) -> str:
+    raw = json.dumps(position, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+# Поля курсоров и их типы: значения уходят параметрами в SQL, поэтому проверяются
+CHATS_CURSOR_FIELDS: Dict[str, type] = {"u": str, "c": str}
+HISTORY_CURSOR_FIELDS: Dict[str, type] = {"s": int}
+
+
+def decode_cursor(cursor: str, fields: Dict[str, type]) -> Dict[str, Any]:
+    """
+    Позиция из курсора; ValueError — курсор повреждён, подделан
+    или выдан другим эндпоинтом (нет поля или у поля не тот тип).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        position = json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"некорректный курсор: {e}") from None
+    if not isinstance(position, dict):
+        raise ValueError("некорректный курсор")
+    for key, expected in fields.items():
+        value = position.get(key)
+        # bool в JSON — подкласс int, как номер сообщения не принимается
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise ValueError(f"некорректный курсор: поле {key}")
+        # Больше 64 бит SQLite не примет как параметр
+        if expected is int and not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError(f"некорректный курсор: поле {key}")
+    return position
+
+
+async def chats_page(db: aiosqlite.Connection, user_id: str, limit: Optional[int],
+                     after: Optional[Tuple[str, str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Чаты пользователя от новых к старым, начиная после позиции after
+    (updated_at, chat_id). Возвращает строки и курсор следующей страницы;
+    limit None — все оставшиеся чаты.
+    """
+    # Лишняя строка показывает, есть ли следующая страница (LIMIT -1 — без ограничения)
+    fetch = limit + 1 if limit is not None else -1
+    if after is None:
+        query = """
+            SELECT chat_id, chat_name, preview, updated_at
+            FROM chats WHERE user_id = ?
+            ORDER BY updated_at DESC, chat_id DESC
+            LIMIT ?
+        """
+        params = (user_id, fetch)
+    else:
+        query = """
+            SELECT chat_id, chat_name, preview, updated_at
+            FROM chats WHERE user_id = ? AND (updated_at, chat_id) < (?, ?)
+            ORDER BY updated_at DESC, chat_id DESC
+            LIMIT ?
+        """
+        params = (user_id, after[0], after[1], fetch)
+    async with db.execute(query, params) as cursor:
+        rows = [dict(row) async for row in cursor]
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor({"u": last["updated_at"], "c": last["chat_id"]})
+    return rows, next_cursor
+
+
+async def messages_page(db: aiosqlite.Connection, chat_id: str, limit: int,
+                        before_seq: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Последние limit видимых реплик чата с seq < before_seq (все — если None),
+    в хронологическом порядке; курсор ведёт к более старым.
+    """
+    async with db.execute("""
+        SELECT seq, role, content FROM messages
+        WHERE chat_id = ? AND seq < ? AND kind = 'message'
+        ORDER BY seq DESC
+        LIMIT ?
+    """, (chat_id, before_seq if before_seq is not None else 2 ** 62, limit + 1)) as cursor:
+        rows = [dict(row) async for row in cursor]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({"s": rows[-1]["seq"]})
+    rows.reverse()
+    return rows, next_cursor
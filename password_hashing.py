@@ -0,0 +1,125 @@
+# --- Хеширование паролей Argon2 в отдельном ограниченном пуле потоков ---
+#
+# Argon2 намеренно дорогой (десятки миллисекунд CPU и десятки мегабайт памяти
+# на вызов). В общем пуле asyncio.to_thread всплеск логинов или перебор паролей
+# занимал все потоки, и ждали разбор файлов и прочая работа в потоках.
+# Здесь у хеширования свой пул из нескольких потоков (argon2-cffi отпускает GIL)
+# и ограниченная очередь: сверх неё запрос сразу отклоняется (PasswordPoolBusy).
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+
+class PasswordPoolBusy(Exception):
+    """Очередь на хеширование паролей переполнена."""
+
+
+def make_password_hasher(time_cost: int, memory_cost: int, parallelism: int) -> PasswordHasher:
+    """memory_cost — в КиБ, как в argon2-cffi."""
+    return PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+
+def verify_password(hasher: PasswordHasher, hashed_password: str, plain_password: str) -> bool:
+    # Параметры проверки берутся из самого хеша: старые хеши проверяются при любых настройках
+    try:
+        return hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+class PasswordHashPool:
+    def __init__(self, hasher: PasswordHasher, max_workers: int = 2, max_queue: int = 16):
+        self.hasher = hasher
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots = asyncio.Semaphore(self.max_workers)
+        self._waiting = 0
+        self._active = 0
+
+        self.hashes = 0
+        self.verifies = 0
+        self.rejected = 0
+        self._run_time_total = 0.0
+        self._max_run_time = 0.0
+        self._acquired = 0
+        self._wait_time_total = 0.0
+        self._max_wait_time = 0.0
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="argon2")
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def hash(self, password: str) -> str:
+        result = await self._run(self.hasher.hash, password)
+        self.hashes += 1
+        return result
+
+    async def verify(self, hashed_password: str, plain_password: str) -> bool:
+        result = await self._run(verify_password, self.hasher, hashed_password, plain_password)
+        self.verifies += 1
+        return result
+
+    def needs_rehash(self, hashed_password: str) -> bool:
+        """Хеш создан с другими параметрами (разбор строки, без хеширования)."""
+        try:
+            return self.hasher.check_needs_rehash(hashed_password)
+        except InvalidHashError:
+            return False
+
+    async def _run(self, func: Callable[..., Any], *args: Any) -> Any:
+        # Место в очереди проверяется до ожидания: при перегрузке отказ мгновенный
+        if self._waiting >= self.max_queue and self._slots.locked():
+            self.rejected += 1
+            raise PasswordPoolBusy()
+
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        waited = time.perf_counter() - started
+        self._acquired += 1
+        self._wait_time_total += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+
+        self._active += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._run_time_total += elapsed
+            self._max_run_time = max(self._max_run_time, elapsed)
+            self._active -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self.hashes + self.verifies
+        return {
+            "workers": self.max_workers,
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_queue": self.max_queue,
+            "time_cost": self.hasher.time_cost,
+            "memory_cost_kib": self.hasher.memory_cost,
+            "parallelism": self.hasher.parallelism,
+            "hashes": self.hashes,
+            "verifies": self.verifies,
+            "rejected": self.rejected,
+            "avg_run_ms": round(self._run_time_total / calls * 1000, 3) if calls else 0.0,
+            "max_run_ms": round(self._max_run_time * 1000, 3),
+            "avg_queue_wait_ms": round(self._wait_time_total / self._acquired * 1000, 3) if self._acquired else 0.0,
+            "max_queue_wait_ms": round(self._max_wait_time * 1000, 3),
+        }
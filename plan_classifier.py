@@ -0,0 +1,301 @@
+# --- Локальный классификатор планов (fast-path для _analyze_and_plan) ---
+#
+# TF-IDF по словам и символьным n-граммам + мультиклассовая логистическая
+# регрессия (softmax), без внешних зависимостей. Обучается офлайн на журнале
+# решений LLM-планировщика (train_plan_classifier.py) и хранится в JSON.
+#
+# Класс — это сочетание решений планировщика:
+#   "reject"                 — is_business = false
+#   "<personality>|answer"   — бизнес-вопрос без поиска
+#   "<personality>|search"   — бизнес-вопрос с поиском (нужен поисковый запрос от LLM)
+
+import asyncio
+import json
+import math
+import os
+import random
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+MODEL_FORMAT_VERSION = 1
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+def extract_features(text: str) -> List[str]:
+    """Слова, биграммы слов и символьные 3-граммы внутри слов."""
+    words = WORD_RE.findall(normalize_text(text))
+    features = [f"w:{w}" for w in words]
+    features += [f"b:{a}_{b}" for a, b in zip(words, words[1:])]
+    for w in words:
+        padded = f"<{w}>"
+        features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    return features
+
+
+def plan_to_label(plan: Dict[str, Any]) -> str:
+    if not plan.get("is_business"):
+        return "reject"
+    mode = "search" if plan.get("needs_search") else "answer"
+    return f"{plan.get('personality') or 'default'}|{mode}"
+
+
+def label_to_plan(label: str) -> Optional[Dict[str, Any]]:
+    """План для метки; None — если для метки нужен LLM (поиск требует запроса)."""
+    if label == "reject":
+        return {
+            "is_business": False,
+            "personality": "default",
+            "needs_search": False,
+            "search_query": None,
+            "num_results": 0,
+        }
+    personality, mode = label.split("|", 1)
+    if mode == "search":
+        return None
+    return {
+        "is_business": True,
+        "personality": personality,
+        "needs_search": False,
+        "search_query": None,
+        "num_results": 0,
+    }
+
+
+def _softmax(scores: List[float]) -> List[float]:
+    top = max(scores)
+    exps = [math.exp(s - top) for s in scores]
+    total = sum(exps)
+    return [e / total for e in exps]
+
+
+class PlanClassifier:
+    def __init__(self, labels: List[str], vocab: Dict[str, int], idf: List[float],
+                 weights: List[List[float]], bias: List[float]):
+        self.labels = labels
+        self.vocab = vocab
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+
+    # --- Векторизация ---
+    def vectorize(self, text: str) -> Dict[int, float]:
+        counts = Counter(f for f in extract_features(text) if f in self.vocab)
+        vector = {
+            self.vocab[f]: (1.0 + math.log(n)) * self.idf[self.vocab[f]]
+            for f, n in counts.items()
+        }
+        norm = math.sqrt(sum(v * v for v in vector.values()))
+        if norm:
+            vector = {i: v / norm for i, v in vector.items()}
+        return vector
+
+    def _probabilities(self, vector: Dict[int, float]) -> List[float]:
+        scores = [
+            b + sum(w[i] * v for i, v in vector.items())
+            for w, b in zip(self.weights, self.bias)
+        ]
+        return _softmax(scores)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """Возвращает (метка, уверенность)."""
+        vector = self.vectorize(text)
+        if not vector:
+            # Ни одного известного признака — уверенности нет
+            return self.labels[0], 0.0
+        probs = self._probabilities(vector)
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.labels[best], probs[best]
+
+    # --- Обучение ---
+    @classmethod
+    def train(cls, texts: Sequence[str], labels: Sequence[str], epochs: int = 20,
+              learning_rate: float = 0.5, l2: float = 1e-5, min_df: int = 2,
+              max_features: int = 20000, seed: int = 13) -> "PlanClassifier":
+        doc_features = [set(extract_features(t)) for t in texts]
+        df = Counter(f for feats in doc_features for f in feats)
+        kept = [f for f, n in df.most_common(max_features) if n >= min_df]
+        if not kept:
+            kept = [f for f, _ in df.most_common(max_features)]
+        vocab = {f: i for i, f in enumerate(kept)}
+        n_docs = len(texts)
+        idf = [math.log((1 + n_docs) / (1 + df[f])) + 1.0 for f in kept]
+
+        label_names = sorted(set(labels))
+        label_index = {l: i for i, l in enumerate(label_names)}
+        weights = [[0.0] * len(vocab) for _ in label_names]
+        bias = [0.0] * len(label_names)
+        model = cls(label_names, vocab, idf, weights, bias)
+
+        samples = [(model.vectorize(t), label_index[l]) for t, l in zip(texts, labels)]
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(samples)
+            lr = learning_rate / (1.0 + epoch * 0.2)
+            for vector, target in samples:
+                probs = model._probabilities(vector)
+                for c, p in enumerate(probs):
+                    grad = p - (1.0 if c == target else 0.0)
+                    if grad == 0.0:
+                        continue
+                    row = weights[c]
+                    for i, v in vector.items():
+                        row[i] -= lr * (grad * v + l2 * row[i])
+                    bias[c] -= lr * grad
+        return model
+
+    # --- Сериализация ---
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "format": MODEL_FORMAT_VERSION,
+            "labels": self.labels,
+            "vocab": self.vocab,
+            "idf": [round(v, 6) for v in self.idf],
+            "weights": [[round(v, 6) for v in row] for row in self.weights],
+            "bias": [round(v, 6) for v in self.bias],
+        }
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "PlanClassifier":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("format") != MODEL_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат модели: {data.get('format')}")
+        return cls(data["labels"], data["vocab"], data["idf"], data["weights"], data["bias"])
+
+
+# --- Журнал решений планировщика ---
+#
+# В журнал попадают тексты запросов пользователей, поэтому он пишется только
+# по явному включению и ограничен по размеру: при превышении max_bytes файл
+# переименовывается в <path>.1 (предыдущий .1 удаляется), т.е. на диске
+# хранится не больше двух файлов.
+
+class PlanLogWriter:
+    """Пишет журнал в фоне: запись в очередь, файл — пачками в отдельном потоке."""
+
+    def __init__(self, path: str, max_bytes: int, max_queue: int = 1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Дописывает очередь и останавливает запись."""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+
+    def log(self, query: str, plan: Dict[str, Any], ts: str):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait({"ts": ts, "query": query[:1000], "plan": plan})
+        except asyncio.QueueFull:
+            # Диск не успевает — журнал не должен тормозить ответы
+            self.dropped += 1
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            records = [record for record in batch if record is not None]
+            if records:
+                try:
+                    await asyncio.to_thread(self._write, records)
+                    self.written += len(records)
+                except OSError as e:
+                    print(f"Не удалось записать журнал планов: {e}")
+            if len(records) < len(batch):
+                return
+
+    def _write(self, records: List[Dict[str, Any]]):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size and size + len(data.encode("utf-8")) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+            self.rotations += 1
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._task is not None,
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+def read_plan_log(path: str) -> List[Tuple[str, str]]:
+    """
+    Читает JSONL-журнал {"query": ..., "plan": {...}} (вместе с ротированным
+    <path>.1, если он есть) и возвращает пары (запрос, метка).
+    Повторы одного запроса схлопываются: берётся последнее решение.
+    """
+    latest: Dict[str, str] = {}
+    paths = [p for p in (path + ".1", path) if os.path.exists(p)] or [path]
+    for current in paths:
+        with open(current, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                query = record.get("query")
+                plan = record.get("plan")
+                if not query or not isinstance(plan, dict):
+                    continue
+                latest[normalize_text(query)] = plan_to_label(plan)
+    return list(latest.items())
+
+
+def evaluate(model: PlanClassifier, samples: Iterable[Tuple[str, str]],
+             threshold: float) -> Dict[str, Any]:
+    """
+    Согласие с LLM: overall — по всем примерам, covered — только там,
+    где модель ответила бы сама (уверенность >= порога и метка без поиска).
+    """
+    total = agree = covered = covered_agree = 0
+    for text, expected in samples:
+        predicted, confidence = model.predict(text)
+        total += 1
+        agree += predicted == expected
+        if confidence >= threshold and label_to_plan(predicted) is not None:
+            covered += 1
+            covered_agree += predicted == expected
+    return {
+        "samples": total,
+        "agreement": round(agree / total, 4) if total else 0.0,
+        "coverage": round(covered / total, 4) if total else 0.0,
+        "covered_agreement": round(covered_agree / covered, 4) if covered else 0.0,
+        "threshold": threshold,
+    }
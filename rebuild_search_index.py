@@ -0,0 +1,74 @@
+"""
+Переиндексация полнотекстового поиска по существующей базе: реплики чатов
+(messages_fts) и фрагменты прикреплённых файлов (file_chunks_fts).
+
+Индексы поддерживаются триггерами и создаются миграцией при старте приложения;
+скрипт нужен, если база восстановлена из резервной копии, индекс повреждён
+или после массового изменения messages в обход приложения. Заодно в тексте
+фрагментов файлов, проиндексированных до замены "ё" на "е", буква заменяется.
+
+Пример:
+    python rebuild_search_index.py --db database.db --optimize
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from message_search import REBUILD_STATEMENTS
+
+
+def table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Переиндексация полнотекстового поиска SQLite")
+    default_db = os.environ.get("DB_PATH", os.path.join(os.environ.get("DATA_DIR", "."), "database.db"))
+    parser.add_argument("--db", default=default_db, help="Файл базы данных")
+    parser.add_argument("--optimize", action="store_true", help="Слить сегменты индекса после перестроения")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"База {args.db} не найдена.")
+        sys.exit(1)
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    if not table_exists(conn, "messages_fts"):
+        print("Индекс messages_fts не найден: запустите приложение, чтобы применить миграции.")
+        sys.exit(1)
+
+    started = time.perf_counter()
+    # Одна транзакция: приложение во время перестроения видит прежний индекс
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for statement in REBUILD_STATEMENTS:
+            conn.execute(statement)
+        messages = conn.execute("SELECT COUNT(*) FROM messages WHERE kind = 'message'").fetchone()[0]
+        chunks = 0
+        if table_exists(conn, "file_chunks_fts"):
+            # Фрагменты старых загрузок хранят "ё", а запросы ищут "е"
+            conn.execute(
+                "UPDATE file_chunks SET content = replace(replace(content, 'ё', 'е'), 'Ё', 'Е') "
+                "WHERE instr(content, 'ё') > 0 OR instr(content, 'Ё') > 0"
+            )
+            # В file_chunks индексируется каждая строка, штатный 'rebuild' подходит
+            conn.execute("INSERT INTO file_chunks_fts (file_chunks_fts) VALUES ('rebuild')")
+            chunks = conn.execute("SELECT COUNT(*) FROM file_chunks").fetchone()[0]
+    print(f"Проиндексировано: сообщений {messages}, фрагментов файлов {chunks} "
+          f"за {time.perf_counter() - started:.2f} с.")
+
+    if args.optimize:
+        started = time.perf_counter()
+        with conn:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+            if chunks:
+                conn.execute("INSERT INTO file_chunks_fts (file_chunks_fts) VALUES ('optimize')")
+        print(f"Индексы оптимизированы за {time.perf_counter() - started:.2f} с.")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
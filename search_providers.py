@@ -0,0 +1,206 @@
+# --- Поисковые провайдеры ---
+#
+# SearchProvider — общий интерфейс: search(query, max_results) возвращает список
+# {"title", "href", "body"} в формате aDDGS.text. Провайдеры живут всё время
+# работы приложения (open при старте, close при остановке).
+#
+# HedgedSearch — «хеджированный» поиск поверх нескольких провайдеров: если первый
+# не ответил за p95 своей обычной задержки, параллельно запускается следующий
+# (или повтор того же), побеждает первый успешный ответ, остальные отменяются.
+# Ошибка провайдера сразу передаёт запрос следующему.
+
+import abc
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+from asyncddgs import aDDGS
+
+SearchResults = List[Dict[str, str]]
+
+
+class SearchProvider(abc.ABC):
+    name = "base"
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def search(self, query: str, max_results: int) -> SearchResults:
+        """Результаты в формате aDDGS.text: список {"title", "href", "body"}."""
+
+
+class DDGSProvider(SearchProvider):
+    """Долгоживущий клиент aDDGS с фиксированным бэкендом ("html", "lite" или "auto")."""
+
+    def __init__(self, backend: str = "auto", timeout: int = 10):
+        self.backend = backend
+        self.name = f"ddgs-{backend}"
+        # Встроенный rate limit aDDGS общий на экземпляр: у долгоживущего клиента
+        # он задерживал бы каждый поиск после предыдущего, поэтому выключен
+        self._client = aDDGS(timeout=timeout, enable_rate_limit=False)
+        self._opened = False
+
+    async def open(self):
+        await self._client.__aenter__()
+        self._opened = True
+
+    async def close(self):
+        if self._opened:
+            await self._client.__aexit__()
+            self._opened = False
+
+    async def search(self, query: str, max_results: int) -> SearchResults:
+        return await self._client.text(query, backend=self.backend, max_results=max_results) or []
+
+
+class FakeSearchProvider(SearchProvider):
+    """Локальный провайдер без сети: для тестов и разработки (SEARCH_PROVIDERS=fake)."""
+
+    name = "fake"
+
+    def __init__(self, results: Optional[Dict[str, SearchResults]] = None,
+                 delay: float = 0.0, error: Optional[Exception] = None):
+        self.results = results or {}
+        self.delay = delay
+        self.error = error
+        self.calls: List[str] = []
+
+    async def search(self, query: str, max_results: int) -> SearchResults:
+        self.calls.append(query)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        if query in self.results:
+            return self.results[query][:max_results]
+        return [
+            {
+                "title": f"{query} — результат {i + 1}",
+                "href": f"https://example.com/search/{i + 1}",
+                "body": f"Сниппет {i + 1} по запросу «{query}».",
+            }
+            for i in range(max_results)
+        ]
+
+
+class HedgedSearch:
+    def __init__(self, providers: Sequence[SearchProvider], default_hedge_delay: float = 1.5,
+                 quantile: float = 0.95, min_samples: int = 20, window: int = 200):
+        if not providers:
+            raise ValueError("Нужен хотя бы один поисковый провайдер")
+        self.providers = list(providers)
+        self.default_hedge_delay = default_hedge_delay
+        self.quantile = quantile
+        self.min_samples = min_samples
+        # Задержки первого провайдера — по ним считается порог хеджа. Проигравший хеджу
+        # основной провайдер тоже учитывается: его задержка не меньше прошедшего времени,
+        # иначе медленные ответы выпадали бы из выборки и порог занижался
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self.wins: Dict[str, int] = {p.name: 0 for p in self.providers}
+        self.errors: Dict[str, int] = {p.name: 0 for p in self.providers}
+
+    async def open(self):
+        for provider in self.providers:
+            await provider.open()
+
+    async def close(self):
+        for provider in self.providers:
+            try:
+                await provider.close()
+            except Exception as e:
+                print(f"Ошибка закрытия поискового провайдера {provider.name}: {e}")
+
+    def hedge_delay(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.default_hedge_delay
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.quantile))]
+
+    def _attempts(self):
+        # Первая попытка — основной провайдер, затем остальные по порядку;
+        # при единственном провайдере хедж — это повтор того же запроса
+        if len(self.providers) == 1:
+            return [self.providers[0], self.providers[0]]
+        return list(self.providers)
+
+    async def search(self, query: str, max_results: int) -> SearchResults:
+        self.requests += 1
+        attempts = self._attempts()
+        started = time.perf_counter()
+        running: Dict[asyncio.Task, int] = {}
+        last_error: Optional[BaseException] = None
+
+        def launch(index: int):
+            provider = attempts[index]
+            running[asyncio.create_task(provider.search(query, max_results))] = index
+
+        launch(0)
+        next_index = 1
+        hedged = False
+        try:
+            while running:
+                can_hedge = next_index < len(attempts)
+                # Хедж по таймеру — только один, пока ждём основной провайдер
+                timeout = self.hedge_delay() if can_hedge and not hedged and next_index == 1 else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Основной провайдер дольше обычного p95 — запускаем хедж
+                    self.hedged += 1
+                    hedged = True
+                    launch(next_index)
+                    next_index += 1
+                    continue
+
+                for task in done:
+                    index = running.pop(task)
+                    provider = attempts[index]
+                    if task.exception() is None:
+                        self.wins[provider.name] += 1
+                        if index == 0:
+                            self._latencies.append(time.perf_counter() - started)
+                        else:
+                            if hedged:
+                                self.hedge_wins += 1
+                            if 0 in running.values():
+                                # Основной ещё не ответил и будет отменён — оценка снизу
+                                self._latencies.append(time.perf_counter() - started)
+                        return task.result()
+                    last_error = task.exception()
+                    self.errors[provider.name] += 1
+                    print(f"Ошибка поискового провайдера {provider.name}: {last_error}")
+
+                if not running and next_index < len(attempts):
+                    # Все запущенные упали — сразу переходим к следующему
+                    self.fallbacks += 1
+                    launch(next_index)
+                    next_index += 1
+        finally:
+            for task in running:
+                task.cancel()
+
+        self.failures += 1
+        raise last_error if last_error is not None else RuntimeError("Поиск не выполнен")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "providers": [p.name for p in self.providers],
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1),
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+            "failures": self.failures,
+            "wins": dict(self.wins),
+            "errors": dict(self.errors),
+        }
@@ -9,6 +9,15 @@ let chats = [];
 let isSidebarCollapsed = false;
 let currentFile = null;
 
+// --- Постраничная загрузка (курсоры выдаёт сервер) ---
+const CHATS_PAGE_SIZE = 50;
+const HISTORY_PAGE_SIZE = 40;
+const SCROLL_LOAD_THRESHOLD = 150; // px до края, с которых подгружается следующая страница
+let chatsNextCursor = null;
+let isLoadingChats = false;
+let historyCursor = null; // курсор более старых сообщений текущего чата
+let isLoadingHistory = false;
+
 // --- Переменные для управления стримингом ---
 let isStreaming = false;
 let activeFetchController = null;
@@ -210,37 +219,131 @@ document.addEventListener('DOMContentLoaded', async () => {
         mobileNewChatBtn.onclick = createNewChat;
     }
 
+    // --- Подгрузка страниц при прокрутке: старые сообщения — у верхнего края, чаты — у нижнего ---
+    ['chat', 'chat-mobile'].forEach(id => {
+        const chatDiv = document.getElementById(id);
+        if (chatDiv) {
+            chatDiv.addEventListener('scroll', () => {
+                if (chatDiv.scrollTop < SCROLL_LOAD_THRESHOLD) loadOlderMessages();
+            });
+        }
+    });
+    ['chats-list', 'sidebar-mobile'].forEach(id => {
+        const list = document.getElementById(id);
+        if (list) {
+            list.addEventListener('scroll', () => {
+                if (list.scrollHeight - list.scrollTop - list.clientHeight < SCROLL_LOAD_THRESHOLD) loadMoreChats();
+            });
+        }
+    });
+
     // --- Обновляем мобильный интерфейс при загрузке ---
     // (Это произойдет только если пользователь уже авторизован)
     updateMobileChatsList();
     updateMobileAuthState();
 });
 
-// --- *** ИЗМЕНЕНИЕ: Загрузка чатов с токеном *** ---
-async function loadChats() {
-    try {
-        const response = await fetch('/get_chats', {
-            method: 'GET', // *** ИЗМЕНЕНИЕ: GET, т.к. user_id в токене ***
-            headers: getAuthHeaders() // *** ИЗМЕНЕНИЕ: Добавляем токен ***
-            // body: JSON.stringify({ user_id: userId }) <-- УДАЛЕНО
-        });
-
-        if (!response.ok) {
-            if (response.status === 401) {
-                // Если токен невалиден, разлогиниваем
-                alert("Сессия истекла. Пожалуйста, войдите снова.");
-                logout();
-            }
-            throw new Error('Не удалось загрузить чаты');
+// --- Запрос страницы списка чатов ---
+async function fetchChatsPage(cursor) {
+    const params = new URLSearchParams({ limit: CHATS_PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`/get_chats?${params}`, {
+        method: 'GET',
+        headers: getAuthHeaders()
+    });
+    if (!response.ok) {
+        if (response.status === 401) {
+            alert("Сессия истекла. Пожалуйста, войдите снова.");
+            logout();
         }
+        throw new Error('Не удалось загрузить чаты');
+    }
+    return response.json();
+}
 
-        const data = await response.json();
+// --- *** ИЗМЕНЕНИЕ: Загрузка чатов с токеном (первая страница) *** ---
+async function loadChats() {
+    try {
+        const data = await fetchChatsPage(null);
         chats = data.chats;
+        chatsNextCursor = data.next_cursor;
         renderChatsList(); // Обновит и ПК, и мобильный список
 
     } catch (e) {
         console.error("Ошибка загрузки чатов:", e);
         chats = [];
+        chatsNextCursor = null;
+    }
+}
+
+// --- Следующая страница списка чатов (при прокрутке сайдбара) ---
+async function loadMoreChats() {
+    if (!chatsNextCursor || isLoadingChats) return;
+    isLoadingChats = true;
+    try {
+        const data = await fetchChatsPage(chatsNextCursor);
+        // Чат мог подняться на первую страницу, пока листали список
+        const known = new Set(chats.map(c => c.id));
+        chats = chats.concat(data.chats.filter(c => !known.has(c.id)));
+        chatsNextCursor = data.next_cursor;
+        renderChatsList();
+
+        const activeItem = document.querySelector(`.chat-item[data-id="${currentChatId}"]`);
+        if (activeItem) activeItem.classList.add('active');
+        const activeItemMobile = document.querySelector(`#chats-list-mobile .chat-item[data-id="${currentChatId}"]`);
+        if (activeItemMobile) activeItemMobile.classList.add('active');
+    } catch (e) {
+        console.error("Ошибка загрузки чатов:", e);
+    } finally {
+        isLoadingChats = false;
+    }
+}
+
+// --- Запрос страницы истории чата (cursor — позиция, до которой брать сообщения) ---
+async function fetchHistoryPage(chatId, cursor) {
+    const body = { chat_id: chatId, limit: HISTORY_PAGE_SIZE };
+    if (cursor) body.cursor = cursor;
+    const response = await fetch('/get_chat_history', {
+        method: 'POST',
+        headers: getAuthHeaders(),
+        body: JSON.stringify(body)
+    });
+    if (!response.ok) {
+        if (response.status === 401) {
+            alert("Сессия истекла. Пожалуйста, войдите снова.");
+            logout();
+        }
+        throw new Error('Не удалось загрузить историю чата');
+    }
+    return response.json();
+}
+
+// --- Подгрузка более старых сообщений (при прокрутке к началу чата) ---
+async function loadOlderMessages() {
+    if (!historyCursor || isLoadingHistory) return;
+    const chatId = currentChatId;
+    isLoadingHistory = true;
+    try {
+        const page = await fetchHistoryPage(chatId, historyCursor);
+        // Пока шёл запрос, пользователь мог переключить чат
+        if (chatId !== currentChatId) return;
+        historyCursor = page.next_cursor;
+        prependMessagesToChat(document.getElementById('chat'), page.messages);
+        prependMessagesToChat(document.getElementById('chat-mobile'), page.messages);
+    } catch (error) {
+        console.error("Ошибка загрузки истории чата:", error);
+    } finally {
+        isLoadingHistory = false;
+    }
+}
+
+// --- Пока страница истории не заполняет окно, прокрутки нет — догружаем сразу ---
+async function fillChatViewport() {
+    const chatDiv = document.getElementById('chat');
+    while (historyCursor && chatDiv.scrollHeight <= chatDiv.clientHeight && chatDiv.clientHeight > 0) {
+        const before = historyCursor;
+        await loadOlderMessages();
+        if (historyCursor === before) break;
     }
 }
 
@@ -340,6 +443,7 @@ async function setCurrentChat(chatId) {
     }
 
     currentChatId = chatId;
+    historyCursor = null;
     const chat = chats.find(c => c.id === chatId);
     if (!chat) {
         console.error(`Чат с ID ${chatId} не найден в локальном кэше.`);
@@ -389,25 +493,16 @@ async function setCurrentChat(chatId) {
 
     try {
         // *** ИЗМЕНЕНИЕ: Запрос истории чата с токеном ***
-        const response = await fetch('/get_chat_history', {
-            method: 'POST',
-            headers: getAuthHeaders(), // *** ИЗМЕНЕНИЕ: Добавляем токен ***
-            body: JSON.stringify({ chat_id: chatId }) // *** ИЗМЕНЕНИЕ: user_id не нужен ***
-        });
-
-        if (!response.ok) {
-             if (response.status === 401) {
-                alert("Сессия истекла. Пожалуйста, войдите снова.");
-                logout();
-            }
-            throw new Error('Не удалось загрузить историю чата');
-        }
-
-        const chatHistory = await response.json();
+        // Загружается только последняя страница, более старые — при прокрутке вверх
+        const chatHistory = await fetchHistoryPage(chatId, null);
+        // Пока шёл запрос, пользователь мог переключить чат
+        if (chatId !== currentChatId) return;
         chatHistory.messages.forEach(msg => {
             addMessageToChat(msg.role, msg.content);
             addMessageToChatMobile(msg.role, msg.content);
         });
+        historyCursor = chatHistory.next_cursor;
+        await fillChatViewport();
 
     } catch (error) {
         console.error("Ошибка загрузки истории чата:", error);
@@ -696,9 +791,8 @@ function autoResize() {
     userInput.style.height = Math.min(userInput.scrollHeight, maxHeight) + 'px';
 }
 
-// --- Добавление сообщения в чат (ПК) ---
-function addMessageToChat(role, content) {
-    const chatDiv = document.getElementById('chat');
+// --- Элемент сообщения (общий для ПК и мобильной версии) ---
+function createMessageElement(role, content) {
     const messageDiv = document.createElement('div');
     messageDiv.className = role === 'user' ? 'user-message' : 'ai-message';
 
@@ -715,11 +809,27 @@ function addMessageToChat(role, content) {
         const htmlContent = marked.parse(content);
         messageDiv.innerHTML = `<strong>PNI:</strong> ${htmlContent}`;
     }
+    return messageDiv;
+}
 
-    chatDiv.appendChild(messageDiv);
+// --- Добавление сообщения в чат (ПК) ---
+function addMessageToChat(role, content) {
+    const chatDiv = document.getElementById('chat');
+    chatDiv.appendChild(createMessageElement(role, content));
     chatDiv.scrollTop = chatDiv.scrollHeight;
 }
 
+// --- Вставка страницы более старых сообщений в начало чата ---
+function prependMessagesToChat(chatDiv, messages) {
+    if (!chatDiv || messages.length === 0) return;
+    const fragment = document.createDocumentFragment();
+    messages.forEach(msg => fragment.appendChild(createMessageElement(msg.role, msg.content)));
+    // Сохраняем видимую позицию: содержимое выше выросло на высоту вставки
+    const offsetFromBottom = chatDiv.scrollHeight - chatDiv.scrollTop;
+    chatDiv.insertBefore(fragment, chatDiv.firstChild);
+    chatDiv.scrollTop = chatDiv.scrollHeight - offsetFromBottom;
+}
+
 // --- Блокировка/разблокировка действий в сайдбаре ---
 function disableSidebarActions(disable) {
     // ПК
@@ -854,22 +964,7 @@ async function sendMessageStreamMobile() {
 // Добавление сообщения в мобильный чат
 function addMessageToChatMobile(role, content) {
     const chatDiv = document.getElementById('chat-mobile');
-    const messageDiv = document.createElement('div');
-    messageDiv.className = role === 'user' ? 'user-message' : 'ai-message';
-    if (role === 'user') {
-        const textNode = document.createTextNode(content);
-        const p = document.createElement('p');
-        p.appendChild(textNode);
-        p.innerHTML = p.innerHTML.replace(/\n/g, '<br>');
-        const strong = document.createElement('strong');
-        strong.textContent = "Вы: ";
-        messageDiv.appendChild(strong);
-        messageDiv.appendChild(p);
-    } else {
-        const htmlContent = marked.parse(content);
-        messageDiv.innerHTML = `<strong>PNI:</strong> ${htmlContent}`;
-    }
-    chatDiv.appendChild(messageDiv);
+    chatDiv.appendChild(createMessageElement(role, content));
     chatDiv.scrollTop = chatDiv.scrollHeight;
 }
 
@@ -0,0 +1,9 @@
+# Тесты запускаются из корня репозитория: python -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# app.py требует ключи при импорте; в тестах они не используются по назначению
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret")
+os.environ.setdefault("CEREBRAS_API_KEY", "test-key")
@@ -0,0 +1,91 @@
+from context_builder import (
+    SUMMARY_PREFIX, TRUNCATED_MARK, build_context, count_tokens, message_tokens, truncate_to_tokens,
+)
+
+SYSTEM = {"role": "system", "content": "Ты помощник малого бизнеса."}
+
+
+def _dialogue(turns: int, words: int = 40, start: int = 0):
+    messages = []
+    for i in range(start, start + turns):
+        messages.append({"role": "user", "content": f"вопрос {i} " + "слово " * words, "kind": "message"})
+        messages.append({"role": "assistant", "content": f"ответ {i} " + "текст " * words, "kind": "message"})
+    return messages
+
+
+def _used(final_messages) -> int:
+    return sum(message_tokens(m) for m in final_messages)
+
+
+def test_everything_fits_into_large_budget():
+    messages = _dialogue(3) + [{"role": "user", "content": "новый вопрос", "kind": "message"}]
+    final, report = build_context(SYSTEM, messages, None, 100000, 4, 100)
+    assert [m["content"] for m in final[1:]] == [m["content"] for m in messages]
+    assert report.dropped == 0 and report.total_tokens == _used(final)
+
+
+def test_old_history_is_dropped_oldest_first_within_budget():
+    messages = _dialogue(20) + [{"role": "user", "content": "новый вопрос", "kind": "message"}]
+    budget = 1000
+    final, report = build_context(SYSTEM, messages, None, budget, 4, 100)
+
+    assert _used(final) <= budget
+    assert report.total_tokens == _used(final)
+    assert report.dropped > 0
+    # Остаётся непрерывный хвост разговора, заканчивающийся текущим вопросом
+    contents = [m["content"] for m in final[1:]]
+    assert contents == [m["content"] for m in messages[-len(contents):]]
+
+
+def test_current_question_is_kept_even_over_budget():
+    question = {"role": "user", "content": "длинный вопрос " * 200, "kind": "message"}
+    final, report = build_context(SYSTEM, _dialogue(2) + [question], None, 50, 4, 100)
+    assert final[-1]["content"] == question["content"]
+    assert len(final) == 2
+    assert report.dropped == 4
+
+
+def test_extra_context_is_truncated_to_the_remaining_budget():
+    messages = [{"role": "user", "content": "что в файле?", "kind": "message"}]
+    extra = "строка документа " * 2000
+    budget = 600
+    final, report = build_context(SYSTEM, messages, extra, budget, 4, 100)
+
+    assert report.extra_truncated
+    assert final[1]["content"].endswith(TRUNCATED_MARK)
+    assert _used(final) <= budget
+
+
+def test_old_file_context_is_compacted_and_summary_replaces_covered_messages():
+    file_message = {"role": "system", "content": "Контекст файла: " + "данные " * 500, "kind": "file"}
+    messages = _dialogue(2) + [file_message] + _dialogue(1, start=2) + [
+        {"role": "user", "content": "и что дальше?", "kind": "message"},
+    ]
+
+    def build(budget):
+        final, report = build_context(
+            SYSTEM, messages, None, budget, 3, 60, summary="говорили о налогах", summary_upto=2,
+        )
+        assert _used(final) <= budget
+        return [m["content"] for m in final], report
+
+    contents, report = build(600)
+    assert contents[1] == SUMMARY_PREFIX + "говорили о налогах"
+    # Первые два сообщения покрыты резюме
+    assert messages[0]["content"] not in contents and messages[1]["content"] not in contents
+    assert messages[2]["content"] in contents and messages[3]["content"] in contents
+    assert file_message["content"] not in contents
+    assert any(c.startswith("[Ранее в чате был передан контекст") for c in contents)
+    assert report.compacted == 1
+
+    # Бюджета меньше: сжатый контекст файла отбрасывается раньше реплик
+    contents, report = build(400)
+    assert messages[2]["content"] in contents and messages[3]["content"] in contents
+    assert not any(c.startswith("[Ранее в чате был передан контекст") for c in contents)
+
+
+def test_truncate_to_tokens_respects_limit():
+    text = "слово " * 1000
+    assert truncate_to_tokens("коротко", 100) == "коротко"
+    assert count_tokens(truncate_to_tokens(text, 50)) <= 50
+    assert truncate_to_tokens(text, 1) == ""
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from db_engine import GroupCommitWriter, open_writer_connection
+
+
+async def _open(path):
+    conn = await open_writer_connection(str(path))
+    await conn.execute("CREATE TABLE items (name TEXT PRIMARY KEY)")
+    writer = GroupCommitWriter(conn)
+    writer.start()
+    return conn, writer
+
+
+def _insert(name):
+    async def op(db):
+        await db.execute("INSERT INTO items (name) VALUES (?)", (name,))
+        return name
+    return op
+
+
+async def _names(conn):
+    async with conn.execute("SELECT name FROM items ORDER BY name") as cursor:
+        return [row[0] async for row in cursor]
+
+
+def test_failed_op_is_rolled_back_without_touching_its_batch(tmp_path):
+    async def scenario():
+        conn, writer = await _open(tmp_path / "db.sqlite")
+
+        async def half_done(db):
+            # Первая запись операции должна откатиться вместе с ней
+            await db.execute("INSERT INTO items (name) VALUES ('partial')")
+            raise ValueError("boom")
+
+        # Все операции попадают в очередь до того, как писатель её разберёт, — одна пачка
+        results = await asyncio.gather(
+            writer.submit(_insert("a")),
+            writer.submit(half_done),
+            writer.submit(_insert("b")),
+            return_exceptions=True,
+        )
+        stats = writer.stats()
+        names = await _names(conn)
+        await writer.close()
+        await conn.close()
+        return results, stats, names
+
+    results, stats, names = asyncio.run(scenario())
+    assert results[0] == "a" and results[2] == "b"
+    assert isinstance(results[1], ValueError)
+    assert names == ["a", "b"]
+    assert stats["commits"] == 1
+    assert stats["ops"] == 3
+    assert stats["failed_ops"] == 1
+
+
+def test_constraint_error_fails_only_its_own_op(tmp_path):
+    async def scenario():
+        conn, writer = await _open(tmp_path / "db.sqlite")
+        await writer.submit(_insert("a"))
+        results = await asyncio.gather(
+            writer.submit(_insert("a")),
+            writer.submit(_insert("c")),
+            return_exceptions=True,
+        )
+        names = await _names(conn)
+        await writer.close()
+        await conn.close()
+        return results, names
+
+    results, names = asyncio.run(scenario())
+    assert isinstance(results[0], Exception)
+    assert results[1] == "c"
+    assert names == ["a", "c"]
+
+
+def test_submit_requires_started_writer(tmp_path):
+    async def scenario():
+        conn = await open_writer_connection(str(tmp_path / "db.sqlite"))
+        try:
+            with pytest.raises(RuntimeError):
+                await GroupCommitWriter(conn).submit(_insert("a"))
+        finally:
+            await conn.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import sqlite3
+
+import app
+import message_search
+import pagination
+from db_engine import open_writer_connection
+
+LEGACY_CHATS = [
+    ("alice", "c1", "Налоги", [
+        {"role": "user", "content": "Как платить налоги на упрощёнке?"},
+        {"role": "assistant", "content": "Раз в квартал авансом."},
+        {"role": "system", "content": "Контекст, извлеченный из прикрепленного файла 'a.txt':\nтекст"},
+        {"role": "user", "content": "А патент?"},
+    ], "2026-01-02T10:00:00"),
+    ("alice", "c2", "Пустой", [], None),
+    ("bob", "c3", "Чужой", [{"role": "user", "content": "налоги для ИП"}], "2026-01-03T10:00:00"),
+]
+
+
+def _make_v0_database(path):
+    """База в исходном формате: история чата — JSON в chats.messages, user_version = 0."""
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE chats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            chat_id TEXT UNIQUE NOT NULL,
+            chat_name TEXT NOT NULL,
+            messages TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            hashed_password TEXT NOT NULL
+        )
+    """)
+    conn.executemany("INSERT INTO users (username, hashed_password) VALUES (?, 'x')", [("alice",), ("bob",)])
+    conn.executemany(
+        "INSERT INTO chats (user_id, chat_id, chat_name, messages, updated_at) VALUES (?, ?, ?, ?, ?)",
+        [(user, chat, name, json.dumps(messages, ensure_ascii=False), updated)
+         for user, chat, name, messages, updated in LEGACY_CHATS],
+    )
+    conn.commit()
+    conn.close()
+
+
+async def _migrate(path):
+    db = await open_writer_connection(str(path))
+    await app._migrate_schema(db)
+    return db
+
+
+async def _fetch(db, query, params=()):
+    async with db.execute(query, params) as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+
+def test_v0_database_migrates_to_current_schema(tmp_path):
+    path = tmp_path / "database.db"
+    _make_v0_database(str(path))
+
+    async def scenario():
+        db = await _migrate(path)
+        result = {
+            "version": (await _fetch(db, "PRAGMA user_version"))[0][0],
+            "messages": await _fetch(db, "SELECT chat_id, seq, role, kind FROM messages ORDER BY chat_id, seq"),
+            "legacy": await _fetch(db, "SELECT COUNT(*) FROM chats WHERE messages IS NOT NULL"),
+            "chats": await _fetch(
+                db, "SELECT chat_id, preview, message_count, summary, summary_seq, updated_at "
+                    "FROM chats ORDER BY chat_id"
+            ),
+            "found": await message_search.search_messages(db, "alice", '"упрощенк"*', 10),
+            "foreign": await message_search.search_messages(db, "alice", '"ип"', 10),
+            "page": (await pagination.chats_page(db, "alice", 1))[0],
+        }
+        # Повторный запуск (рестарт воркера) ничего не дублирует
+        await app._migrate_schema(db)
+        result["messages_again"] = await _fetch(db, "SELECT COUNT(*) FROM messages")
+        await db.close()
+        return result
+
+    result = asyncio.run(scenario())
+    assert result["version"] == app.SCHEMA_VERSION
+    assert result["messages"] == [
+        ("c1", 0, "user", "message"),
+        ("c1", 1, "assistant", "message"),
+        ("c1", 2, "system", "file"),
+        ("c1", 3, "user", "message"),
+        ("c3", 0, "user", "message"),
+    ]
+    assert result["legacy"] == [(0,)]
+    assert result["chats"] == [
+        ("c1", "А патент?", 4, None, 0, "2026-01-02T10:00:00"),
+        ("c2", None, 0, None, 0, ""),
+        ("c3", "налоги для ИП", 1, None, 0, "2026-01-03T10:00:00"),
+    ]
+    # Реплики проиндексированы (с заменой ё), и поиск не видит чужие чаты
+    assert [(row["chat_id"], row["seq"]) for row in result["found"]] == [("c1", 0)]
+    assert result["foreign"] == []
+    assert [row["chat_id"] for row in result["page"]] == ["c1"]
+    assert result["messages_again"] == [(5,)]
+
+
+def test_v5_database_gets_keyset_index(tmp_path):
+    path = tmp_path / "database.db"
+    _make_v0_database(str(path))
+
+    async def scenario():
+        db = await _migrate(path)
+        # Состояние версии 5: прежний индекс списка чатов и NULL в updated_at
+        await db.execute("CREATE INDEX idx_chats_user_updated ON chats (user_id, updated_at)")
+        await db.execute("UPDATE chats SET updated_at = NULL WHERE chat_id = 'c2'")
+        await db.execute("PRAGMA user_version = 5")
+        await app._migrate_schema(db)
+        indexes = {row[0] for row in await _fetch(db, "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        updated = await _fetch(db, "SELECT updated_at FROM chats WHERE chat_id = 'c2'")
+        await db.close()
+        return indexes, updated
+
+    indexes, updated = asyncio.run(scenario())
+    assert "idx_chats_user_updated" not in indexes
+    assert "idx_chats_user_updated_chat" in indexes
+    assert updated == [("",)]
@@ -0,0 +1,106 @@
+import asyncio
+import base64
+import json
+
+import aiosqlite
+import pytest
+
+import pagination
+from pagination import CHATS_CURSOR_FIELDS, HISTORY_CURSOR_FIELDS, decode_cursor, encode_cursor
+
+
+def _raw_cursor(value) -> str:
+    raw = json.dumps(value).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def test_cursor_round_trip():
+    position = {"u": "2026-01-02T03:04:05", "c": "чат-1"}
+    assert decode_cursor(encode_cursor(position), CHATS_CURSOR_FIELDS) == position
+    assert decode_cursor(encode_cursor({"s": 42}), HISTORY_CURSOR_FIELDS) == {"s": 42}
+
+
+@pytest.mark.parametrize("cursor, fields", [
+    ("не base64!", CHATS_CURSOR_FIELDS),
+    (base64.urlsafe_b64encode(b"\xff\xfe").decode(), CHATS_CURSOR_FIELDS),
+    (_raw_cursor([1, 2]), HISTORY_CURSOR_FIELDS),
+    (_raw_cursor({"u": "x"}), CHATS_CURSOR_FIELDS),
+    (_raw_cursor({"u": 1, "c": "x"}), CHATS_CURSOR_FIELDS),
+    (_raw_cursor({"s": "5"}), HISTORY_CURSOR_FIELDS),
+    (_raw_cursor({"s": True}), HISTORY_CURSOR_FIELDS),
+    (_raw_cursor({"s": 2 ** 63}), HISTORY_CURSOR_FIELDS),
+    # Курсор истории не подходит списку чатов и наоборот
+    (encode_cursor({"s": 1}), CHATS_CURSOR_FIELDS),
+    (encode_cursor({"u": "x", "c": "y"}), HISTORY_CURSOR_FIELDS),
+])
+def test_bad_cursor_is_rejected(cursor, fields):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, fields)
+
+
+async def _db():
+    db = await aiosqlite.connect(":memory:")
+    db.row_factory = aiosqlite.Row
+    await db.execute(
+        "CREATE TABLE chats (chat_id TEXT, user_id TEXT, chat_name TEXT, preview TEXT, updated_at TEXT)"
+    )
+    await db.execute("CREATE TABLE messages (chat_id TEXT, seq INTEGER, role TEXT, content TEXT, kind TEXT)")
+    return db
+
+
+def test_chats_pages_cover_all_chats_once():
+    async def scenario():
+        db = await _db()
+        # Два чата с одинаковым updated_at: порядок между ними задаёт chat_id
+        rows = [(f"c{i}", "u1", f"chat {i}", "", f"2026-01-{i // 2 + 1:02d}") for i in range(7)]
+        rows.append(("other", "u2", "чужой", "", "2026-02-01"))
+        await db.executemany("INSERT INTO chats VALUES (?, ?, ?, ?, ?)", rows)
+
+        seen, after = [], None
+        while True:
+            page, cursor = await pagination.chats_page(db, "u1", 3, after)
+            seen.extend(row["chat_id"] for row in page)
+            if cursor is None:
+                break
+            position = decode_cursor(cursor, CHATS_CURSOR_FIELDS)
+            after = (position["u"], position["c"])
+        everything, last_cursor = await pagination.chats_page(db, "u1", None)
+        await db.close()
+        return seen, [row["chat_id"] for row in everything], last_cursor
+
+    seen, everything, last_cursor = asyncio.run(scenario())
+    assert seen == everything
+    assert seen == ["c6", "c5", "c4", "c3", "c2", "c1", "c0"]
+    assert last_cursor is None
+
+
+def test_history_pages_go_back_in_time_and_skip_hidden_messages():
+    async def scenario():
+        db = await _db()
+        rows = [("c1", seq, "user", f"m{seq}", "message") for seq in range(5)]
+        rows.append(("c1", 5, "system", "file", "file"))
+        rows.append(("c1", 6, "assistant", "m6", "message"))
+        await db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+
+        pages, before = [], None
+        while True:
+            page, cursor = await pagination.messages_page(db, "c1", 2, before)
+            pages.append([row["content"] for row in page])
+            if cursor is None:
+                break
+            before = decode_cursor(cursor, HISTORY_CURSOR_FIELDS)["s"]
+        await db.close()
+        return pages
+
+    assert asyncio.run(scenario()) == [["m4", "m6"], ["m2", "m3"], ["m0", "m1"]]
+
+
+def test_app_maps_bad_cursor_to_400():
+    from fastapi import HTTPException
+
+    import app
+
+    with pytest.raises(HTTPException) as error:
+        app._decode_page_cursor(_raw_cursor({"s": "1"}), HISTORY_CURSOR_FIELDS)
+    assert error.value.status_code == 400
+    assert app._decode_page_cursor(encode_cursor({"s": 3}), HISTORY_CURSOR_FIELDS) == {"s": 3}
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from search_providers import FakeSearchProvider, HedgedSearch, SearchProvider
+
+
+def _provider(name, **kwargs):
+    provider = FakeSearchProvider(**kwargs)
+    provider.name = name
+    return provider
+
+
+def test_fast_primary_answers_without_hedge():
+    primary = _provider("primary")
+    backup = _provider("backup")
+    search = HedgedSearch([primary, backup], default_hedge_delay=0.5)
+
+    results = asyncio.run(search.search("кофейня", 2))
+
+    assert len(results) == 2
+    assert backup.calls == []
+    assert search.stats()["hedged"] == 0
+    assert search.wins == {"primary": 1, "backup": 0}
+    assert len(search._latencies) == 1
+
+
+def test_slow_primary_is_hedged_and_its_latency_recorded():
+    primary = _provider("primary", delay=1.0, results={"q": [{"title": "slow", "href": "", "body": ""}]})
+    backup = _provider("backup", results={"q": [{"title": "fast", "href": "", "body": ""}]})
+    search = HedgedSearch([primary, backup], default_hedge_delay=0.05)
+
+    results = asyncio.run(search.search("q", 3))
+
+    assert results[0]["title"] == "fast"
+    assert search.hedged == 1 and search.hedge_wins == 1
+    # Проигравший основной провайдер всё равно даёт оценку задержки снизу
+    assert len(search._latencies) == 1
+    assert search._latencies[0] >= 0.05
+
+
+def test_primary_error_falls_back_immediately():
+    primary = _provider("primary", error=RuntimeError("down"))
+    backup = _provider("backup")
+    search = HedgedSearch([primary, backup], default_hedge_delay=5.0)
+
+    results = asyncio.run(asyncio.wait_for(search.search("q", 1), timeout=1.0))
+
+    assert len(results) == 1
+    assert search.fallbacks == 1
+    assert search.errors["primary"] == 1
+    assert len(search._latencies) == 0
+
+
+def test_all_providers_failing_raises_last_error():
+    search = HedgedSearch([
+        _provider("primary", error=RuntimeError("first")),
+        _provider("backup", error=ValueError("second")),
+    ])
+
+    with pytest.raises(ValueError):
+        asyncio.run(search.search("q", 1))
+    assert search.failures == 1
+
+
+def test_hedge_delay_follows_recorded_quantile():
+    search = HedgedSearch([_provider("primary")], default_hedge_delay=1.5, quantile=0.9, min_samples=10)
+    assert search.hedge_delay() == 1.5
+    search._latencies.extend(i / 100 for i in range(1, 11))
+    assert search.hedge_delay() == pytest.approx(0.10)
+
+
+def test_search_provider_is_abstract():
+    with pytest.raises(TypeError):
+        SearchProvider()
@@ -0,0 +1,78 @@
+"""
+Обучение и оценка локального классификатора планов.
+
+Журнал решений LLM-планировщика пишет app.py при PLAN_LOG_ENABLED=true
+(PLAN_LOG_PATH, по умолчанию plan_log.jsonl; ротированный plan_log.jsonl.1
+читается вместе с ним). Скрипт делит его на обучающую и тестовую выборки, обучает
+PlanClassifier, печатает отчёт о согласии с LLM и сохраняет модель, которую
+приложение подхватывает при старте (PLAN_CLASSIFIER_PATH).
+
+Пример:
+    python train_plan_classifier.py --log plan_log.jsonl --out plan_classifier.json
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from collections import Counter
+
+from plan_classifier import PlanClassifier, evaluate, read_plan_log
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обучение локального классификатора планов")
+    parser.add_argument("--log", default="plan_log.jsonl", help="JSONL-журнал решений планировщика")
+    parser.add_argument("--out", default="plan_classifier.json", help="Куда сохранить модель")
+    parser.add_argument("--test-split", type=float, default=0.2, help="Доля тестовой выборки")
+    parser.add_argument("--threshold", type=float, default=0.9, help="Порог уверенности fast-path")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=13)
+    parser.add_argument("--eval-only", action="store_true",
+                        help="Не обучать: оценить уже сохранённую модель --out на всём журнале")
+    args = parser.parse_args()
+
+    samples = read_plan_log(args.log)
+    if not samples:
+        print(f"В журнале {args.log} нет пригодных записей.")
+        sys.exit(1)
+
+    print(f"Примеров (уникальных запросов): {len(samples)}")
+    print("Распределение меток:", dict(Counter(label for _, label in samples).most_common()))
+
+    if args.eval_only:
+        model = PlanClassifier.load(args.out)
+        print(json.dumps(evaluate(model, samples, args.threshold), ensure_ascii=False, indent=2))
+        return
+
+    rng = random.Random(args.seed)
+    rng.shuffle(samples)
+    n_test = int(len(samples) * args.test_split)
+    test, train = samples[:n_test], samples[n_test:]
+
+    started = time.perf_counter()
+    model = PlanClassifier.train(
+        [text for text, _ in train],
+        [label for _, label in train],
+        epochs=args.epochs,
+        seed=args.seed,
+    )
+    print(f"Обучение: {len(train)} примеров, {len(model.vocab)} признаков, "
+          f"{time.perf_counter() - started:.1f} с")
+
+    print("\n--- Отчёт о согласии с LLM ---")
+    print("train:", json.dumps(evaluate(model, train, args.threshold), ensure_ascii=False))
+    if test:
+        print("test: ", json.dumps(evaluate(model, test, args.threshold), ensure_ascii=False))
+        for threshold in (0.7, 0.8, 0.9, 0.95, 0.99):
+            report = evaluate(model, test, threshold)
+            print(f"  порог {threshold:.2f}: покрытие {report['coverage']:.1%}, "
+                  f"согласие на покрытых {report['covered_agreement']:.1%}")
+
+    model.save(args.out)
+    print(f"\nМодель сохранена: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+# --- Приём загружаемых файлов: лимит размера и спул на диск ---
+#
+# Файл не собирается в bytes целиком: UploadSizeLimitMiddleware отсекает слишком
+# большие запросы по Content-Length (и считает байты тела, если заголовка нет),
+# а receive_upload_form разбирает multipart-форму прямо из потока запроса и пишет
+# файл кусками во временный файл, по пути считая SHA-256 и проверяя лимит.
+# Промежуточной копии Starlette (SpooledTemporaryFile) нет: файл попадает на диск
+# один раз, и парсеры читают его оттуда по пути.
+
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from fastapi import HTTPException, Request
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.responses import JSONResponse
+
+# Запас на остальные поля multipart-формы (сообщение, chat_id, границы частей)
+FORM_OVERHEAD_BYTES = 64 * 1024
+# Расширение загрузки, которое сохраняется у временного файла
+SAFE_SUFFIX_RE = re.compile(r"\.[a-z0-9]{1,10}")
+
+
+def _too_large_detail(max_bytes: int) -> str:
+    return f"Файл слишком большой (максимум {max_bytes // (1024 * 1024)} МБ)."
+
+
+class UploadSizeLimitMiddleware:
+    """ASGI-middleware: 413 для тела запроса больше лимита на указанных путях."""
+
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.max_body = max_bytes + FORM_OVERHEAD_BYTES
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body:
+            response = JSONResponse({"detail": _too_large_detail(self.max_bytes)}, status_code=413)
+            await response(scope, receive, send)
+            return
+
+        # Без Content-Length (chunked) считаем байты по мере чтения тела
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    raise HTTPException(status_code=413, detail=_too_large_detail(self.max_bytes))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+@dataclass
+class SpooledUpload:
+    path: str
+    filename: str
+    size: int = 0
+    sha256: str = ""
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_chunks(out, digest, chunks: List[bytes]):
+    # hashlib отпускает GIL на больших буферах — хэш и запись вместе в потоке
+    for chunk in chunks:
+        digest.update(chunk)
+        out.write(chunk)
+
+
+async def _receive_urlencoded_form(request: Request) -> Dict[str, str]:
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > FORM_OVERHEAD_BYTES:
+            raise HTTPException(status_code=413, detail="Поле формы слишком большое.")
+    return dict(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+
+
+async def receive_upload_form(request: Request, max_bytes: int,
+                              directory: Optional[str] = None) -> Tuple[Dict[str, str], Optional[SpooledUpload]]:
+    """
+    Читает multipart-форму из потока запроса: текстовые поля и не больше одного
+    файла, записанного во временный файл. Форма без файла может прийти и как
+    application/x-www-form-urlencoded. 400 — форма повреждена,
+    413 — файл больше max_bytes. Временный файл удаляет вызывающий (remove()).
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type == b"application/x-www-form-urlencoded":
+        return await _receive_urlencoded_form(request), None
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Ожидается форма multipart/form-data.")
+
+    fields: Dict[str, str] = {}
+    upload: Optional[SpooledUpload] = None
+    out = None
+    digest = hashlib.sha256()
+    # Куски файла из очередного пакета тела, ещё не записанные на диск
+    pending: List[bytes] = []
+    part: Dict[str, object] = {}
+    header = {"name": b"", "value": b""}
+
+    def on_part_begin():
+        part.clear()
+        part.update(disposition=b"", name="", is_file=False, data=bytearray())
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header["name"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        if header["name"].lower() == b"content-disposition":
+            part["disposition"] = header["value"]
+        header["name"] = header["value"] = b""
+
+    def on_headers_finished():
+        nonlocal upload, out
+        _, options = parse_options_header(part["disposition"])
+        part["name"] = options.get(b"name", b"").decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        # Пустое имя — браузер отправил поле файла без выбранного файла
+        if not filename:
+            return
+        if upload is not None:
+            raise HTTPException(status_code=400, detail="Можно прикрепить только один файл.")
+        name = filename.decode("utf-8", "replace")
+        # Расширение нужно и на диске: openpyxl отказывается открывать файл без .xlsx
+        suffix = os.path.splitext(name)[1].lower()
+        fd, path = tempfile.mkstemp(prefix="upload-", suffix=suffix if SAFE_SUFFIX_RE.fullmatch(suffix) else "",
+                                    dir=directory)
+        out = os.fdopen(fd, "wb")
+        upload = SpooledUpload(path=path, filename=name)
+        part["is_file"] = True
+
+    def on_part_data(data: bytes, start: int, end: int):
+        if part["is_file"]:
+            upload.size += end - start
+            if upload.size > max_bytes:
+                raise HTTPException(status_code=413, detail=_too_large_detail(max_bytes))
+            pending.append(data[start:end])
+        else:
+            part["data"] += data[start:end]
+            if len(part["data"]) > FORM_OVERHEAD_BYTES:
+                raise HTTPException(status_code=413, detail="Поле формы слишком большое.")
+
+    def on_part_end():
+        if not part["is_file"]:
+            fields[part["name"]] = part["data"].decode("utf-8", "replace")
+
+    callbacks = {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    }
+    try:
+        parser = MultipartParser(boundary, callbacks)
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if pending:
+                await asyncio.to_thread(_write_chunks, out, digest, pending[:])
+                pending.clear()
+        parser.finalize()
+    except BaseException as e:
+        if out is not None:
+            out.close()
+        if upload is not None:
+            upload.remove()
+        if isinstance(e, FormParserError):
+            raise HTTPException(status_code=400, detail="Некорректная форма.") from None
+        raise
+    if out is not None:
+        out.close()
+        upload.sha256 = digest.hexdigest()
+    return fields, upload